@@ -31,6 +31,11 @@ from carina.blueprints.usuarios.views import usuarios
 from carina.blueprints.usuarios_roles.views import usuarios_roles
 from carina.extensions import csrf, database, login_manager, moment
 from config.settings import Settings
+from lib.disk_cache import DiskCache
+from lib.storage_backends import create_storage_backend, set_storage_backend
+
+# App de este proceso, la comparten los módulos de tareas y los comandos del CLI
+_app = None
 
 
 def create_app():
@@ -45,6 +50,14 @@ def create_app():
     app.redis = Redis.from_url(app.config["REDIS_URL"])
     app.task_queue = rq.Queue(app.config["TASK_QUEUE"], connection=app.redis, default_timeout=3000)
 
+    # Backend del storage, Google Cloud Storage, un directorio local o la memoria
+    set_storage_backend(create_storage_backend(app.config["ALMACEN_BACKEND"], app.config["ALMACEN_DIRECTORIO"]))
+
+    # Cache en disco de los archivos del storage, en App Engine el directorio /tmp ocupa la memoria de la instancia
+    app.disk_cache = None
+    if app.config["CACHE_DISCO_DIRECTORIO"] != "":
+        app.disk_cache = DiskCache(app.config["CACHE_DISCO_DIRECTORIO"], app.config["CACHE_DISCO_MEGABYTES"] * 1024 * 1024)
+
     # Registrar blueprints
     app.register_blueprint(autoridades)
     app.register_blueprint(bitacoras)
@@ -79,6 +92,14 @@ def create_app():
     return app
 
 
+def get_or_create_app():
+    """Entregar la app de este proceso, se crea la primera vez que se pide"""
+    global _app  # pylint: disable=global-statement
+    if _app is None:
+        _app = create_app()
+    return _app
+
+
 def extensions(app):
     """Inicializar extensiones"""
     csrf.init_app(app)
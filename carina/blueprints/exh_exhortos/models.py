@@ -2,10 +2,12 @@
 Exh Exhortos, modelos
 """
 
+import hashlib
+import json
 from datetime import datetime
 from typing import List, Optional
 
-from sqlalchemy import Enum, ForeignKey, String
+from sqlalchemy import Enum, ForeignKey, String, Text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.sql.functions import now
 
@@ -135,6 +137,20 @@ class ExhExhorto(database.Model, UniversalMixin):
     # Y se lleva un contador de intentos
     por_enviar_intentos: Mapped[int] = mapped_column(default=0)
 
+    # Si falla un intento, se programa el siguiente con espera exponencial, si es nulo se puede enviar ya
+    por_enviar_tiempo_siguiente: Mapped[Optional[datetime]]
+
+    # Tiempo en que el PJ exhortado aceptó el exhorto, si es nulo hay que enviarlo; luego se envían los archivos pendientes
+    por_enviar_tiempo_aceptado: Mapped[Optional[datetime]]
+
+    # Reserva del proceso que lo está enviando, para que otros procesos lo omitan hasta que la libere o venza
+    por_enviar_reservado_hasta: Mapped[Optional[datetime]]
+    por_enviar_reservado_por: Mapped[Optional[str]] = mapped_column(String(64))
+
+    # Payload JSON que se envía al PJ exhortado, se elabora al pasar a POR ENVIAR para que cada intento mande los mismos bytes
+    por_enviar_payload: Mapped[Optional[str]] = mapped_column(Text, deferred=True)
+    por_enviar_payload_hash: Mapped[Optional[str]] = mapped_column(String(64))
+
     # Acuse fecha hora local en el que el Poder Judicial exhortado marca que se recibió el Exhorto
     acuse_fecha_hora_recepcion: Mapped[Optional[datetime]]
 
@@ -159,6 +175,9 @@ class ExhExhorto(database.Model, UniversalMixin):
     # fue enviado correctamente al Poder Judicial exhortado o también una página que muestre el estatus del exhorto.
     acuse_url_info: Mapped[Optional[str]] = mapped_column(String(256))
 
+    # Tiempo de la última consulta al PJ exhortado, se consultan primero los que tienen más tiempo sin consultarse
+    consulta_tiempo_anterior: Mapped[Optional[datetime]]
+
     # Respuesta a un exhorto
     # Identificador propio del Poder Judicial exhortado con el que identifica la respuesta del exhorto. Este dato puede ser un número consecutivo (ej "1", "2", "3"...), un GUID/UUID o cualquíer otro valor con que se identifique la respuesta
     respuesta_respuesta_origen_id: Mapped[Optional[str]] = mapped_column(String(48))
@@ -169,6 +188,60 @@ class ExhExhorto(database.Model, UniversalMixin):
     # Fecha hora local en el que el Poder Judicial exhortante marca la Respuesta del Exhorto como recibida
     respuesta_fecha_hora_recepcion: Mapped[Optional[datetime]]
 
+    def elaborar_payload(self, municipio_destino) -> dict:
+        """Elaborar los datos del exhorto que se envían al PJ exhortado"""
+        partes = []
+        for exh_exhorto_parte in self.exh_exhortos_partes:
+            partes.append(
+                {
+                    "nombre": str(exh_exhorto_parte.nombre),
+                    "apellidoPaterno": str(exh_exhorto_parte.apellido_paterno),
+                    "apellidoMaterno": str(exh_exhorto_parte.apellido_materno),
+                    "genero": str(exh_exhorto_parte.genero),
+                    "esPersonaMoral": bool(exh_exhorto_parte.es_persona_moral),
+                    "tipoParte": int(exh_exhorto_parte.tipo_parte),
+                    "tipoParteNombre": str(exh_exhorto_parte.tipo_parte_nombre),
+                }
+            )
+        archivos = []
+        for exh_exhorto_archivo in self.exh_exhortos_archivos:
+            archivos.append(
+                {
+                    "nombreArchivo": str(exh_exhorto_archivo.nombre_archivo),
+                    "hashSha1": str(exh_exhorto_archivo.hash_sha1),
+                    "hashSha256": str(exh_exhorto_archivo.hash_sha256),
+                    "tipoDocumento": int(exh_exhorto_archivo.tipo_documento),
+                }
+            )
+        return {
+            "exhortoOrigenId": str(self.exhorto_origen_id),
+            "municipioDestinoId": int(municipio_destino.clave),
+            "materiaClave": str(self.materia_clave),
+            "estadoOrigenId": int(self.municipio_origen.estado.clave),
+            "municipioOrigenId": int(self.municipio_origen.clave),
+            "juzgadoOrigenId": str(self.juzgado_origen_id),
+            "juzgadoOrigenNombre": str(self.juzgado_origen_nombre),
+            "numeroExpedienteOrigen": str(self.numero_expediente_origen),
+            "numeroOficioOrigen": str(self.numero_oficio_origen),
+            "tipoJuicioAsuntoDelitos": str(self.tipo_juicio_asunto_delitos),
+            "juezExhortante": str(self.juez_exhortante),
+            "partes": partes,
+            "fojas": int(self.fojas),
+            "diasResponder": int(self.dias_responder),
+            "tipoDiligenciacionNombre": str(self.tipo_diligenciacion_nombre),
+            "fechaOrigen": self.fecha_origen.strftime("%Y-%m-%dT%H:%M:%S"),
+            "observaciones": str(self.observaciones),
+            "archivos": archivos,
+        }
+
+    def guardar_payload(self, municipio_destino) -> bool:
+        """Serializar el payload con su hash SHA-256 sin hacer commit, entrega verdadero si cambió"""
+        self.por_enviar_payload = json.dumps(self.elaborar_payload(municipio_destino), ensure_ascii=False)
+        payload_hash = hashlib.sha256(self.por_enviar_payload.encode("utf-8")).hexdigest()
+        cambio = payload_hash != self.por_enviar_payload_hash
+        self.por_enviar_payload_hash = payload_hash
+        return cambio
+
     def __repr__(self):
         """Representación"""
         return f"<ExhExhorto {self.id}>"
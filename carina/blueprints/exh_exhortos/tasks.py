@@ -3,13 +3,23 @@ Exh Exhortos, tareas en el fondo
 """
 
 import logging
+import os
+import random
+import socket
 import time
-from datetime import datetime, timedelta
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from itertools import repeat
+from typing import Optional
 
 import requests
+from redis.exceptions import RedisError
+from sqlalchemy import or_
+from sqlalchemy.orm import joinedload, selectinload, undefer
 
-from carina.app import create_app
-from carina.blueprints.estados.models import Estado
+from carina.app import get_or_create_app
 from carina.blueprints.exh_exhortos.models import ExhExhorto
 from carina.blueprints.exh_externos.models import ExhExterno
 from carina.blueprints.municipios.models import Municipio
@@ -17,12 +27,16 @@ from carina.extensions import database
 from lib.exceptions import (
     MyAnyError,
     MyBucketNotFoundError,
+    MyCircuitOpenError,
+    MyDownloadError,
     MyEmptyError,
     MyFileNotFoundError,
     MyNotExistsError,
     MyNotValidParamError,
 )
-from lib.google_cloud_storage import get_blob_name_from_url, get_file_from_gcs
+from lib.google_cloud_storage import get_blob_name_from_url, open_file_from_gcs
+from lib.interop import get_interop_client
+from lib.stage_timer import StageTimer, TimedReader
 from lib.tasks import set_task_error, set_task_progress
 
 bitacora = logging.getLogger(__name__)
@@ -32,28 +46,215 @@ empunadura = logging.FileHandler("logs/exh_exhortos.log")
 empunadura.setFormatter(formato)
 bitacora.addHandler(empunadura)
 
-app = create_app()
+app = get_or_create_app()
 app.app_context().push()
 database.app = app
 
 CANTIDAD_MAXIMA_INTENTOS = 3
-SEGUNDOS_ESPERA_ENTRE_INTENTOS = 60  # 1 minuto
-TIMEOUT = 30  # 30 segundos
+SEGUNDOS_ESPERA_ENTRE_INTENTOS = 60  # 1 minuto, se duplica en cada intento
+SEGUNDOS_ESPERA_MAXIMA = 3600  # 1 hora
+HILOS_MAXIMOS = 8  # Cantidad máxima de hilos al enviar en paralelo
+HILOS_POR_EXTERNO = 1  # Cantidad máxima de hilos que envian al mismo tiempo a un mismo externo
+SEGUNDOS_RESERVA = 3600  # 1 hora, más que el tiempo máximo de una tarea en el fondo, luego otro proceso puede tomarlo
+CANTIDAD_MAXIMA_CONSULTAR = 500  # Exhortos por cada ejecución de consultar, primero los consultados hace más tiempo
+
+# Columnas del exhorto que se actualizan al consultarlo y las llaves que las pueden traer en data
+CAMPOS_CONSULTA = {
+    "acuse_fecha_hora_recepcion": ("fechaHoraRecepcion",),
+    "acuse_municipio_area_recibe_id": ("municipioTurnadoId", "municipioAreaRecibeId"),
+    "acuse_area_recibe_id": ("areaTurnadoId", "areaRecibeId"),
+    "acuse_area_recibe_nombre": ("areaTurnadoNombre", "areaRecibeNombre"),
+    "acuse_url_info": ("urlInfo",),
+}
+
+# Si es falso, los intentos fallidos no programan la tarea que reintentará, para medir el envío sin dejar trabajos en la cola
+_reintentos = {"programar": True}
+
+
+def consultar_exhorto(exh_exhorto: ExhExhorto, exh_externo: ExhExterno, tiempo_actual: datetime) -> tuple[bool, str]:
+    """Consultar un exhorto al PJ externo y guardar solo los datos que cambiaron, entrega si hubo cambios y el mensaje"""
+
+    # Consultar el exhorto por su folio de seguimiento
+    url = f"{exh_externo.endpoint_consultar_exhorto.rstrip('/')}/{exh_exhorto.folio_seguimiento}"
+    mensaje_advertencia = ""
+    try:
+        response = get_interop_client(exh_externo).get(url, kind="endpoint_consultar_exhorto")
+        response.raise_for_status()
+        respuesta = response.json()
+    except MyCircuitOpenError:
+        mensaje_advertencia = f"El circuito de {exh_externo.clave} está abierto"
+    except requests.exceptions.ConnectionError:
+        mensaje_advertencia = "No hubo respuesta del servidor al consultar el exhorto"
+    except requests.exceptions.HTTPError as error:
+        mensaje_advertencia = f"Status Code {str(error)} al consultar el exhorto"
+    except ValueError:
+        # Antes que RequestException porque requests.exceptions.JSONDecodeError hereda de ambas
+        mensaje_advertencia = "La respuesta no es JSON al consultar el exhorto"
+    except requests.exceptions.RequestException:
+        mensaje_advertencia = "Falla desconocida al consultar el exhorto"
+
+    # Validar que la respuesta tenga success y data
+    if mensaje_advertencia == "":
+        if "success" not in respuesta or bool(respuesta["success"]) is False:
+            mensaje_advertencia = "La consulta del exhorto no fue exitosa"
+        elif "data" not in respuesta or not isinstance(respuesta["data"], dict):
+            mensaje_advertencia = "La respuesta no tiene 'data' al consultar el exhorto"
+
+    # Registrar el tiempo de la consulta, aunque haya fallado, para que la siguiente ejecución empiece por otros
+    exh_exhorto.consulta_tiempo_anterior = tiempo_actual
+
+    # Si NO se consultó con éxito, guardar solo el tiempo de la consulta
+    if mensaje_advertencia != "":
+        exh_exhorto.save()
+        return False, f"{exh_exhorto.folio_seguimiento}: {mensaje_advertencia}"
+
+    # Tomar los datos que vienen en la respuesta, las llaves opcionales que no vengan se omiten
+    data = respuesta["data"]
+    datos = {}
+    for columna, llaves in CAMPOS_CONSULTA.items():
+        for llave in llaves:
+            if llave in data and data[llave] is not None:
+                datos[columna] = data[llave]
+                break
+    if "acuse_fecha_hora_recepcion" in datos:
+        datos["acuse_fecha_hora_recepcion"] = convertir_fecha_hora(str(datos["acuse_fecha_hora_recepcion"]))
+    if "acuse_municipio_area_recibe_id" in datos:
+        try:
+            datos["acuse_municipio_area_recibe_id"] = int(datos["acuse_municipio_area_recibe_id"])
+        except ValueError:
+            datos["acuse_municipio_area_recibe_id"] = None
+    for columna in ("acuse_area_recibe_id", "acuse_area_recibe_nombre", "acuse_url_info"):
+        if columna in datos:
+            datos[columna] = str(datos[columna])
+
+    # Cambiar solo los datos que son diferentes
+    cambios = []
+    for columna, valor in datos.items():
+        if valor is not None and getattr(exh_exhorto, columna) != valor:
+            setattr(exh_exhorto, columna, valor)
+            cambios.append(columna)
+    exh_exhorto.save()
+
+    # Entregar si hubo cambios y el mensaje
+    if len(cambios) > 0:
+        return True, f"{exh_exhorto.folio_seguimiento}: Se actualizó {', '.join(cambios)}"
+    return False, f"{exh_exhorto.folio_seguimiento}: Sin cambios"
+
+
+def consultar_carril(exh_exhortos_ids: list[int], tiempo_actual: datetime) -> tuple[int, int, list[str]]:
+    """Consultar en un hilo, uno tras otro, los exhortos de un carril"""
+
+    # Inicializar los contadores y el listado de mensajes
+    consultados_contador = 0
+    cambiados_contador = 0
+    mensajes = []
+
+    # Cada hilo usa su propio contexto y por lo tanto su propia sesión de la base de datos
+    with app.app_context():
+        exh_exhortos = ExhExhorto.query.filter(ExhExhorto.id.in_(exh_exhortos_ids)).order_by(ExhExhorto.id).all()
+        municipios, exh_externos = cargar_destinos(exh_exhortos)
+        for exh_exhorto in exh_exhortos:
+            exh_externo, _, mensaje_advertencia = consultar_destino(exh_exhorto, municipios, exh_externos, para_consultar=True)
+            if mensaje_advertencia != "":
+                mensajes.append(mensaje_advertencia)
+                bitacora.warning(mensaje_advertencia)
+                continue  # Pasar al siguiente exhorto
+            try:
+                cambiado, mensaje = consultar_exhorto(exh_exhorto, exh_externo, tiempo_actual)
+            except Exception as error:
+                database.session.rollback()
+                mensaje_error = f"Falla inesperada al consultar el exhorto {exh_exhorto.folio_seguimiento}: {str(error)}"
+                mensajes.append(mensaje_error)
+                bitacora.error(mensaje_error)
+                continue  # Pasar al siguiente exhorto
+            mensajes.append(mensaje)
+            bitacora.info(mensaje)
+            consultados_contador += 1
+            if cambiado:
+                cambiados_contador += 1
 
+    # Entregar los contadores y los mensajes
+    return consultados_contador, cambiados_contador, mensajes
 
-def consultar(exh_exhorto_id: int) -> tuple[str, str, str]:
-    """Consultar exhortos"""
+
+def consultar(folio_seguimiento: str = "") -> tuple[str, str, str]:
+    """Consultar un exhorto o los exhortos con estado RECIBIDO CON EXITO, en hilos agrupados por PJ externo"""
     bitacora.info("Inicia consultar")
 
-    # Elaborar mensaje_termino
-    mensaje_termino = "Termina consultar"
-    bitacora.info(mensaje_termino)
+    # Si no se proporciona el folio_seguimiento
+    if folio_seguimiento == "":
+        # Consultar los exhortos RECIBIDO CON EXITO, primero los que no se han consultado o hace más tiempo
+        exh_exhortos = (
+            ExhExhorto.query.filter_by(estado="RECIBIDO CON EXITO")
+            .filter_by(estatus="A")
+            .filter(ExhExhorto.folio_seguimiento.isnot(None))
+            .order_by(ExhExhorto.consulta_tiempo_anterior.asc().nulls_first(), ExhExhorto.id)
+            .limit(CANTIDAD_MAXIMA_CONSULTAR)
+            .all()
+        )
+    else:
+        # Consultar el exhorto con folio_seguimiento
+        exh_exhorto = ExhExhorto.query.filter_by(folio_seguimiento=folio_seguimiento).filter_by(estatus="A").first()
+        if exh_exhorto is None:
+            mensaje_advertencia = f"No existe el exhorto con folio de seguimiento {folio_seguimiento}"
+            bitacora.warning(mensaje_advertencia)
+            raise MyNotExistsError(mensaje_advertencia)
+        exh_exhortos = [exh_exhorto]
+
+    # Validar que haya exhortos por consultar
+    if len(exh_exhortos) == 0:
+        mensaje_advertencia = "AVISO: No hay exhortos por consultar"
+        bitacora.warning(mensaje_advertencia)
+        raise MyEmptyError(mensaje_advertencia)
+
+    # Inicializar listado de mensajes de termino
+    mensajes_termino = []
+
+    # Agrupar por externo, omitiendo los que no tienen endpoint para consultar
+    municipios, exh_externos = cargar_destinos(exh_exhortos)
+    consultas_por_externo = {}
+    for exh_exhorto in exh_exhortos:
+        exh_externo, _, mensaje_advertencia = consultar_destino(exh_exhorto, municipios, exh_externos, para_consultar=True)
+        if mensaje_advertencia != "":
+            mensajes_termino.append(mensaje_advertencia)
+            bitacora.warning(mensaje_advertencia)
+            continue  # Pasar al siguiente exhorto
+        consultas_por_externo.setdefault(exh_externo.id, []).append(exh_exhorto.id)
+
+    # Repartir en carriles de HILOS_POR_EXTERNO para cada externo
+    carriles = []
+    for consultas_externo in consultas_por_externo.values():
+        for numero in range(HILOS_POR_EXTERNO):
+            carril = consultas_externo[numero::HILOS_POR_EXTERNO]
+            if len(carril) > 0:
+                carriles.append(carril)
+
+    # Consultar en paralelo
+    consultados_contador = 0
+    cambiados_contador = 0
+    if len(carriles) > 0:
+        bitacora.info(
+            "Consultando %s exhortos a %s externos en %s carriles...",
+            len(exh_exhortos),
+            len(consultas_por_externo),
+            len(carriles),
+        )
+        with ThreadPoolExecutor(max_workers=min(HILOS_MAXIMOS, len(carriles))) as ejecutor:
+            for consultados, cambiados, mensajes in ejecutor.map(consultar_carril, carriles, repeat(datetime.now())):
+                consultados_contador += consultados
+                cambiados_contador += cambiados
+                mensajes_termino.extend(mensajes)
+
+    # Elaborar mensaje final
+    mensaje_final = f"Termina consultar con {consultados_contador} exhortos consultados y {cambiados_contador} con cambios."
+    mensajes_termino.append(mensaje_final)
+    bitacora.info(mensaje_final)
 
     # Entregar mensaje_termino, nombre_archivo y url_publica
-    return mensaje_termino, "", ""
+    return "\n".join(mensajes_termino), "", ""
 
 
-def lanzar_consultar(exh_exhorto_id):
+def lanzar_consultar(folio_seguimiento: str = ""):
     """Lanzar tarea en el fondo para consultar exhortos"""
 
     # Iniciar la tarea en el fondo
@@ -61,7 +262,7 @@ def lanzar_consultar(exh_exhorto_id):
 
     # Ejecutar
     try:
-        mensaje_termino, nombre_archivo, url_publica = consultar(exh_exhorto_id)
+        mensaje_termino, nombre_archivo, url_publica = consultar(folio_seguimiento)
     except MyAnyError as error:
         mensaje_error = str(error)
         set_task_error(mensaje_error)
@@ -74,172 +275,306 @@ def lanzar_consultar(exh_exhorto_id):
     return mensaje_termino
 
 
-def enviar(exhorto_origen_id: str = "") -> tuple[str, str, str]:
-    """Enviar exhortos"""
-    bitacora.info("Inicia enviar")
+@contextmanager
+def sin_expirar_al_confirmar():
+    """Que los objetos cargados no se vuelvan a consultar después de cada commit, al salir se restaura la sesión"""
+    sesion = database.session()
+    expire_on_commit = sesion.expire_on_commit
+    sesion.expire_on_commit = False
+    try:
+        yield sesion
+    finally:
+        sesion.expire_on_commit = expire_on_commit
 
-    # Inicializar el listado de exhortos a enviar
-    exh_exhortos = []
 
-    # Si no se proporciona el exhorto_origen_id
-    if exhorto_origen_id == "":
-        # Consultar todos los exhortos con estado POR ENVIAR
-        exh_exhortos = ExhExhorto.query.filter_by(estado="POR ENVIAR").filter_by(estatus="A").all()
-    else:
-        # Consultar el exhorto con exhorto_origen_id
-        exh_exhorto = ExhExhorto.query.filter_by(exhorto_origen_id=exhorto_origen_id).filter_by(estatus="A").first()
-        if exh_exhorto is None:
-            mensaje_advertencia = f"No existe el exhorto con ID {exhorto_origen_id}"
-            bitacora.warning(mensaje_advertencia)
-            raise MyNotExistsError(mensaje_advertencia)
-        if exh_exhorto.estado != "POR ENVIAR":
-            mensaje_advertencia = f"El exhorto con ID {exhorto_origen_id} no está en estado POR ENVIAR"
-            bitacora.warning(mensaje_advertencia)
-            raise MyNotExistsError(mensaje_advertencia)
-        exh_exhortos.append(exh_exhorto)
+def cargar_por_enviar(consulta) -> list[ExhExhorto]:
+    """Cargar los exhortos de la consulta con su payload y sus archivos en una cantidad constante de consultas"""
 
-    # Validar que haya exhortos POR ENVIAR
-    if len(exh_exhortos) == 0:
-        mensaje_advertencia = "AVISO: No hay exhortos por enviar"
-        bitacora.warning(mensaje_advertencia)
-        raise MyEmptyError(mensaje_advertencia)
+    # Consultar los exhortos y cargar sus hijos con una consulta por cada relación
+    return (
+        consulta.options(
+            undefer(ExhExhorto.por_enviar_payload),
+            selectinload(ExhExhorto.exh_exhortos_archivos),
+        )
+        .order_by(ExhExhorto.id)
+        .all()
+    )
 
-    # Obtener el tiempo actual
+
+def reservar_por_enviar(consulta) -> tuple[str, list[int]]:
+    """Reservar los exhortos de la consulta que no estén reservados por otro proceso, entrega el reservador y los IDs"""
+
+    # Identificar a este proceso
+    reservador = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    # Omitir los exhortos con una reserva vigente
     tiempo_actual = datetime.now()
+    consulta = consulta.filter(
+        or_(
+            ExhExhorto.por_enviar_reservado_hasta.is_(None),
+            ExhExhorto.por_enviar_reservado_hasta < tiempo_actual,
+        )
+    )
+
+    # Bloquear los renglones, saltando los que otro proceso tenga bloqueados en este momento
+    exh_exhortos_ids = [
+        renglon.id
+        for renglon in consulta.with_entities(ExhExhorto.id)
+        .order_by(ExhExhorto.id)
+        .with_for_update(skip_locked=True, of=ExhExhorto)
+        .all()
+    ]
+
+    # Guardar la reserva y confirmar, lo que libera los bloqueos; la reserva protege a los exhortos desde aquí
+    if len(exh_exhortos_ids) > 0:
+        ExhExhorto.query.filter(ExhExhorto.id.in_(exh_exhortos_ids)).update(
+            {
+                ExhExhorto.por_enviar_reservado_hasta: tiempo_actual + timedelta(seconds=SEGUNDOS_RESERVA),
+                ExhExhorto.por_enviar_reservado_por: reservador,
+            },
+            synchronize_session=False,
+        )
+    database.session.commit()
+
+    # Entregar el reservador y los IDs
+    return reservador, exh_exhortos_ids
+
+
+def liberar_reserva(reservador: str, exh_exhortos_ids: list[int]):
+    """Liberar las reservas de este proceso para que otros puedan tomar los exhortos que siguen POR ENVIAR"""
+    if len(exh_exhortos_ids) == 0:
+        return
+    database.session.rollback()
+    ExhExhorto.query.filter(ExhExhorto.id.in_(exh_exhortos_ids)).filter_by(por_enviar_reservado_por=reservador).update(
+        {
+            ExhExhorto.por_enviar_reservado_hasta: None,
+            ExhExhorto.por_enviar_reservado_por: None,
+        },
+        synchronize_session=False,
+    )
+    database.session.commit()
+
+
+def liberar_exhorto(reservador: str, exh_exhorto: ExhExhorto):
+    """Liberar la reserva de un exhorto en cuanto se termina con él, sin descartar los demás exhortos cargados"""
+    ExhExhorto.query.filter_by(id=exh_exhorto.id).filter_by(por_enviar_reservado_por=reservador).update(
+        {
+            ExhExhorto.por_enviar_reservado_hasta: None,
+            ExhExhorto.por_enviar_reservado_por: None,
+        },
+        synchronize_session=False,
+    )
+    database.session.commit()
+
+
+def cargar_destinos(exh_exhortos: list[ExhExhorto]) -> tuple[dict[int, Municipio], dict[int, ExhExterno]]:
+    """Cargar los municipios de destino y los externos de los exhortos, entrega diccionarios por ID de municipio y de estado
+    Basta con que los exhortos tengan municipio_destino_id, como los renglones de una consulta de columnas"""
+
+    # Consultar los municipios de destino con sus estados
+    municipios_ids = {exh_exhorto.municipio_destino_id for exh_exhorto in exh_exhortos}
+    municipios = {}
+    if len(municipios_ids) > 0:
+        consulta = Municipio.query.options(joinedload(Municipio.estado)).filter(Municipio.id.in_(municipios_ids))
+        municipios = {municipio.id: municipio for municipio in consulta.all()}
+
+    # Consultar los externos de los estados de destino, tomar el primero porque solo debe haber uno por estado
+    estados_ids = {municipio.estado_id for municipio in municipios.values()}
+    exh_externos = {}
+    if len(estados_ids) > 0:
+        consulta = ExhExterno.query.filter(ExhExterno.estado_id.in_(estados_ids)).order_by(ExhExterno.id)
+        for exh_externo in consulta.all():
+            exh_externos.setdefault(exh_externo.estado_id, exh_externo)
+
+    # Entregar los diccionarios
+    return municipios, exh_externos
+
+
+def consultar_destino(
+    exh_exhorto: ExhExhorto,
+    municipios: dict[int, Municipio],
+    exh_externos: dict[int, ExhExterno],
+    para_consultar: bool = False,
+) -> tuple[Optional[ExhExterno], Optional[Municipio], str]:
+    """Tomar el externo y el municipio de destino de un exhorto, si falta algo entrega un mensaje de advertencia"""
+
+    # Tomar el Estado de destino a partir del ID del Municipio en municipio_destino_id
+    municipio_destino = municipios.get(exh_exhorto.municipio_destino_id)
+    if municipio_destino is None:
+        return None, None, f"No existe el municipio con ID {exh_exhorto.municipio_destino_id}"
+    estado = municipio_destino.estado
+    if estado is None:
+        return None, None, f"No existe el estado con ID {municipio_destino.estado_id}"
+
+    # Tomar el ExhExterno del Estado
+    exh_externo = exh_externos.get(estado.id)
+    if exh_externo is None:
+        return None, None, f"No hay datos en exh_externos del estado {estado.nombre}"
+
+    # Si exh_externo no tiene API-key
+    if exh_externo.api_key is None or exh_externo.api_key == "":
+        return None, None, f"No tiene API-key en exh_externos el estado {estado.nombre}"
+
+    # Si es para consultar, solo se necesita el endpoint para consultar exhortos
+    if para_consultar:
+        if exh_externo.endpoint_consultar_exhorto is None or exh_externo.endpoint_consultar_exhorto == "":
+            return None, None, f"No tiene endpoint para consultar exhortos el estado {estado.nombre}"
+        return exh_externo, municipio_destino, ""
+
+    # Si exh_externo no tiene endpoint para enviar exhortos
+    if exh_externo.endpoint_recibir_exhorto is None or exh_externo.endpoint_recibir_exhorto == "":
+        return None, None, f"No tiene endpoint para enviar exhortos el estado {estado.nombre}"
+
+    # Si exh_externo no tiene endpoint para enviar archivos
+    if exh_externo.endpoint_recibir_exhorto_archivo is None or exh_externo.endpoint_recibir_exhorto_archivo == "":
+        return None, None, f"No tiene endpoint para enviar archivos el estado {estado.nombre}"
+
+    # Entregar el externo y el municipio de destino
+    return exh_externo, municipio_destino, ""
+
+
+def convertir_fecha_hora(texto: str) -> Optional[datetime]:
+    """Convertir la fecha hora que entrega un PJ externo, con o sin T y con o sin microsegundos, si no se puede entrega None"""
+    for formato_fecha_hora in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.strptime(texto, formato_fecha_hora)
+        except ValueError:
+            continue
+    return None
 
-    # Inicializar listado de mensajes de termino
-    mensajes_termino = []
 
-    # Bucle de exhortos POR ENVIAR
-    exhortos_omitidos_contador = 0
-    exhortos_procesados_contador = 0
-    for exh_exhorto in exh_exhortos:
-        # Si por_enviar_tiempo_anterior mas SEGUNDOS_ESPERA_ENTRE_INTENTOS es mayor al tiempo actual, entonces se omite
-        if (
-            exh_exhorto.por_enviar_tiempo_anterior is not None
-            and tiempo_actual < exh_exhorto.por_enviar_tiempo_anterior + timedelta(seconds=SEGUNDOS_ESPERA_ENTRE_INTENTOS)
-        ):
-            mensaje_advertencia = f"Se omite el exhorto {exh_exhorto.exhorto_origen_id} por tiempo de espera"
-            mensajes_termino.append(mensaje_advertencia)
-            bitacora.warning(mensaje_advertencia)
-            exhortos_omitidos_contador += 1
-            continue  # Pasar al siguiente exhorto
+def registrar_intento_fallido(exh_exhorto: ExhExhorto, tiempo_actual: datetime, mensaje_advertencia: str) -> str:
+    """Incrementar los intentos y programar el siguiente con espera exponencial, entrega el mensaje de advertencia"""
 
-        # Informar al loggin que se va a enviar el exhorto
-        mensaje = f"Enviando el exhorto {exh_exhorto.exhorto_origen_id}..."
-        mensajes_termino.append(mensaje)
-        bitacora.info(mensaje)
+    # Actualizar por_enviar_tiempo_anterior
+    exh_exhorto.por_enviar_tiempo_anterior = tiempo_actual
 
-        # Consultar el Estado de destino a partir del ID del Municipio en municipio_destino_id
-        municipio = Municipio.query.get(exh_exhorto.municipio_destino_id)
-        if municipio is None:
-            mensaje_advertencia = f"No existe el municipio con ID {exh_exhorto.municipio_destino_id}"
-            mensajes_termino.append(mensaje_advertencia)
-            bitacora.warning(mensaje_advertencia)
-            continue  # Pasar al siguiente exhorto
-        estado = Estado.query.get(municipio.estado_id)
-        if estado is None:
-            mensaje_advertencia = f"No existe el estado con ID {municipio.estado_id}"
-            mensajes_termino.append(mensaje_advertencia)
-            bitacora.warning(mensaje_advertencia)
-            continue  # Pasar al siguiente exhorto
+    # Incrementar por_enviar_intentos
+    exh_exhorto.por_enviar_intentos += 1
 
-        # Consultar el ExhExterno con el ID del Estado, tomar el primero porque solo debe haber uno
-        exh_externo = ExhExterno.query.filter_by(estado_id=estado.id).first()
-        if exh_externo is None:
-            mensaje_advertencia = f"No hay datos en exh_externos del estado {estado.nombre}"
-            mensajes_termino.append(mensaje_advertencia)
-            bitacora.warning(mensaje_advertencia)
-            continue  # Pasar al siguiente exhorto
+    # Si el exhorto excede CANTIDAD_MAXIMA_INTENTOS, entonces cambiar el estado a INTENTOS AGOTADOS
+    if exh_exhorto.por_enviar_intentos > CANTIDAD_MAXIMA_INTENTOS:
+        exh_exhorto.estado = "INTENTOS AGOTADOS"
+        exh_exhorto.por_enviar_tiempo_siguiente = None
+        exh_exhorto.save()
+        return mensaje_advertencia + ". Cambio el estado a INTENTOS AGOTADOS"
 
-        # Si exh_externo no tiene API-key
-        if exh_externo.api_key is None or exh_externo.api_key == "":
-            mensaje_advertencia = f"No tiene API-key en exh_externos el estado {estado.nombre}"
-            mensajes_termino.append(mensaje_advertencia)
-            bitacora.warning(mensaje_advertencia)
-            continue  # Pasar al siguiente exhorto
+    # Calcular la espera exponencial con la mitad de variación aleatoria para no reintentar todos al mismo tiempo
+    segundos = min(SEGUNDOS_ESPERA_MAXIMA, SEGUNDOS_ESPERA_ENTRE_INTENTOS * 2 ** (exh_exhorto.por_enviar_intentos - 1))
+    segundos = segundos / 2 + random.uniform(0, segundos / 2)
 
-        # Si exh_externo no tiene endpoint para enviar exhortos
-        if exh_externo.endpoint_recibir_exhorto is None or exh_externo.endpoint_recibir_exhorto == "":
-            mensaje_advertencia = f"No tiene endpoint para enviar exhortos el estado {estado.nombre}"
-            mensajes_termino.append(mensaje_advertencia)
-            bitacora.warning(mensaje_advertencia)
-            continue  # Pasar al siguiente exhorto
+    # Programar el siguiente intento
+    programar_reintento(exh_exhorto, segundos)
 
-        # Si exh_externo no tiene endpoint para enviar archivos
-        if exh_externo.endpoint_recibir_exhorto_archivo is None or exh_externo.endpoint_recibir_exhorto_archivo == "":
-            mensaje_advertencia = f"No tiene endpoint para enviar archivos el estado {estado.nombre}"
-            mensajes_termino.append(mensaje_advertencia)
-            bitacora.warning(mensaje_advertencia)
-            continue  # Pasar al siguiente exhorto
+    # Entregar el mensaje de advertencia
+    tiempo_siguiente_str = exh_exhorto.por_enviar_tiempo_siguiente.strftime("%Y-%m-%d %H:%M:%S")
+    return mensaje_advertencia + f". Van {exh_exhorto.por_enviar_intentos} intentos, el siguiente será {tiempo_siguiente_str}"
 
-        # Consultar el municipio de municipio_destino_id para enviar su clave INEGI
-        municipio_destino = Municipio.query.get(exh_exhorto.municipio_destino_id)
-        if municipio_destino is None:
-            mensaje_advertencia = f"No existe municipio_destino_id {exh_exhorto.municipio_destino_id}"
-            mensajes_termino.append(mensaje_advertencia)
-            bitacora.warning(mensaje_advertencia)
-            continue  # Pasar al siguiente exhorto
 
-        # Bucle para juntar los datos de las partes
-        partes = []
-        for exh_exhorto_parte in exh_exhorto.exh_exhortos_partes:
-            partes.append(
-                {
-                    "nombre": str(exh_exhorto_parte.nombre),
-                    "apellidoPaterno": str(exh_exhorto_parte.apellido_paterno),
-                    "apellidoMaterno": str(exh_exhorto_parte.apellido_materno),
-                    "genero": str(exh_exhorto_parte.genero),
-                    "esPersonaMoral": bool(exh_exhorto_parte.es_persona_moral),
-                    "tipoParte": int(exh_exhorto_parte.tipo_parte),
-                    "tipoParteNombre": str(exh_exhorto_parte.tipo_parte_nombre),
-                }
-            )
+def posponer_envio(exh_exhorto: ExhExhorto, mensaje_advertencia: str) -> str:
+    """Posponer el envío porque el circuito del externo está abierto, sin gastar un intento, entrega el mensaje de advertencia"""
 
-        # Bucle para juntar los datos de los archivos exh_exhortos_archivos
-        archivos = []
-        for exh_exhorto_archivo in exh_exhorto.exh_exhortos_archivos:
-            archivos.append(
-                {
-                    "nombreArchivo": str(exh_exhorto_archivo.nombre_archivo),
-                    "hashSha1": str(exh_exhorto_archivo.hash_sha1),
-                    "hashSha256": str(exh_exhorto_archivo.hash_sha256),
-                    "tipoDocumento": int(exh_exhorto_archivo.tipo_documento),
-                }
-            )
+    # Esperar a que el circuito pueda volver a probarse, con variación aleatoria para no reintentar todos al mismo tiempo
+    segundos = app.config["INTEROP_CIRCUITO_SEGUNDOS"]
+    segundos = segundos + random.uniform(0, segundos / 2)
+
+    # Programar el siguiente intento
+    programar_reintento(exh_exhorto, segundos)
+
+    # Entregar el mensaje de advertencia
+    tiempo_siguiente_str = exh_exhorto.por_enviar_tiempo_siguiente.strftime("%Y-%m-%d %H:%M:%S")
+    return mensaje_advertencia + f". Se pospone sin contar el intento, el siguiente será {tiempo_siguiente_str}"
+
+
+def programar_reintento(exh_exhorto: ExhExhorto, segundos: float):
+    """Guardar por_enviar_tiempo_siguiente y programar la tarea en el fondo que reintentará"""
 
-        # Definir los datos del exhorto
-        datos_exhorto = {
-            "exhortoOrigenId": str(exh_exhorto.exhorto_origen_id),
-            "municipioDestinoId": int(municipio_destino.clave),
-            "materiaClave": str(exh_exhorto.materia_clave),
-            "estadoOrigenId": int(exh_exhorto.municipio_origen.estado.clave),
-            "municipioOrigenId": int(exh_exhorto.municipio_origen.clave),
-            "juzgadoOrigenId": str(exh_exhorto.juzgado_origen_id),
-            "juzgadoOrigenNombre": str(exh_exhorto.juzgado_origen_nombre),
-            "numeroExpedienteOrigen": str(exh_exhorto.numero_expediente_origen),
-            "numeroOficioOrigen": str(exh_exhorto.numero_oficio_origen),
-            "tipoJuicioAsuntoDelitos": str(exh_exhorto.tipo_juicio_asunto_delitos),
-            "juezExhortante": str(exh_exhorto.juez_exhortante),
-            "partes": partes,
-            "fojas": int(exh_exhorto.fojas),
-            "diasResponder": int(exh_exhorto.dias_responder),
-            "tipoDiligenciacionNombre": str(exh_exhorto.tipo_diligenciacion_nombre),
-            "fechaOrigen": exh_exhorto.fecha_origen.strftime("%Y-%m-%dT%H:%M:%S"),
-            "observaciones": str(exh_exhorto.observaciones),
-            "archivos": archivos,
-        }
+    # Guardar por_enviar_tiempo_siguiente junto con los demás cambios pendientes del exhorto
+    exh_exhorto.por_enviar_tiempo_siguiente = datetime.now() + timedelta(seconds=segundos)
+    exh_exhorto.save()
 
+    # Programar la tarea en el fondo que reintentará cuando se cumpla el tiempo
+    if not _reintentos["programar"]:
+        return
+    try:
+        app.task_queue.enqueue_at(
+            exh_exhorto.por_enviar_tiempo_siguiente.astimezone(timezone.utc),
+            "carina.blueprints.exh_exhortos.tasks.reintentar_enviar",
+            exhorto_origen_id=exh_exhorto.exhorto_origen_id,
+            programado=exh_exhorto.por_enviar_tiempo_siguiente.isoformat(),
+        )
+    except RedisError as error:
+        bitacora.error("No se pudo programar el reintento de %s: %s", exh_exhorto.exhorto_origen_id, str(error))
+
+
+@contextmanager
+def sin_programar_reintentos():
+    """Que los intentos fallidos no programen tareas en la cola, al salir se vuelven a programar"""
+    _reintentos["programar"] = False
+    try:
+        yield
+    finally:
+        _reintentos["programar"] = True
+
+
+def enviar_exhorto(
+    exh_exhorto: ExhExhorto,
+    exh_externo: ExhExterno,
+    municipio_destino: Municipio,
+    tiempo_actual: datetime,
+    cronometro: Optional[StageTimer] = None,
+) -> tuple[bool, list[str]]:
+    """Enviar un exhorto y sus archivos al PJ externo, entrega si fue recibido con éxito y los mensajes"""
+
+    # Inicializar listado de mensajes
+    mensajes = []
+
+    # Medir el tiempo de cada etapa etiquetado con el exhorto y el externo
+    if cronometro is None:
+        cronometro = StageTimer()
+    etiquetas = {"clave": exh_externo.clave, "exhorto_origen_id": exh_exhorto.exhorto_origen_id}
+
+    # Informar al loggin que se va a enviar el exhorto
+    mensaje = f"Enviando el exhorto {exh_exhorto.exhorto_origen_id}..."
+    mensajes.append(mensaje)
+    bitacora.info(mensaje)
+
+    # El payload se elaboró al pasar a POR ENVIAR, cada intento manda los mismos bytes
+    # Si no lo tiene, como los exhortos que ya estaban en POR ENVIAR, se elabora y se guarda una sola vez
+    if exh_exhorto.por_enviar_payload is None:
+        with cronometro.span("armar_payload", **etiquetas):
+            exh_exhorto.guardar_payload(municipio_destino)
+            exh_exhorto.save()
+    payload = exh_exhorto.por_enviar_payload.encode("utf-8")
+
+    # Tomar el cliente HTTP con conexiones persistentes del externo
+    cliente = get_interop_client(exh_externo)
+
+    # Si el exhorto ya fue aceptado en un intento anterior, se continúa con los archivos pendientes
+    if exh_exhorto.por_enviar_tiempo_aceptado is not None:
+        mensaje = "El exhorto ya había sido aceptado, se continúa con los archivos pendientes"
+        mensajes.append(mensaje)
+        bitacora.info(mensaje)
+    else:
         # Enviar el exhorto
         mensaje_advertencia = ""
         try:
-            response = requests.post(
-                exh_externo.endpoint_recibir_exhorto,
-                headers={"X-Api-Key": exh_externo.api_key},
-                timeout=TIMEOUT,
-                json=datos_exhorto,
-            )
+            with cronometro.span("limitador", **etiquetas):
+                cliente.acquire()
+            with cronometro.span("post_exhorto", **etiquetas):
+                response = cliente.post(
+                    exh_externo.endpoint_recibir_exhorto,
+                    kind="endpoint_recibir_exhorto",
+                    acquired=True,
+                    data=payload,
+                    headers={"Content-Type": "application/json"},
+                )
             response.raise_for_status()
+        except MyCircuitOpenError:
+            mensaje_advertencia = posponer_envio(exh_exhorto, f"El circuito de {exh_externo.clave} está abierto")
+            mensajes.append(mensaje_advertencia)
+            bitacora.warning(mensaje_advertencia)
+            return False, mensajes
         except requests.exceptions.ConnectionError:
             mensaje_advertencia = "No hubo respuesta del servidor al enviar el exhorto"
         except requests.exceptions.HTTPError as error:
@@ -249,21 +584,10 @@ def enviar(exhorto_origen_id: str = "") -> tuple[str, str, str]:
 
         # Si NO se comunicó con éxito...
         if mensaje_advertencia != "":
-            # Actualizar por_enviar_tiempo_anterior
-            exh_exhorto.por_enviar_tiempo_anterior = tiempo_actual
-            # Incrementar por_enviar_intentos
-            exh_exhorto.por_enviar_intentos += 1
-            # Si el exhorto excede CANTIDAD_MAXIMA_INTENTOS, entonces cambiar el estado a INTENTOS AGOTADOS
-            if exh_exhorto.por_enviar_intentos > CANTIDAD_MAXIMA_INTENTOS:
-                exh_exhorto.estado = "INTENTOS AGOTADOS"
-                mensaje_advertencia += ". Cambio el estado a INTENTOS AGOTADOS"
-            else:
-                mensaje_advertencia += f". Van {exh_exhorto.por_enviar_intentos} intentos"
-            mensajes_termino.append(mensaje_advertencia)
+            mensaje_advertencia = registrar_intento_fallido(exh_exhorto, tiempo_actual, mensaje_advertencia)
+            mensajes.append(mensaje_advertencia)
             bitacora.warning(mensaje_advertencia)
-            # Guardar los cambios en por_enviar_tiempo_anterior, por_enviar_intentos y estado
-            exh_exhorto.save()
-            continue  # Pasar al siguiente exhorto
+            return False, mensajes
 
         # Tomar success de la respuesta
         exhorto_enviado_con_exito = False
@@ -274,9 +598,9 @@ def enviar(exhorto_origen_id: str = "") -> tuple[str, str, str]:
             exh_exhorto.estado = "RECHAZADO"
             exh_exhorto.save()
             mensaje_advertencia = "La respuesta no tiene 'success' al enviar el exhorto. Cambio el estado a RECHAZADO"
-            mensajes_termino.append(mensaje_advertencia)
+            mensajes.append(mensaje_advertencia)
             bitacora.warning(mensaje_advertencia)
-            continue  # Pasar al siguiente exhorto
+            return False, mensajes
 
         # Si NO se envió con éxito...
         if exhorto_enviado_con_exito is False:
@@ -287,111 +611,144 @@ def enviar(exhorto_origen_id: str = "") -> tuple[str, str, str]:
                 mensaje_advertencia += f"MENSAJE: {str(respuesta['message'])}"
             if "errors" in respuesta:
                 mensaje_advertencia += f"ERRORES: {str(respuesta['errors'])}"
-            mensajes_termino.append(mensaje_advertencia)
+            mensajes.append(mensaje_advertencia)
             bitacora.warning(mensaje_advertencia)
-            continue  # Pasar al siguiente exhorto
+            return False, mensajes
 
-        # Mandar los archivos del exhorto con multipart/form-data
-        todos_los_archivos_enviados_con_exito = True
-        for exh_exhorto_archivo in exh_exhorto.exh_exhortos_archivos:
-            # Informar al loggin que se va a enviar el archivo
-            mensaje = f"Enviando archivo {exh_exhorto_archivo.nombre_archivo}..."
-            bitacora.info(mensaje)
+        # Guardar el tiempo en que fue aceptado para que un reintento no lo vuelva a enviar
+        exh_exhorto.por_enviar_tiempo_aceptado = datetime.now()
+        with cronometro.span("commit", **etiquetas):
+            exh_exhorto.save()
 
-            # Pausa de 2 segundos entre envios de archivos
-            time.sleep(2)
+    # Mandar los archivos del exhorto con multipart/form-data, omitiendo los que ya se enviaron en un intento anterior
+    exh_exhortos_archivos = sorted(exh_exhorto.exh_exhortos_archivos, key=lambda item: item.id)
+    todos_los_archivos_enviados_con_exito = True
+    for exh_exhorto_archivo in exh_exhortos_archivos:
+        # Si ya fue enviado, pasar al siguiente archivo
+        if exh_exhorto_archivo.envio_tiempo is not None:
+            continue
 
-            # Obtener el contenido del archivo desde Google Storage
-            try:
-                archivo_contenido = get_file_from_gcs(
+        # Informar al loggin que se va a enviar el archivo
+        mensaje = f"Enviando archivo {exh_exhorto_archivo.nombre_archivo}..."
+        bitacora.info(mensaje)
+
+        # Abrir el archivo en Google Storage para leerlo por pedazos, o del cache en disco si ya se bajó antes
+        try:
+            with cronometro.span("abrir_gcs", **etiquetas):
+                archivo_lector, archivo_tamano = open_file_from_gcs(
                     bucket_name=app.config["CLOUD_STORAGE_DEPOSITO"],
                     blob_name=get_blob_name_from_url(exh_exhorto_archivo.url),
+                    disk_cache=app.disk_cache,
+                    sha256=exh_exhorto_archivo.hash_sha256 or "",
                 )
-            except (MyBucketNotFoundError, MyFileNotFoundError, MyNotValidParamError) as error:
-                mensaje_error = f"Falla al tratar de bajar el archivo del storage {str(error)}"
-                mensajes_termino.append(mensaje_advertencia)
-                bitacora.error(mensaje_error)
-                todos_los_archivos_enviados_con_exito = False
-                break  # Salir del bucle de archivos
-
-            # Enviar el archivo
-            mensaje_advertencia = ""
-            try:
-                response = requests.post(
+        except (MyBucketNotFoundError, MyFileNotFoundError, MyNotValidParamError) as error:
+            mensaje_error = f"Falla al tratar de bajar el archivo del storage {str(error)}"
+            mensajes.append(mensaje_error)
+            bitacora.error(mensaje_error)
+            todos_los_archivos_enviados_con_exito = False
+            break  # Salir del bucle de archivos
+
+        # Enviar el archivo, se transmite por pedazos desde el storage sin tenerlo completo en memoria
+        # El tiempo de lectura del storage se separa del tiempo de la red midiendo las lecturas del lector
+        # y la espera del limitador de peticiones se mide aparte, antes de empezar a medir el envío
+        mensaje_advertencia = ""
+        archivo_lector = TimedReader(archivo_lector)
+        inicio = time.perf_counter()
+        try:
+            with archivo_lector:
+                with cronometro.span("limitador", **etiquetas):
+                    cliente.acquire()
+                inicio = time.perf_counter()
+                response = cliente.post_multipart(
                     url=exh_externo.endpoint_recibir_exhorto_archivo,
-                    headers={"X-Api-Key": exh_externo.api_key},
-                    timeout=TIMEOUT,
-                    data={"exhortoOrigenId": exh_exhorto.exhorto_origen_id},
-                    files={"archivo": (exh_exhorto_archivo.nombre_archivo, archivo_contenido, "application/pdf")},
+                    fields={"exhortoOrigenId": exh_exhorto.exhorto_origen_id},
+                    file_field="archivo",
+                    filename=exh_exhorto_archivo.nombre_archivo,
+                    fileobj=archivo_lector,
+                    size=archivo_tamano,
+                    content_type="application/pdf",
+                    kind="endpoint_recibir_exhorto_archivo",
+                    acquired=True,
                 )
-                response.raise_for_status()
-            except requests.exceptions.ConnectionError:
-                mensaje_advertencia = "No hubo respuesta del servidor al enviar el archivo"
-            except requests.exceptions.HTTPError as error:
-                mensaje_advertencia = f"Status Code {str(error)} al enviar el archivo"
-            except requests.exceptions.RequestException:
-                mensaje_advertencia = "Falla desconocida al enviar el archivo"
-
-            # Si NO se comunicó con éxito...
-            if mensaje_advertencia != "":
-                # Actualizar por_enviar_tiempo_anterior
-                exh_exhorto.por_enviar_tiempo_anterior = tiempo_actual
-                # Incrementar por_enviar_intentos
-                exh_exhorto.por_enviar_intentos += 1
-                # Si el exhorto excede CANTIDAD_MAXIMA_INTENTOS, entonces cambiar el estado a INTENTOS AGOTADOS
-                if exh_exhorto.por_enviar_intentos > CANTIDAD_MAXIMA_INTENTOS:
-                    exh_exhorto.estado = "INTENTOS AGOTADOS"
-                    mensaje_advertencia += ". Cambio el estado a INTENTOS AGOTADOS"
-                else:
-                    mensaje_advertencia += f". Van {exh_exhorto.por_enviar_intentos} intentos"
-                mensajes_termino.append(mensaje_advertencia)
-                bitacora.warning(mensaje_advertencia)
-                # Guardar los cambios en por_enviar_tiempo_anterior, por_enviar_intentos y estado
-                exh_exhorto.save()
-                todos_los_archivos_enviados_con_exito = False
-                break  # Salir del bucle de archivos
-
-            # Tomar success de la respuesta
-            archivo_enviado_con_exito = False
-            respuesta = response.json()
-            if "success" in respuesta:
-                archivo_enviado_con_exito = bool(respuesta["success"])
-            else:
-                mensaje_advertencia = "La respuesta no tiene 'success' al enviar el archivo"
-                mensajes_termino.append(mensaje_advertencia)
-                bitacora.warning(mensaje_advertencia)
-                todos_los_archivos_enviados_con_exito = False
-                break  # Salir del bucle de archivos
-
-            # Si NO se envió con éxito...
-            if archivo_enviado_con_exito is False:
-                mensaje_advertencia = "El envío del archivo del exhorto no fue exitoso"
-                if "message" in respuesta:
-                    mensaje_advertencia += f"MENSAJE: {str(respuesta['message'])}"
-                if "errors" in respuesta:
-                    mensaje_advertencia += f"ERRORES: {str(respuesta['errors'])}"
-                mensajes_termino.append(mensaje_advertencia)
-                bitacora.warning(mensaje_advertencia)
-                todos_los_archivos_enviados_con_exito = False
-                break  # Salir del bucle de archivos
+            response.raise_for_status()
+        except MyCircuitOpenError:
+            mensaje_advertencia = posponer_envio(exh_exhorto, f"El circuito de {exh_externo.clave} está abierto")
+            mensajes.append(mensaje_advertencia)
+            bitacora.warning(mensaje_advertencia)
+            return False, mensajes
+        except MyDownloadError:
+            mensaje_advertencia = "Falla al leer el archivo del storage mientras se enviaba"
+        except requests.exceptions.ConnectionError:
+            mensaje_advertencia = "No hubo respuesta del servidor al enviar el archivo"
+        except requests.exceptions.HTTPError as error:
+            mensaje_advertencia = f"Status Code {str(error)} al enviar el archivo"
+        except requests.exceptions.RequestException:
+            mensaje_advertencia = "Falla desconocida al enviar el archivo"
+        finally:
+            cronometro.add("descargar_gcs", archivo_lector.seconds, **etiquetas)
+            cronometro.add("post_archivo", time.perf_counter() - inicio - archivo_lector.seconds, **etiquetas)
 
-        # Si todos_los_archivos_enviados_con_exito es falso, cambiar estado a RECHAZADO
-        if todos_los_archivos_enviados_con_exito is False:
-            exh_exhorto.estado = "RECHAZADO"
-            exh_exhorto.save()
-            mensaje_advertencia = "Cambio el estado a RECHAZADO por falla al enviar archivos"
-            mensajes_termino.append(mensaje_advertencia)
+        # Si NO se comunicó con éxito, se registra el intento y el siguiente continuará desde este archivo
+        if mensaje_advertencia != "":
+            mensaje_advertencia = registrar_intento_fallido(exh_exhorto, tiempo_actual, mensaje_advertencia)
+            mensajes.append(mensaje_advertencia)
             bitacora.warning(mensaje_advertencia)
-            continue  # Pasar al siguiente exhorto
+            return False, mensajes
+
+        # Tomar success de la respuesta
+        archivo_enviado_con_exito = False
+        respuesta = response.json()
+        if "success" in respuesta:
+            archivo_enviado_con_exito = bool(respuesta["success"])
+        else:
+            mensaje_advertencia = "La respuesta no tiene 'success' al enviar el archivo"
+            mensajes.append(mensaje_advertencia)
+            bitacora.warning(mensaje_advertencia)
+            todos_los_archivos_enviados_con_exito = False
+            break  # Salir del bucle de archivos
+
+        # Si NO se envió con éxito...
+        if archivo_enviado_con_exito is False:
+            mensaje_advertencia = "El envío del archivo del exhorto no fue exitoso"
+            if "message" in respuesta:
+                mensaje_advertencia += f"MENSAJE: {str(respuesta['message'])}"
+            if "errors" in respuesta:
+                mensaje_advertencia += f"ERRORES: {str(respuesta['errors'])}"
+            mensajes.append(mensaje_advertencia)
+            bitacora.warning(mensaje_advertencia)
+            todos_los_archivos_enviados_con_exito = False
+            break  # Salir del bucle de archivos
+
+        # Guardar que el archivo fue recibido con éxito y la respuesta del externo
+        exh_exhorto_archivo.envio_tiempo = datetime.now()
+        exh_exhorto_archivo.envio_respuesta = respuesta
+        with cronometro.span("commit", **etiquetas):
+            exh_exhorto_archivo.save()
+
+    # Si todos_los_archivos_enviados_con_exito es falso, cambiar estado a RECHAZADO
+    if todos_los_archivos_enviados_con_exito is False:
+        exh_exhorto.estado = "RECHAZADO"
+        exh_exhorto.save()
+        mensaje_advertencia = "Cambio el estado a RECHAZADO por falla al enviar archivos"
+        mensajes.append(mensaje_advertencia)
+        bitacora.warning(mensaje_advertencia)
+        return False, mensajes
+
+    # Validar el acuse, el tiempo se mide con cualquier desenlace, incluso los que cambian el estado a RECHAZADO
+    with cronometro.span("validar_acuse", **etiquetas):
+        # Tomar la respuesta del último archivo, que pudo haberse recibido en un intento anterior
+        respuesta = {}
+        if len(exh_exhortos_archivos) > 0 and exh_exhortos_archivos[-1].envio_respuesta is not None:
+            respuesta = exh_exhortos_archivos[-1].envio_respuesta
 
         # Validar que en la ultima respuesta tenga "data"
         if "data" not in respuesta:
             exh_exhorto.estado = "RECHAZADO"
             exh_exhorto.save()
             mensaje_advertencia = "Cambio el estado a RECHAZADO porque la respuesta no tiene 'data'"
-            mensajes_termino.append(mensaje_advertencia)
+            mensajes.append(mensaje_advertencia)
             bitacora.warning(mensaje_advertencia)
-            continue  # Pasar al siguiente exhorto
+            return False, mensajes
         data = respuesta["data"]
 
         # Validar que en data tenga "acuse"
@@ -399,9 +756,9 @@ def enviar(exhorto_origen_id: str = "") -> tuple[str, str, str]:
             exh_exhorto.estado = "RECHAZADO"
             exh_exhorto.save()
             mensaje_advertencia = "Cambio el estado a RECHAZADO porque la respuesta no tiene 'acuse'"
-            mensajes_termino.append(mensaje_advertencia)
+            mensajes.append(mensaje_advertencia)
             bitacora.warning(mensaje_advertencia)
-            continue  # Pasar al siguiente exhorto
+            return False, mensajes
         acuse = data["acuse"]
 
         # Inicializar mensaje_advertencia como texto vacio, si falta algo obligado se llenará
@@ -424,24 +781,15 @@ def enviar(exhorto_origen_id: str = "") -> tuple[str, str, str]:
             mensaje_advertencia = "Faltó folioSeguimiento en el acuse"
 
         # Validar que en acuse tenga "fechaHoraRecepcion"
+        acuse_fecha_hora_recepcion = None
         try:
             acuse_fecha_hora_recepcion_str = str(acuse["fechaHoraRecepcion"])
             bitacora.info("Acuse fechaHoraRecepcion: %s", acuse_fecha_hora_recepcion_str)
+            acuse_fecha_hora_recepcion = convertir_fecha_hora(acuse_fecha_hora_recepcion_str)
+            if acuse_fecha_hora_recepcion is None:
+                mensaje_advertencia = "fechaHoraRecepcion en formato incorrecto"
         except KeyError:
             mensaje_advertencia = "Faltó fechaHoraRecepcion en el acuse"
-        try:
-            acuse_fecha_hora_recepcion = datetime.strptime(acuse_fecha_hora_recepcion_str, "%Y-%m-%d %H:%M:%S.%f")
-        except ValueError:
-            try:
-                acuse_fecha_hora_recepcion = datetime.strptime(acuse_fecha_hora_recepcion_str, "%Y-%m-%dT%H:%M:%S.%f")
-            except ValueError:
-                try:
-                    acuse_fecha_hora_recepcion = datetime.strptime(acuse_fecha_hora_recepcion_str, "%Y-%m-%d %H:%M:%S")
-                except ValueError:
-                    try:
-                        acuse_fecha_hora_recepcion = datetime.strptime(acuse_fecha_hora_recepcion_str, "%Y-%m-%dT%H:%M:%S")
-                    except ValueError:
-                        mensaje_advertencia = "fechaHoraRecepcion en formato incorrecto"
 
         # Puede venir "municipioAreaRecibeId" en acuse porque es opcional
         acuse_municipio_area_recibe_id = None
@@ -480,30 +828,227 @@ def enviar(exhorto_origen_id: str = "") -> tuple[str, str, str]:
             exh_exhorto.estado = "RECHAZADO"
             exh_exhorto.save()
             mensaje_advertencia += ". Cambio el estado a RECHAZADO"
-            mensajes_termino.append(mensaje_advertencia)
+            mensajes.append(mensaje_advertencia)
             bitacora.warning(mensaje_advertencia)
-            continue
-
-        # Actualizar el exhorto, principalmente cambiar el estado a RECIBIDO CON EXITO
-        exh_exhorto.estado = "RECIBIDO CON EXITO"
-        exh_exhorto.folio_seguimiento = acuse_folio_seguimiento
-        exh_exhorto.acuse_fecha_hora_recepcion = acuse_fecha_hora_recepcion
-        exh_exhorto.acuse_municipio_area_recibe_id = acuse_municipio_area_recibe_id
-        exh_exhorto.acuse_area_recibe_id = acuse_area_recibe_id
-        exh_exhorto.acuse_area_recibe_nombre = acuse_area_recibe_nombre
-        exh_exhorto.acuse_url_info = acuse_url_info
+            return False, mensajes
+
+    # Actualizar el exhorto, principalmente cambiar el estado a RECIBIDO CON EXITO
+    exh_exhorto.estado = "RECIBIDO CON EXITO"
+    exh_exhorto.folio_seguimiento = acuse_folio_seguimiento
+    exh_exhorto.acuse_fecha_hora_recepcion = acuse_fecha_hora_recepcion
+    exh_exhorto.acuse_municipio_area_recibe_id = acuse_municipio_area_recibe_id
+    exh_exhorto.acuse_area_recibe_id = acuse_area_recibe_id
+    exh_exhorto.acuse_area_recibe_nombre = acuse_area_recibe_nombre
+    exh_exhorto.acuse_url_info = acuse_url_info
+    with cronometro.span("commit", **etiquetas):
         exh_exhorto.save()
 
-        # Agregar mensaje de éxito a la bitácora
-        mensaje = "El exhorto se envió con éxito. Cambio el estado a RECIBIDO CON EXITO"
-        mensajes_termino.append(mensaje)
-        bitacora.info(mensaje)
+    # Agregar mensaje de éxito a la bitácora
+    mensaje = "El exhorto se envió con éxito. Cambio el estado a RECIBIDO CON EXITO"
+    mensajes.append(mensaje)
+    bitacora.info(mensaje)
+
+    # Entregar que fue recibido con éxito
+    return True, mensajes
+
+
+def enviar_y_liberar(
+    exh_exhorto: ExhExhorto,
+    exh_externo: ExhExterno,
+    municipio_destino: Municipio,
+    tiempo_actual: datetime,
+    cronometro: StageTimer,
+    reservador: str,
+) -> tuple[bool, list[str]]:
+    """Enviar un exhorto y liberar su reserva, una falla inesperada se registra para seguir con los demás"""
+    exhorto_origen_id = exh_exhorto.exhorto_origen_id
+    try:
+        exito, mensajes = enviar_exhorto(exh_exhorto, exh_externo, municipio_destino, tiempo_actual, cronometro)
+    except Exception as error:
+        database.session.rollback()
+        mensaje_error = f"Falla inesperada al enviar el exhorto {exhorto_origen_id}: {str(error)}"
+        bitacora.error(mensaje_error)
+        exito, mensajes = False, [mensaje_error]
+    liberar_exhorto(reservador, exh_exhorto)
+    return exito, mensajes
+
+
+def enviar_carril(
+    exh_exhortos_ids: list[int],
+    tiempo_actual: datetime,
+    cronometro: StageTimer,
+    reservador: str,
+) -> tuple[int, list[str]]:
+    """Enviar en un hilo, uno tras otro, los exhortos de un carril, liberando cada uno al terminar con él"""
+
+    # Inicializar el contador y el listado de mensajes
+    exhortos_procesados_contador = 0
+    mensajes = []
+
+    # Cada hilo usa su propio contexto y por lo tanto su propia sesión de la base de datos
+    with app.app_context(), sin_expirar_al_confirmar():
+        with cronometro.span("consulta_bd"):
+            exh_exhortos = cargar_por_enviar(ExhExhorto.query.filter(ExhExhorto.id.in_(exh_exhortos_ids)))
+            municipios, exh_externos = cargar_destinos(exh_exhortos)
+        for exh_exhorto in exh_exhortos:
+            exh_externo, municipio_destino, mensaje_advertencia = consultar_destino(exh_exhorto, municipios, exh_externos)
+            if mensaje_advertencia != "":
+                mensajes.append(mensaje_advertencia)
+                bitacora.warning(mensaje_advertencia)
+                continue  # Pasar al siguiente exhorto
+            exito, mensajes_exhorto = enviar_y_liberar(
+                exh_exhorto, exh_externo, municipio_destino, tiempo_actual, cronometro, reservador
+            )
+            mensajes.extend(mensajes_exhorto)
+            if exito:
+                exhortos_procesados_contador += 1
 
-        # Pausa de 2 segundos entre envios de exhortos
-        time.sleep(2)
+    # Entregar el contador y los mensajes
+    return exhortos_procesados_contador, mensajes
 
-        # Incrementar contador_recibidos_con_exito
-        exhortos_procesados_contador += 1
+
+def enviar_reservados(
+    exh_exhortos_ids: list[int],
+    en_paralelo: bool,
+    reservador: str,
+    cronometro: Optional[StageTimer] = None,
+) -> tuple[int, list[str]]:
+    """Enviar los exhortos reservados, liberando cada uno al terminar con él, entrega el contador de procesados y los mensajes"""
+
+    # Medir el tiempo de cada etapa
+    if cronometro is None:
+        cronometro = StageTimer()
+
+    # Obtener el tiempo actual
+    tiempo_actual = datetime.now()
+
+    # Inicializar el contador y el listado de mensajes de termino
+    exhortos_procesados_contador = 0
+    mensajes_termino = []
+
+    # Si NO es en paralelo, cargar los exhortos completos y enviarlos uno tras otro
+    # Los exhortos cargados se conservan entre los commits de cada envío, al terminar se restaura la sesión
+    if en_paralelo is False:
+        with sin_expirar_al_confirmar():
+            # Consultar los exhortos reservados con su payload y sus archivos
+            # y los municipios de destino y los externos de todos los exhortos
+            with cronometro.span("consulta_bd"):
+                exh_exhortos = cargar_por_enviar(ExhExhorto.query.filter(ExhExhorto.id.in_(exh_exhortos_ids)))
+                municipios, exh_externos = cargar_destinos(exh_exhortos)
+            for exh_exhorto in exh_exhortos:
+                # Consultar el externo y el municipio de destino
+                exh_externo, municipio_destino, mensaje_advertencia = consultar_destino(exh_exhorto, municipios, exh_externos)
+                if mensaje_advertencia != "":
+                    mensajes_termino.append(mensaje_advertencia)
+                    bitacora.warning(mensaje_advertencia)
+                    continue  # Pasar al siguiente exhorto
+
+                # Enviar
+                exito, mensajes = enviar_y_liberar(
+                    exh_exhorto, exh_externo, municipio_destino, tiempo_actual, cronometro, reservador
+                )
+                mensajes_termino.extend(mensajes)
+                if exito:
+                    exhortos_procesados_contador += 1
+
+    # Si es en paralelo, agrupar por externo y repartir en carriles de HILOS_POR_EXTERNO cada uno
+    # Para agrupar basta el ID y el municipio de destino, cada carril carga completos sus exhortos
+    if en_paralelo is True:
+        with cronometro.span("consulta_bd"):
+            renglones = (
+                ExhExhorto.query.with_entities(ExhExhorto.id, ExhExhorto.municipio_destino_id)
+                .filter(ExhExhorto.id.in_(exh_exhortos_ids))
+                .order_by(ExhExhorto.id)
+                .all()
+            )
+            municipios, exh_externos = cargar_destinos(renglones)
+        envios_por_externo = {}
+        for renglon in renglones:
+            exh_externo, _, mensaje_advertencia = consultar_destino(renglon, municipios, exh_externos)
+            if mensaje_advertencia != "":
+                mensajes_termino.append(mensaje_advertencia)
+                bitacora.warning(mensaje_advertencia)
+                continue  # Pasar al siguiente exhorto
+            envios_por_externo.setdefault(exh_externo.id, []).append(renglon.id)
+        carriles = []
+        for envios_externo in envios_por_externo.values():
+            for numero in range(HILOS_POR_EXTERNO):
+                carril = envios_externo[numero::HILOS_POR_EXTERNO]
+                if len(carril) > 0:
+                    carriles.append(carril)
+        if len(carriles) > 0:
+            bitacora.info(
+                "Enviando %s exhortos a %s externos en %s carriles...",
+                sum(len(carril) for carril in carriles),
+                len(envios_por_externo),
+                len(carriles),
+            )
+            with ThreadPoolExecutor(max_workers=min(HILOS_MAXIMOS, len(carriles))) as ejecutor:
+                for procesados, mensajes in ejecutor.map(
+                    enviar_carril, carriles, repeat(tiempo_actual), repeat(cronometro), repeat(reservador)
+                ):
+                    exhortos_procesados_contador += procesados
+                    mensajes_termino.extend(mensajes)
+
+    # Entregar el contador y los mensajes
+    return exhortos_procesados_contador, mensajes_termino
+
+
+def enviar(exhorto_origen_id: str = "", en_paralelo: bool = False) -> tuple[str, str, str]:
+    """Enviar exhortos, si en_paralelo es verdadero se envian en hilos agrupados por PJ externo"""
+    bitacora.info("Inicia enviar")
+
+    # Medir el tiempo de cada etapa, al terminar se acumulan los histogramas por externo
+    cronometro = StageTimer(bitacora)
+
+    # Si no se proporciona el exhorto_origen_id
+    if exhorto_origen_id == "":
+        # Reservar todos los exhortos con estado POR ENVIAR que no tengan programado un siguiente intento en el futuro
+        consulta = ExhExhorto.query.filter_by(estado="POR ENVIAR").filter_by(estatus="A")
+        consulta = consulta.filter(
+            or_(
+                ExhExhorto.por_enviar_tiempo_siguiente.is_(None),
+                ExhExhorto.por_enviar_tiempo_siguiente <= datetime.now(),
+            )
+        )
+        with cronometro.span("reservar"):
+            reservador, exh_exhortos_ids = reservar_por_enviar(consulta)
+    else:
+        # Consultar el exhorto con exhorto_origen_id
+        exh_exhorto = ExhExhorto.query.filter_by(exhorto_origen_id=exhorto_origen_id).filter_by(estatus="A").first()
+        if exh_exhorto is None:
+            mensaje_advertencia = f"No existe el exhorto con ID {exhorto_origen_id}"
+            bitacora.warning(mensaje_advertencia)
+            raise MyNotExistsError(mensaje_advertencia)
+        if exh_exhorto.estado != "POR ENVIAR":
+            mensaje_advertencia = f"El exhorto con ID {exhorto_origen_id} no está en estado POR ENVIAR"
+            bitacora.warning(mensaje_advertencia)
+            raise MyNotExistsError(mensaje_advertencia)
+        reservador, exh_exhortos_ids = reservar_por_enviar(
+            ExhExhorto.query.filter_by(id=exh_exhorto.id).filter_by(estado="POR ENVIAR")
+        )
+        if len(exh_exhortos_ids) == 0:
+            mensaje_advertencia = f"AVISO: El exhorto con ID {exhorto_origen_id} lo está enviando otro proceso"
+            bitacora.warning(mensaje_advertencia)
+            raise MyEmptyError(mensaje_advertencia)
+
+    # Validar que haya exhortos POR ENVIAR
+    if len(exh_exhortos_ids) == 0:
+        mensaje_advertencia = "AVISO: No hay exhortos por enviar"
+        bitacora.warning(mensaje_advertencia)
+        raise MyEmptyError(mensaje_advertencia)
+
+    # Enviar los exhortos reservados, cada uno se libera al terminar con él y al final se liberan los que queden
+    try:
+        exhortos_procesados_contador, mensajes_termino = enviar_reservados(
+            exh_exhortos_ids, en_paralelo, reservador, cronometro
+        )
+    finally:
+        liberar_reserva(reservador, exh_exhortos_ids)
+
+    # Acumular los histogramas de tiempos por externo y etapa, y agregar el resumen a los mensajes
+    cronometro.save(app.redis, "cronometro:enviar")
+    mensajes_termino.extend(cronometro.summary())
 
     # Elaborar mensaje final
     mensaje_final = f"Termina enviar exhortos con {exhortos_procesados_contador} exhortos procesados."
@@ -514,7 +1059,7 @@ def enviar(exhorto_origen_id: str = "") -> tuple[str, str, str]:
     return "\n".join(mensajes_termino), "", ""
 
 
-def lanzar_enviar(exhorto_origen_id: str):
+def lanzar_enviar(exhorto_origen_id: str, en_paralelo: bool = False):
     """Lanzar tarea en el fondo para enviar exhortos"""
 
     # Iniciar la tarea en el fondo
@@ -522,7 +1067,7 @@ def lanzar_enviar(exhorto_origen_id: str):
 
     # Ejecutar
     try:
-        mensaje_termino, nombre_archivo, url_publica = enviar(exhorto_origen_id)
+        mensaje_termino, nombre_archivo, url_publica = enviar(exhorto_origen_id, en_paralelo)
     except MyAnyError as error:
         mensaje_error = str(error)
         set_task_error(mensaje_error)
@@ -533,3 +1078,39 @@ def lanzar_enviar(exhorto_origen_id: str):
 
     # Entregar mensaje de termino
     return mensaje_termino
+
+
+def reintentar_enviar(exhorto_origen_id: str, programado: str) -> str:
+    """Tarea en el fondo programada para reintentar el envío de un exhorto cuando se cumple su espera"""
+
+    # Consultar el exhorto
+    exh_exhorto = ExhExhorto.query.filter_by(exhorto_origen_id=exhorto_origen_id).filter_by(estatus="A").first()
+    if exh_exhorto is None or exh_exhorto.estado != "POR ENVIAR":
+        mensaje = f"Se omite reintentar el exhorto {exhorto_origen_id} porque ya no está POR ENVIAR"
+        bitacora.info(mensaje)
+        return mensaje
+
+    # Si se programó otro intento después de este, se omite porque le toca a esa otra tarea
+    if exh_exhorto.por_enviar_tiempo_siguiente is None or exh_exhorto.por_enviar_tiempo_siguiente.isoformat() != programado:
+        mensaje = f"Se omite reintentar el exhorto {exhorto_origen_id} porque ya fue reprogramado"
+        bitacora.info(mensaje)
+        return mensaje
+
+    # Ejecutar
+    try:
+        mensaje_termino, _, _ = enviar(exhorto_origen_id)
+    except MyEmptyError as error:
+        # Si otro proceso lo tiene reservado, reprogramar para no perder el reintento
+        if exh_exhorto.estado == "POR ENVIAR" and exh_exhorto.por_enviar_reservado_hasta is not None:
+            segundos = SEGUNDOS_ESPERA_ENTRE_INTENTOS + random.uniform(0, SEGUNDOS_ESPERA_ENTRE_INTENTOS / 2)
+            programar_reintento(exh_exhorto, segundos)
+            tiempo_siguiente_str = exh_exhorto.por_enviar_tiempo_siguiente.strftime("%Y-%m-%d %H:%M:%S")
+            mensaje = f"{str(error)}. Se reprograma el reintento para {tiempo_siguiente_str}"
+            bitacora.info(mensaje)
+            return mensaje
+        return str(error)
+    except MyAnyError as error:
+        return str(error)
+
+    # Entregar mensaje de termino
+    return mensaje_termino
@@ -26,7 +26,7 @@ from carina.blueprints.exh_exhortos.forms import (
 from carina.blueprints.exh_exhortos.models import ExhExhorto
 from carina.blueprints.exh_exhortos_archivos.models import ExhExhortoArchivo
 from carina.blueprints.exh_exhortos_partes.models import ExhExhortoParte
-from carina.blueprints.exh_externos.models import ExhExterno
+from carina.blueprints.exh_externos.cache import consultar_cache_materias
 from carina.blueprints.modulos.models import Modulo
 from carina.blueprints.municipios.models import Municipio
 from carina.blueprints.permisos.models import Permiso
@@ -159,23 +159,22 @@ def new():
             flash("El municipio de destino no es válido", "warning")
             es_valido = False
         else:
-            estado_destino = municipio_destino.estado
-            # Consultar en exh_externos al estado de destino
-            exh_externo = ExhExterno.query.filter_by(estado_id=estado_destino.id).first()
-            if exh_externo is None:
-                flash(f"No hay registro en externos para el estado de destino {estado_destino.nombre}", "warning")
+            # Consultar en el cache de materias al externo del estado de destino
+            cache_materias = consultar_cache_materias(municipio_destino.estado_id)
+            if cache_materias is None:
+                flash(f"No hay registro en externos para el estado de destino {municipio_destino.estado.nombre}", "warning")
                 es_valido = False
             else:
                 # Validar la clave de la materia y obtener el nombre de la misma
-                if exh_externo.materias is None:
-                    flash(f"No hay materias en externos para el estado de destino {estado_destino.nombre}", "warning")
+                if cache_materias["materias"] is None:
+                    flash(f"No hay materias en externos para el estado de destino {municipio_destino.estado.nombre}", "warning")
                     es_valido = False
                 else:
-                    materia = next((materia for materia in exh_externo.materias if materia["clave"] == materia_clave), None)
-                    if materia is None:
-                        flash(f"La clave de materia {materia_clave} no se encuentra en externo {exh_externo.clave}", "warning")
+                    materia_nombre = cache_materias["por_clave"].get(materia_clave)
+                    if materia_nombre is None:
+                        exh_externo_clave = cache_materias["exh_externo_clave"]
+                        flash(f"La clave de materia {materia_clave} no se encuentra en externo {exh_externo_clave}", "warning")
                         es_valido = False
-                    materia_nombre = materia["nombre"]
         # Si es valido, guardar
         if es_valido:
             exh_exhorto = ExhExhorto(
@@ -244,23 +243,22 @@ def edit(exh_exhorto_id):
             flash("El municipio de destino no es válido", "warning")
             es_valido = False
         else:
-            estado_destino = municipio_destino.estado
-            # Consultar en exh_externos al estado de destino
-            exh_externo = ExhExterno.query.filter_by(estado_id=estado_destino.id).first()
-            if exh_externo is None:
-                flash(f"No hay registro en externos para el estado de destino {estado_destino.nombre}", "warning")
+            # Consultar en el cache de materias al externo del estado de destino
+            cache_materias = consultar_cache_materias(municipio_destino.estado_id)
+            if cache_materias is None:
+                flash(f"No hay registro en externos para el estado de destino {municipio_destino.estado.nombre}", "warning")
                 es_valido = False
             else:
                 # Validar la clave de la materia y obtener el nombre de la misma
-                if exh_externo.materias is None:
-                    flash(f"No hay materias en externos para el estado de destino {estado_destino.nombre}", "warning")
+                if cache_materias["materias"] is None:
+                    flash(f"No hay materias en externos para el estado de destino {municipio_destino.estado.nombre}", "warning")
                     es_valido = False
                 else:
-                    materia = next((materia for materia in exh_externo.materias if materia["clave"] == materia_clave), None)
-                    if materia is None:
-                        flash(f"La clave de materia {materia_clave} no se encuentra en externo {exh_externo.clave}", "warning")
+                    materia_nombre = cache_materias["por_clave"].get(materia_clave)
+                    if materia_nombre is None:
+                        exh_externo_clave = cache_materias["exh_externo_clave"]
+                        flash(f"La clave de materia {materia_clave} no se encuentra en externo {exh_externo_clave}", "warning")
                         es_valido = False
-                    materia_nombre = materia["nombre"]
         # Si es valido, actualizar
         if es_valido:
             exh_exhorto.municipio_destino_id = form.municipio_destino.data
@@ -378,10 +376,15 @@ def cancel(exh_exhorto_id):
 def get_from_externo(exh_exhorto_id):
     """Lanzar tarea en el fondo para consultar Exhorto al PJ Externo"""
     exh_exhorto = ExhExhorto.query.get_or_404(exh_exhorto_id)
+    # Validar que el Exhorto tenga folio de seguimiento
+    if exh_exhorto.folio_seguimiento is None or exh_exhorto.folio_seguimiento == "":
+        flash("No se puede consultar el exhorto porque no tiene folio de seguimiento.", "warning")
+        return redirect(url_for("exh_exhortos.detail", exh_exhorto_id=exh_exhorto.id))
     tarea = current_user.launch_task(
         comando="exh_exhortos.tasks.lanzar_consultar",
         mensaje="Consultando exhorto desde externo",
-        exh_exhorto_id=exh_exhorto.id,
+        folio_seguimiento=exh_exhorto.folio_seguimiento,
+        llave_unica=exh_exhorto.folio_seguimiento,
     )
     flash("Se ha lanzado la tarea en el fondo. Esta página se va a recargar en 10 segundos...", "info")
     return redirect(url_for("tareas.detail", tarea_id=tarea.id))
@@ -406,14 +409,29 @@ def send(exh_exhorto_id):
     if exh_exhorto.estado != "PENDIENTE":
         flash("El estado del exhorto debe ser PENDIENTE.", "warning")
         return redirect(url_for("exh_exhortos.detail", exh_exhorto_id=exh_exhorto.id))
-    # Cambiar el estado a POR ENVIAR
+    # Validar que el municipio de destino exista
+    municipio_destino = Municipio.query.get(exh_exhorto.municipio_destino_id)
+    if municipio_destino is None:
+        flash("No se pudo enviar el exhorto. El municipio de destino no es válido.", "warning")
+        return redirect(url_for("exh_exhortos.detail", exh_exhorto_id=exh_exhorto.id))
+    # Cambiar el estado a POR ENVIAR, como es un envío nuevo se reinicia el avance de un envío anterior
+    # Se elabora el payload una sola vez, todos los intentos de envío mandan los mismos bytes
     exh_exhorto.estado = "POR ENVIAR"
+    exh_exhorto.por_enviar_tiempo_siguiente = None
+    exh_exhorto.por_enviar_tiempo_aceptado = None
+    exh_exhorto.guardar_payload(municipio_destino)
     exh_exhorto.save()
+    for exh_exhorto_archivo in exh_exhorto.exh_exhortos_archivos:
+        if exh_exhorto_archivo.envio_tiempo is not None:
+            exh_exhorto_archivo.envio_tiempo = None
+            exh_exhorto_archivo.envio_respuesta = None
+            exh_exhorto_archivo.save()
     # Lanzar tarea en el fondo
     tarea = current_user.launch_task(
         comando="exh_exhortos.tasks.lanzar_enviar",
         mensaje="Enviando exhorto al externo",
         exhorto_origen_id=exh_exhorto.exhorto_origen_id,
+        llave_unica=exh_exhorto.exhorto_origen_id,
     )
     flash("Se ha lanzado la tarea en el fondo. Esta página se va a recargar en 10 segundos...", "info")
     return redirect(url_for("tareas.detail", tarea_id=tarea.id))
@@ -483,10 +501,24 @@ def back_to_by_send(exh_exhorto_id):
     if exh_exhorto.estado != "INTENTOS AGOTADOS":
         es_valido = False
         flash("El estado del exhorto debe ser INTENTOS AGOTADOS.", "warning")
+    # Validar que el municipio de destino exista
+    municipio_destino = Municipio.query.get(exh_exhorto.municipio_destino_id)
+    if municipio_destino is None:
+        es_valido = False
+        flash("El municipio de destino no es válido.", "warning")
     # Hacer el cambio de estado
     if es_valido:
         exh_exhorto.estado = "POR ENVIAR"
         exh_exhorto.por_enviar_intentos = 0
+        exh_exhorto.por_enviar_tiempo_siguiente = None
+        # Si el payload cambió, el PJ exhortado tiene otro, entonces se reinicia el avance para enviarlo completo
+        # Si es igual, se conserva el avance y no se vuelve a mandar lo que ya fue aceptado
+        if exh_exhorto.guardar_payload(municipio_destino):
+            exh_exhorto.por_enviar_tiempo_aceptado = None
+            for exh_exhorto_archivo in exh_exhorto.exh_exhortos_archivos:
+                if exh_exhorto_archivo.envio_tiempo is not None:
+                    exh_exhorto_archivo.envio_tiempo = None
+                    exh_exhorto_archivo.envio_respuesta = None
         exh_exhorto.save()
         bitacora = Bitacora(
             modulo=Modulo.query.filter_by(nombre=MODULO).first(),
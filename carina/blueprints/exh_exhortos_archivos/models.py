@@ -5,7 +5,7 @@ Exh Exhortos Archivos, modelos
 from datetime import datetime
 from typing import Optional
 
-from sqlalchemy import Enum, ForeignKey, String
+from sqlalchemy import JSON, Enum, ForeignKey, String
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.sql.functions import now
 
@@ -67,6 +67,17 @@ class ExhExhortoArchivo(database.Model, UniversalMixin):
     # Identifica si el archivo es del exhorto inicial o es parte de la respuesta
     es_respuesta: Mapped[bool] = mapped_column(default=False)
 
+    # Fecha y hora en que el PJ exhortado recibió con éxito el archivo que le enviamos, si es nulo no se ha enviado
+    envio_tiempo: Mapped[Optional[datetime]]
+
+    # Respuesta del PJ exhortado al recibir el archivo que le enviamos
+    envio_respuesta: Mapped[Optional[dict]] = mapped_column(JSON)
+
+    @property
+    def fue_enviado(self):
+        """Si fue recibido con éxito por el PJ exhortado"""
+        return self.envio_tiempo is not None
+
     @property
     def tipo_documento_nombre(self):
         """Nombre del tipo de documento"""
@@ -2,11 +2,10 @@
 Exh Exhortos Archivos, vistas
 """
 
-import hashlib
 import json
 from datetime import datetime
 
-from flask import Blueprint, current_app, flash, make_response, redirect, render_template, request, url_for
+from flask import Blueprint, current_app, flash, redirect, render_template, request, url_for
 from flask_login import current_user, login_required
 from werkzeug.datastructures import CombinedMultiDict
 from werkzeug.utils import secure_filename
@@ -19,8 +18,9 @@ from carina.blueprints.modulos.models import Modulo
 from carina.blueprints.permisos.models import Permiso
 from carina.blueprints.usuarios.decorators import permission_required
 from lib.datatables import get_datatable_parameters, output_datatable_json
+from lib.download import send_file_from_gcs
 from lib.exceptions import MyBucketNotFoundError, MyFileNotFoundError, MyNotValidParamError, MyUploadError
-from lib.google_cloud_storage import get_blob_name_from_url, get_file_from_gcs, upload_file_to_gcs
+from lib.google_cloud_storage import HashingReader, get_blob_name_from_url, upload_stream_to_gcs
 from lib.safe_string import safe_message, safe_string
 
 MODULO = "EXH EXHORTOS ARCHIVOS"
@@ -137,22 +137,19 @@ def download_pdf(exh_exhorto_archivo_id):
     # Tomar el nombre del archivo con el que sera descargado
     descarga_nombre = exh_exhorto_archivo.nombre_archivo
 
-    # Obtener el contenido del archivo desde Google Storage
+    # Descargar el archivo PDF desde Google Storage, con un URL firmado o por partes
     try:
-        descarga_contenido = get_file_from_gcs(
+        return send_file_from_gcs(
             bucket_name=current_app.config["CLOUD_STORAGE_DEPOSITO"],
             blob_name=get_blob_name_from_url(exh_exhorto_archivo.url),
+            filename=descarga_nombre,
+            content_type="application/pdf",
+            sha256=exh_exhorto_archivo.hash_sha256 or "",
         )
     except (MyBucketNotFoundError, MyFileNotFoundError, MyNotValidParamError) as error:
         flash(str(error), "danger")
         return redirect(url_for("exh_exhortos.detail", exh_exhorto_id=exh_exhorto_archivo.exh_exhorto_id))
 
-    # Descargar un archivo PDF
-    response = make_response(descarga_contenido)
-    response.headers["Content-Type"] = "application/pdf"
-    response.headers["Content-Disposition"] = f"attachment; filename={descarga_nombre}"
-    return response
-
 
 @exh_exhortos_archivos.route("/exh_exhortos_archivos/nuevo_con_exhorto/<int:exh_exhorto_id>", methods=["GET", "POST"])
 @permission_required(MODULO, Permiso.CREAR)
@@ -196,27 +193,27 @@ def new_with_exh_exhorto(exh_exhorto_id):
         day = fecha_hora_recepcion.strftime("%d")
         blob_name = f"exh_exhortos_archivos/{year}/{month}/{day}/{archivo_pdf_nombre}"
 
-        # Subir el archivo en Google Storage
+        # Subir el archivo en Google Storage por partes, el sha1, sha256 y tamaño se calculan mientras se lee
+        lector = HashingReader(archivo.stream)
         try:
-            data = archivo.stream.read()
-            archivo_pdf_url = upload_file_to_gcs(
+            archivo_pdf_url = upload_stream_to_gcs(
                 bucket_name=current_app.config["CLOUD_STORAGE_DEPOSITO"],
                 blob_name=blob_name,
                 content_type="application/pdf",
-                data=data,
+                stream=lector,
             )
         except (MyBucketNotFoundError, MyUploadError) as error:
             exh_exhorto_archivo.delete()
             flash(str(error), "danger")
             return redirect(url_for("exh_exhortos.detail", exh_exhorto_id=exh_exhorto_id))
 
-        # Definir con hashlib el sha1 y hash256 del archivo
-        exh_exhorto_archivo.hash_sha1 = hashlib.sha1(data).hexdigest()
-        exh_exhorto_archivo.hash_sha256 = hashlib.sha256(data).hexdigest()
+        # Tomar del lector el sha1 y hash256 del archivo
+        exh_exhorto_archivo.hash_sha1 = lector.sha1.hexdigest()
+        exh_exhorto_archivo.hash_sha256 = lector.sha256.hexdigest()
 
         # Si se sube con exito, actualizar el registro con la URL del archivo
         exh_exhorto_archivo.url = archivo_pdf_url
-        exh_exhorto_archivo.tamano = len(data)
+        exh_exhorto_archivo.tamano = lector.size
         exh_exhorto_archivo.estado = "RECIBIDO"
         exh_exhorto_archivo.save()
 
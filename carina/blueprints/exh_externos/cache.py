@@ -0,0 +1,99 @@
+"""
+Exh Externos, cache de materias
+
+Las materias de cada externo indexadas por estado_id y clave de materia, para validar los formularios
+de exhortos y llenar el select de materias sin consultar la base de datos
+
+- En Redis, el hash CACHE_HASH tiene un campo por estado_id con el JSON del externo y sus materias,
+  y CACHE_VERSION es un número que aumenta cada vez que se refresca
+- En la memoria de cada proceso se guarda la última versión leída, si la versión en Redis
+  no ha cambiado se usa la memoria, entonces cada búsqueda cuesta una lectura de Redis
+- Se refresca con refrescar_cache_materias al terminar probar_endpoints y al modificar un externo
+- Si no hay Redis se consulta la base de datos
+"""
+
+import json
+import logging
+import threading
+from typing import Optional
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+from carina.blueprints.exh_externos.models import ExhExterno
+
+CACHE_HASH = "exh_externos:materias"
+CACHE_VERSION = "exh_externos:materias:version"
+
+bitacora = logging.getLogger(__name__)
+
+_memoria = {"version": None, "estados": {}}
+_memoria_candado = threading.Lock()
+
+
+def elaborar_entrada(exh_externo: ExhExterno) -> dict:
+    """Elaborar la entrada del cache de un externo"""
+    return {
+        "exh_externo_clave": exh_externo.clave,
+        "estatus": exh_externo.estatus,
+        "materias": exh_externo.materias,
+    }
+
+
+def indexar_entrada(entrada: dict) -> dict:
+    """Agregar a la entrada el dict de nombres de materias por clave"""
+    entrada["por_clave"] = {materia["clave"]: materia["nombre"] for materia in entrada["materias"] or []}
+    return entrada
+
+
+def refrescar_cache_materias() -> Optional[int]:
+    """Cargar en Redis las materias de todos los externos, entrega la nueva versión o None si no hay Redis"""
+    campos = {}
+    for exh_externo in ExhExterno.query.order_by(ExhExterno.estatus, ExhExterno.id).all():
+        # Un estado tiene un solo externo, si hubiera más se toma el primero activo, los de estatus A van antes que los B
+        campos.setdefault(str(exh_externo.estado_id), json.dumps(elaborar_entrada(exh_externo)))
+    try:
+        pipeline = current_app.redis.pipeline(transaction=True)
+        pipeline.delete(CACHE_HASH)
+        if len(campos) > 0:
+            pipeline.hset(CACHE_HASH, mapping=campos)
+        pipeline.incr(CACHE_VERSION)
+        return pipeline.execute()[-1]
+    except RedisError as error:
+        bitacora.warning("No se pudo refrescar el cache de materias: %s", str(error))
+        return None
+
+
+def consultar_materias_bd(estado_id: int) -> Optional[dict]:
+    """Consultar el externo de un estado y sus materias en la base de datos, cuando no hay cache"""
+    exh_externo = ExhExterno.query.filter_by(estado_id=estado_id).order_by(ExhExterno.estatus, ExhExterno.id).first()
+    if exh_externo is None:
+        return None
+    return indexar_entrada(elaborar_entrada(exh_externo))
+
+
+def consultar_cache_materias(estado_id: int) -> Optional[dict]:
+    """
+    Consultar el externo de un estado y sus materias en el cache
+
+    :param estado_id: ID del estado del externo
+    :return: Dict con exh_externo_clave, estatus, materias (lista de clave y nombre o None)
+        y por_clave (dict de nombres por clave), o None si el estado no tiene externo
+    """
+    try:
+        version = current_app.redis.get(CACHE_VERSION)
+        if version is None:
+            version = refrescar_cache_materias()
+            if version is None:
+                return consultar_materias_bd(estado_id)
+        version = int(version)
+        if version != _memoria["version"]:
+            campos = current_app.redis.hgetall(CACHE_HASH)
+            estados = {int(campo): indexar_entrada(json.loads(valor)) for campo, valor in campos.items()}
+            with _memoria_candado:
+                _memoria["version"] = version
+                _memoria["estados"] = estados
+    except RedisError as error:
+        bitacora.warning("Sin cache de materias: %s", str(error))
+        return consultar_materias_bd(estado_id)
+    return _memoria["estados"].get(estado_id)
@@ -2,15 +2,24 @@
 Exh Externos, tareas en el fondo
 """
 
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional
 
 import requests
+from redis.exceptions import RedisError
 
-from carina.app import create_app
+from carina.app import get_or_create_app
+from carina.blueprints.exh_externos.cache import refrescar_cache_materias
 from carina.blueprints.exh_externos.models import ExhExterno
 from carina.extensions import database
-from lib.exceptions import MyAnyError, MyEmptyError, MyNotExistsError
+from lib.endpoint_health import CONNECTION, ERROR, OK, TIMEOUT, EndpointHealth
+from lib.exceptions import MyAnyError, MyCircuitOpenError, MyEmptyError, MyNotExistsError
+from lib.interop import HEALTH_PREFIX, get_interop_client, probe_endpoint
 from lib.safe_string import safe_clave, safe_string
+from lib.stage_timer import StageTimer
 from lib.tasks import set_task_error, set_task_progress
 
 bitacora = logging.getLogger(__name__)
@@ -20,11 +29,79 @@ empunadura = logging.FileHandler("logs/exh_externos.log")
 empunadura.setFormatter(formato)
 bitacora.addHandler(empunadura)
 
-app = create_app()
+app = get_or_create_app()
 app.app_context().push()
 database.app = app
 
-TIMEOUT = 30  # 30 segundos
+# Columnas de ExhExterno con los endpoints que se prueban
+ENDPOINTS = (
+    "endpoint_consultar_materias",
+    "endpoint_recibir_exhorto",
+    "endpoint_recibir_exhorto_archivo",
+    "endpoint_consultar_exhorto",
+    "endpoint_recibir_respuesta_exhorto",
+    "endpoint_recibir_respuesta_exhorto_archivo",
+    "endpoint_actualizar_exhorto",
+    "endpoint_recibir_promocion",
+    "endpoint_recibir_promocion_archivo",
+)
+HILOS_MAXIMOS = 64  # Cantidad máxima de hilos al probar, para que todo tarde casi lo mismo que el endpoint más lento
+SEGUNDOS_CONEXION = 3  # Segundos para conectar al probar, un endpoint caído no debe detener la prueba
+SEGUNDOS_LECTURA = 10  # Segundos para recibir la respuesta al probar
+
+
+def consultar_materias(exh_externo: ExhExterno, cronometro: StageTimer) -> tuple[Optional[dict], str]:
+    """Consultar las materias de un externo en un hilo, entrega la respuesta o el mensaje de advertencia"""
+    with app.app_context():
+        try:
+            with cronometro.span("get_materias", clave=exh_externo.clave):
+                response = get_interop_client(exh_externo).get(
+                    exh_externo.endpoint_consultar_materias,
+                    kind="endpoint_consultar_materias",
+                    timeout=(SEGUNDOS_CONEXION, SEGUNDOS_LECTURA),
+                )
+            response.raise_for_status()
+            return response.json(), ""
+        except MyCircuitOpenError:
+            return None, f"El circuito está abierto por fallas anteriores, no se probó {exh_externo.clave}"
+        except requests.exceptions.ConnectionError as error:
+            return None, f"Error de conexión {str(error)} para {exh_externo.clave}"
+        except requests.exceptions.Timeout:
+            return None, f"Se acabó el tiempo de espera para {exh_externo.clave}"
+        except requests.exceptions.HTTPError as error:
+            return None, f"Error HTTP {str(error)} para {exh_externo.clave}"
+        except ValueError:
+            # Antes que RequestException porque requests.exceptions.JSONDecodeError hereda de ambas
+            return None, f"La respuesta no es JSON al consultar materias para {exh_externo.clave}"
+        except requests.exceptions.RequestException as error:
+            return None, f"Error de request {str(error)} para {exh_externo.clave}"
+
+
+def probar_endpoint(clave: str, api_key: str, columna: str, url: str) -> dict:
+    """Probar un endpoint en un hilo, entrega el resultado con latencia, status code y tiempo del saludo TLS"""
+    resultado = probe_endpoint(url, api_key, SEGUNDOS_CONEXION, SEGUNDOS_LECTURA)
+    resultado["clave"] = clave
+    resultado["endpoint"] = columna
+    resultado["tiempo"] = datetime.now().isoformat()
+    return resultado
+
+
+def resultado_desenlace(resultado: dict) -> str:
+    """Desenlace del resultado de probar un endpoint para la serie de tiempo de salud"""
+    if resultado["status_code"] is None:
+        return TIMEOUT if "Timeout" in resultado["error"] or "timed out" in resultado["error"] else CONNECTION
+    return ERROR if resultado["status_code"] >= 500 else OK
+
+
+def describir_resultado(resultado: dict) -> str:
+    """Elaborar el mensaje del resultado de probar un endpoint"""
+    if resultado["status_code"] is None:
+        return f"{resultado['clave']} {resultado['endpoint']}: ERROR {resultado['error']}"
+    mensaje = f"{resultado['clave']} {resultado['endpoint']}: HTTP {resultado['status_code']}"
+    mensaje += f" en {resultado['latency'] * 1000:.0f} ms, conexión {resultado['connect'] * 1000:.0f} ms"
+    if resultado["tls"] is not None:
+        mensaje += f", TLS {resultado['tls'] * 1000:.0f} ms"
+    return mensaje
 
 
 def probar_endpoints(clave: str) -> tuple[str, str, str]:
@@ -34,14 +111,19 @@ def probar_endpoints(clave: str) -> tuple[str, str, str]:
     # Limpiar clave
     clave = safe_clave(clave)
 
+    # Medir el tiempo de cada etapa, al terminar se acumulan los histogramas por externo
+    cronometro = StageTimer(bitacora)
+
     # Si no se proporciona la clave
     exh_externos = []
     if clave == "":
         # Probar todos los exh externos
-        exh_externos = ExhExterno.query.filter_by(estatus="A").all()
+        with cronometro.span("consulta_bd"):
+            exh_externos = ExhExterno.query.filter_by(estatus="A").all()
     else:
         # Consultar exh externo a partir de la clave
-        exh_externo = ExhExterno.query.filter_by(clave=safe_clave(clave)).filter_by(estatus="A").first()
+        with cronometro.span("consulta_bd"):
+            exh_externo = ExhExterno.query.filter_by(clave=safe_clave(clave)).filter_by(estatus="A").first()
         if exh_externo is None:
             mensaje_advertencia = f"ERROR: No existe o ha sido eliminado el externo con clave {clave}"
             bitacora.warning(mensaje_advertencia)
@@ -57,10 +139,60 @@ def probar_endpoints(clave: str) -> tuple[str, str, str]:
     # Inicializar listado de mensajes de termino
     mensajes_termino = []
 
-    # Probar endpoints de consultar materias
-    bitacora.info("Por probar %s endpoints de consultar materias...", len(exh_externos))
+    # Probar al mismo tiempo todos los endpoints de todos los externos y consultar sus materias
+    pruebas = []
+    for exh_externo in exh_externos:
+        for columna in ENDPOINTS:
+            url = getattr(exh_externo, columna)
+            if url is not None and url != "":
+                pruebas.append((exh_externo.clave, exh_externo.api_key or "", columna, url))
+    por_consultar_materias = [
+        exh_externo for exh_externo in exh_externos if exh_externo.api_key and exh_externo.endpoint_consultar_materias
+    ]
+    bitacora.info("Por probar %s endpoints de %s externos...", len(pruebas), len(exh_externos))
+    resultados = []
+    respuestas_materias = {}
+    if len(pruebas) + len(por_consultar_materias) > 0:
+        with ThreadPoolExecutor(max_workers=min(HILOS_MAXIMOS, len(pruebas) + len(por_consultar_materias))) as ejecutor:
+            futuros_materias = {
+                exh_externo.id: ejecutor.submit(consultar_materias, exh_externo, cronometro)
+                for exh_externo in por_consultar_materias
+            }
+            futuros_pruebas = [ejecutor.submit(probar_endpoint, *prueba) for prueba in pruebas]
+            resultados = [futuro.result() for futuro in futuros_pruebas]
+            respuestas_materias = {exh_externo_id: futuro.result() for exh_externo_id, futuro in futuros_materias.items()}
+
+    # Reportar los resultados de los endpoints, acumular sus latencias y agregarlos a la serie de tiempo de salud
+    # Consultar materias pasa por el cliente interop que ya registra su muestra, la de su prueba se omite para no duplicarla
+    registrados_por_cliente = {(exh_externo.clave, "endpoint_consultar_materias") for exh_externo in por_consultar_materias}
+    salud = EndpointHealth(app.redis, prefix=HEALTH_PREFIX)
+    contador_disponibles = 0
+    for resultado in resultados:
+        mensaje = describir_resultado(resultado)
+        mensajes_termino.append(mensaje)
+        if (resultado["clave"], resultado["endpoint"]) not in registrados_por_cliente:
+            salud.record(resultado["clave"], resultado["endpoint"], resultado["latency"], resultado_desenlace(resultado))
+        if resultado["status_code"] is not None and resultado["status_code"] < 500:
+            contador_disponibles += 1
+            cronometro.add(resultado["endpoint"], resultado["latency"], clave=resultado["clave"])
+            if resultado["tls"] is not None:
+                cronometro.add("tls", resultado["tls"], clave=resultado["clave"])
+            bitacora.info(mensaje)
+        else:
+            bitacora.warning(mensaje)
+
+    # Guardar el último resultado de cada endpoint
+    if len(resultados) > 0:
+        try:
+            app.redis.hset(
+                "probar_endpoints:ultimos",
+                mapping={f"{resultado['clave']}:{resultado['endpoint']}": json.dumps(resultado) for resultado in resultados},
+            )
+        except RedisError as error:
+            bitacora.warning("No se pudieron guardar los resultados en Redis: %s", str(error))
+
+    # Actualizar las materias con las respuestas de consultar materias
     contador_exitosos = 0
-    contador_total = 0
     for exh_externo in exh_externos:
         if exh_externo.api_key == "":
             mensaje_advertencia = f"No hay api_key para {exh_externo.clave}"
@@ -72,29 +204,13 @@ def probar_endpoints(clave: str) -> tuple[str, str, str]:
             mensajes_termino.append(mensaje_advertencia)
             bitacora.warning(mensaje_advertencia)
             continue
-        bitacora.info("Probando %s...", exh_externo.clave)
-        mensaje_advertencia = ""
-        contador_total += 1
-        try:
-            response = requests.get(
-                exh_externo.endpoint_consultar_materias,
-                headers={"X-Api-Key": exh_externo.api_key},
-                timeout=TIMEOUT,
-            )
-            response.raise_for_status()
-        except requests.exceptions.ConnectionError as error:
-            mensaje_advertencia = f"Error de conexión {str(error)} para {exh_externo.clave}"
-        except requests.exceptions.Timeout:
-            mensaje_advertencia = f"Se acabó el tiempo de espera para {exh_externo.clave}"
-        except requests.exceptions.HTTPError as error:
-            mensaje_advertencia = f"Error HTTP {str(error)} para {exh_externo.clave}"
-        except requests.exceptions.RequestException as error:
-            mensaje_advertencia = f"Error de request {str(error)} para {exh_externo.clave}"
+        respuesta, mensaje_advertencia = respuestas_materias.get(
+            exh_externo.id, (None, f"No se consultaron las materias de {exh_externo.clave}")
+        )
         if mensaje_advertencia != "":
             mensajes_termino.append(mensaje_advertencia)
             bitacora.warning(mensaje_advertencia)
             continue
-        respuesta = response.json()
         consulta_materias_exitosa = False
         if "success" in respuesta:
             consulta_materias_exitosa = bool(respuesta["success"])
@@ -140,7 +256,8 @@ def probar_endpoints(clave: str) -> tuple[str, str, str]:
             continue
         if exh_externo.materias is None or exh_externo.materias != materias:
             exh_externo.materias = materias
-            exh_externo.save()
+            with cronometro.span("commit", clave=exh_externo.clave):
+                exh_externo.save()
             mensaje = f"Se actualizaron las materias de {exh_externo.clave}"
             mensajes_termino.append(mensaje)
             bitacora.info(mensaje)
@@ -150,8 +267,17 @@ def probar_endpoints(clave: str) -> tuple[str, str, str]:
             bitacora.info(mensaje)
         contador_exitosos += 1
 
+    # Refrescar el cache de materias que usan los formularios de exhortos
+    with cronometro.span("cache_materias"):
+        refrescar_cache_materias()
+
+    # Acumular los histogramas de tiempos por externo y etapa, y agregar el resumen a los mensajes
+    cronometro.save(app.redis, "cronometro:probar_endpoints")
+    mensajes_termino.extend(cronometro.summary())
+
     # Elaborar mensaje final
-    mensaje_final = f"Termina probar endpoints con {contador_exitosos} consultas exitosas."
+    mensaje_final = f"Termina probar endpoints con {contador_disponibles} de {len(resultados)} endpoints disponibles"
+    mensaje_final += f" y {contador_exitosos} consultas de materias exitosas."
     mensajes_termino.append(mensaje_final)
     bitacora.info(mensaje_final)
 
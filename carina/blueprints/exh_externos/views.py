@@ -4,20 +4,26 @@ Exh Externos, vistas
 
 import json
 
-from flask import Blueprint, flash, redirect, render_template, request, url_for
+from flask import Blueprint, current_app, flash, redirect, render_template, request, url_for
 from flask_login import current_user, login_required
 
 from carina.blueprints.bitacoras.models import Bitacora
+from carina.blueprints.exh_externos.cache import consultar_cache_materias, refrescar_cache_materias
 from carina.blueprints.exh_externos.forms import ExhExternoForm
 from carina.blueprints.exh_externos.models import ExhExterno
 from carina.blueprints.modulos.models import Modulo
 from carina.blueprints.permisos.models import Permiso
 from carina.blueprints.usuarios.decorators import permission_required
 from lib.datatables import get_datatable_parameters, output_datatable_json
+from lib.endpoint_health import EndpointHealth
+from lib.interop import HEALTH_PREFIX
 from lib.safe_string import safe_clave, safe_message, safe_string, safe_url
 
 MODULO = "EXH EXTERNOS"
 
+# Ventanas en horas que se pueden elegir en el tablero de salud
+SALUD_HORAS = (1, 24, 168, 720)
+
 exh_externos = Blueprint("exh_externos", __name__, template_folder="templates")
 
 
@@ -97,6 +103,34 @@ def list_inactive():
     )
 
 
+@exh_externos.route("/exh_externos/salud")
+def health():
+    """Tablero de salud con latencias p50, p95, p99 y disponibilidad de cada Externo y sus endpoints"""
+    horas = request.args.get("horas", 24, type=int)
+    if horas not in SALUD_HORAS:
+        horas = 24
+    salud = EndpointHealth(current_app.redis, prefix=HEALTH_PREFIX)
+    series = salud.series()
+    renglones = []
+    for exh_externo in ExhExterno.query.filter_by(estatus="A").order_by(ExhExterno.clave).all():
+        # Una sola lectura de Redis por externo, el total se acumula de los mismos buckets que sus endpoints
+        endpoints, total = salud.summaries(
+            exh_externo.clave,
+            [endpoint for clave, endpoint in series if clave == exh_externo.clave],
+            seconds=horas * 3600,
+        )
+        renglones.append(
+            {
+                "exh_externo": exh_externo,
+                "total": total,
+                "endpoints": [
+                    {"endpoint": endpoint, **resumen} for endpoint, resumen in endpoints.items() if resumen["count"] > 0
+                ],
+            }
+        )
+    return render_template("exh_externos/health.jinja2", renglones=renglones, horas=horas, salud_horas=SALUD_HORAS)
+
+
 @exh_externos.route("/exh_externos/<int:exh_externo_id>")
 def detail(exh_externo_id):
     """Detalle de un Externo"""
@@ -137,6 +171,7 @@ def new():
             endpoint_recibir_promocion_archivo=safe_url(form.endpoint_recibir_promocion_archivo.data),
         )
         exh_externo.save()
+        refrescar_cache_materias()
         bitacora = Bitacora(
             modulo=Modulo.query.filter_by(nombre=MODULO).first(),
             usuario=current_user,
@@ -188,6 +223,7 @@ def edit(exh_externo_id):
             exh_externo.endpoint_recibir_promocion = safe_url(form.endpoint_recibir_promocion.data)
             exh_externo.endpoint_recibir_promocion_archivo = safe_url(form.endpoint_recibir_promocion_archivo.data)
             exh_externo.save()
+            refrescar_cache_materias()
             bitacora = Bitacora(
                 modulo=Modulo.query.filter_by(nombre=MODULO).first(),
                 usuario=current_user,
@@ -222,6 +258,7 @@ def delete(exh_externo_id):
     exh_externo = ExhExterno.query.get_or_404(exh_externo_id)
     if exh_externo.estatus == "A":
         exh_externo.delete()
+        refrescar_cache_materias()
         bitacora = Bitacora(
             modulo=Modulo.query.filter_by(nombre=MODULO).first(),
             usuario=current_user,
@@ -240,6 +277,7 @@ def recover(exh_externo_id):
     exh_externo = ExhExterno.query.get_or_404(exh_externo_id)
     if exh_externo.estatus == "B":
         exh_externo.recover()
+        refrescar_cache_materias()
         bitacora = Bitacora(
             modulo=Modulo.query.filter_by(nombre=MODULO).first(),
             usuario=current_user,
@@ -260,6 +298,7 @@ def test_endpoints(exh_externo_id):
         comando="exh_externos.tasks.lanzar_probar_endpoints",
         mensaje="Probando endpoints",
         clave=exh_externo.clave,
+        llave_unica=exh_externo.clave,
     )
     flash("Se ha lanzado la tarea en el fondo. Esta página se va a recargar en 10 segundos...", "info")
     return redirect(url_for("tareas.detail", tarea_id=tarea.id))
@@ -271,12 +310,11 @@ def select_materias_json(estado_id=None):
     # Si estado_id es None, entonces no se entrega nada
     if estado_id is None:
         return json.dumps([])
-    # Consultar
-    consulta = ExhExterno.query.filter_by(estado_id=estado_id, estatus="A")
+    # Consultar en el cache de materias
+    cache_materias = consultar_cache_materias(estado_id)
     # Elaborar datos para Select
     data = []
-    resultado = consulta.first()
-    if resultado:
-        data = resultado.materias
+    if cache_materias is not None and cache_materias["estatus"] == "A":
+        data = cache_materias["materias"]
     # Entregar JSON
     return json.dumps(data)
@@ -3,19 +3,39 @@ Tareas, vistas
 """
 
 import json
-
-from flask import Blueprint, current_app, flash, make_response, redirect, render_template, request, url_for
+import time
+
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    flash,
+    redirect,
+    render_template,
+    request,
+    stream_with_context,
+    url_for,
+)
 from flask_login import current_user, login_required
+from redis.exceptions import RedisError
 
 from lib.datatables import get_datatable_parameters, output_datatable_json
+from lib.download import send_file_from_gcs
 from lib.exceptions import MyAnyError
-from lib.google_cloud_storage import get_blob_name_from_url, get_file_from_gcs
+from lib.google_cloud_storage import get_blob_name_from_url
+from lib.tasks import get_task_channel
 from carina.blueprints.permisos.models import Permiso
 from carina.blueprints.tareas.models import Tarea
 from carina.blueprints.usuarios.decorators import permission_required
 
 MODULO = "TAREAS"
 
+# Segundos que se espera un evento antes de cerrar la respuesta, el navegador se vuelve a conectar
+SEGUNDOS_ESPERA_EVENTO = 25
+
+# Milisegundos que espera el navegador para volver a conectarse
+MILISEGUNDOS_RECONEXION = 500
+
 tareas = Blueprint("tareas", __name__, template_folder="templates")
 
 
@@ -105,6 +125,58 @@ def detail(tarea_id):
     return render_template("tareas/detail.jinja2", tarea=tarea)
 
 
+@tareas.route("/tareas/<tarea_id>/eventos")
+@login_required
+def events(tarea_id):
+    """
+    Eventos del avance de una Tarea como Server-Sent Events
+
+    Cada respuesta entrega un solo evento y se cierra, o se cierra sin evento al pasar SEGUNDOS_ESPERA_EVENTO,
+    porque App Engine estándar no tiene websockets ni entrega las respuestas por pedazos.
+    EventSource se vuelve a conectar solo, con la secuencia del último evento en Last-Event-ID.
+    """
+    try:
+        secuencia = int(request.headers.get("Last-Event-ID", request.args.get("secuencia", "0")))
+    except ValueError:
+        secuencia = 0
+    canal = get_task_channel(tarea_id)
+
+    def elaborar_evento(evento: str) -> str:
+        """Elaborar el texto del evento"""
+        return f"retry: {MILISEGUNDOS_RECONEXION}\nid: {json.loads(evento)['secuencia']}\ndata: {evento}\n\n"
+
+    def esperar_evento():
+        """Entregar el último evento si es nuevo o esperar el siguiente que se publique"""
+        try:
+            # Suscribirse antes de leer el último evento para no perder uno que se publique en medio
+            pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(canal)
+            try:
+                ultimo = current_app.redis.get(canal)
+                if ultimo is not None and json.loads(ultimo)["secuencia"] > secuencia:
+                    yield elaborar_evento(ultimo.decode("utf-8"))
+                    return
+                limite = time.monotonic() + SEGUNDOS_ESPERA_EVENTO
+                while time.monotonic() < limite:
+                    mensaje = pubsub.get_message(timeout=limite - time.monotonic())
+                    if mensaje is not None and json.loads(mensaje["data"])["secuencia"] > secuencia:
+                        yield elaborar_evento(mensaje["data"].decode("utf-8"))
+                        return
+            finally:
+                pubsub.close()
+        except RedisError:
+            # Sin Redis se pide al navegador que espere más para volver a conectarse
+            yield f"retry: {SEGUNDOS_ESPERA_EVENTO * 1000}\n\n"
+            return
+        yield f"retry: {MILISEGUNDOS_RECONEXION}\n: sin cambios\n\n"
+
+    return Response(
+        stream_with_context(esperar_evento()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @tareas.route("/tareas/<tarea_id>/xlsx")
 @login_required
 def download_xlsx(tarea_id):
@@ -129,18 +201,14 @@ def download_xlsx(tarea_id):
         flash("Esta tarea no tiene un archivo XLSX para descargar", "warning")
         return redirect(url_for("tareas.detail", tarea_id=tarea.id))
 
-    # Obtener el contenido del archivo desde Google Storage
+    # Descargar el archivo XLSX desde Google Storage, con un URL firmado o por partes
     try:
-        descarga_contenido = get_file_from_gcs(
+        return send_file_from_gcs(
             bucket_name=current_app.config["CLOUD_STORAGE_DEPOSITO"],
             blob_name=get_blob_name_from_url(tarea.url),
+            filename=descarga_nombre,
+            content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         )
     except MyAnyError as error:
         flash(str(error), "danger")
         return redirect(url_for("tareas.detail", tarea_id=tarea.id))
-
-    # Descargar un archivo XLSX
-    response = make_response(descarga_contenido)
-    response.headers["Content-Type"] = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    response.headers["Content-Disposition"] = f"attachment; filename={descarga_nombre}"
-    return response
@@ -2,11 +2,13 @@
 Usuarios, modelos
 """
 
+import uuid
 from datetime import datetime
 from typing import List, Optional
 
 from flask import current_app
 from flask_login import UserMixin
+from redis.exceptions import RedisError
 from sqlalchemy import ForeignKey, String
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
@@ -14,6 +16,7 @@ from carina.blueprints.permisos.models import Permiso
 from carina.blueprints.tareas.models import Tarea
 from carina.blueprints.usuarios_roles.models import UsuarioRol
 from carina.extensions import database, pwd_context
+from lib.tasks import get_task_lock, lock_task
 from lib.universal_mixin import UniversalMixin
 
 
@@ -138,9 +141,20 @@ class Usuario(database.Model, UserMixin, UniversalMixin):
         usuarios_roles = UsuarioRol.query.filter_by(usuario_id=self.id).filter_by(estatus="A").all()
         return [usuario_rol.rol.nombre for usuario_rol in usuarios_roles]
 
-    def launch_task(self, comando, mensaje, *args, **kwargs):
-        """Lanzar tarea en el fondo"""
-        rq_job = current_app.task_queue.enqueue(f"carina.blueprints.{comando}", *args, **kwargs)
+    def launch_task(self, comando, mensaje, *args, llave_unica: str = "", **kwargs):
+        """Lanzar tarea en el fondo, con llave_unica si ya hay una equivalente en la cola o en ejecución se entrega esa"""
+        job_id = str(uuid.uuid4())
+        meta = {}
+        if llave_unica != "":
+            llave = get_task_lock(comando, llave_unica)
+            try:
+                tarea = lock_task(current_app.redis, llave, job_id)
+                if tarea is not None:
+                    return tarea
+                meta["llave_unica"] = llave
+            except RedisError:
+                pass  # Sin Redis no se puede encolar, el error lo da enqueue
+        rq_job = current_app.task_queue.enqueue(f"carina.blueprints.{comando}", *args, job_id=job_id, meta=meta, **kwargs)
         tarea = Tarea(id=rq_job.get_id(), comando=comando, mensaje=mensaje, usuario=self)
         tarea.save()
         return tarea
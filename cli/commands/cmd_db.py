@@ -8,7 +8,7 @@ import sys
 import click
 from dotenv import load_dotenv
 
-from carina.app import create_app
+from carina.app import get_or_create_app
 from carina.extensions import database
 from cli.commands.alimentar_autoridades import alimentar_autoridades
 from cli.commands.alimentar_distritos import alimentar_distritos, eliminar_distritos_sin_autoridades
@@ -34,7 +34,7 @@ from cli.commands.respaldar_oficinas import respaldar_oficinas
 from cli.commands.respaldar_roles_permisos import respaldar_roles_permisos
 from cli.commands.respaldar_usuarios_roles import respaldar_usuarios_roles
 
-app = create_app()
+app = get_or_create_app()
 app.app_context().push()
 database.app = app
 
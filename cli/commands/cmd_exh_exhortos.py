@@ -6,13 +6,13 @@ import sys
 
 import click
 
-from carina.app import create_app
+from carina.app import get_or_create_app
 from carina.blueprints.exh_exhortos.tasks import consultar as task_consultar
 from carina.blueprints.exh_exhortos.tasks import enviar as task_enviar
 from carina.extensions import database
 from lib.exceptions import MyAnyError
 
-app = create_app()
+app = get_or_create_app()
 app.app_context().push()
 database.app = app
 
@@ -23,13 +23,13 @@ def cli():
 
 
 @click.command()
-@click.option("--folio_seguimiento", type=str, help="folio de seguimiento de un exhorto")
+@click.option("--folio_seguimiento", type=str, default="", help="folio de seguimiento de un exhorto")
 def consultar(folio_seguimiento: str):
     """Consultar un exhorto o todos los exhortos con estado RECIBIDO CON EXITO"""
 
     # Ejecutar la tarea
     try:
-        mensaje_termino, _, _ = task_consultar(folio_seguimiento)
+        mensaje_termino, _, _ = task_consultar(folio_seguimiento=folio_seguimiento)
     except MyAnyError as error:
         click.echo(click.style(str(error), fg="red"))
         sys.exit(1)
@@ -39,13 +39,14 @@ def consultar(folio_seguimiento: str):
 
 
 @click.command()
-@click.option("--exhorto_origen_id", type=str, help="Exhorto origen ID")
-def enviar(exhorto_origen_id: str = ""):
+@click.option("--exhorto_origen_id", type=str, default="", help="Exhorto origen ID")
+@click.option("--paralelo", is_flag=True, help="Enviar en paralelo agrupando por externo")
+def enviar(exhorto_origen_id: str, paralelo: bool):
     """Enviar un exhorto o todos los exhortos con estado POR ENVIAR"""
 
     # Ejecutar la tarea
     try:
-        mensaje_termino, _, _ = task_enviar(exhorto_origen_id)
+        mensaje_termino, _, _ = task_enviar(exhorto_origen_id, en_paralelo=paralelo)
     except MyAnyError as error:
         click.echo(click.style(str(error), fg="red"))
         sys.exit(1)
@@ -6,12 +6,12 @@ import sys
 
 import click
 
-from carina.app import create_app
+from carina.app import get_or_create_app
 from carina.blueprints.exh_externos.tasks import probar_endpoints as task_probar_endpoints
 from carina.extensions import database
 from lib.exceptions import MyAnyError
 
-app = create_app()
+app = get_or_create_app()
 app.app_context().push()
 database.app = app
 
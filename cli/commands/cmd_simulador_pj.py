@@ -0,0 +1,306 @@
+"""
+CLI Simulador PJ
+
+Un PJ externo simulado en local para medir el envío de exhortos sin llamar a los PJ reales
+
+- servir: levanta el simulador para usarlo con los endpoints de un exh_externo
+- medir_enviar: siembra exhortos de prueba, los envía al simulador y reporta exhortos/minuto, bytes/segundo y memoria
+"""
+
+import hashlib
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import uuid
+
+import click
+import requests
+from sqlalchemy import func
+
+from carina.app import get_or_create_app
+from carina.blueprints.autoridades.models import Autoridad
+from carina.blueprints.estados.models import Estado
+from carina.blueprints.exh_areas.models import ExhArea
+from carina.blueprints.exh_exhortos.models import ExhExhorto
+from carina.blueprints.exh_exhortos.tasks import (
+    enviar_reservados,
+    liberar_reserva,
+    reservar_por_enviar,
+    sin_programar_reintentos,
+)
+from carina.blueprints.exh_exhortos_archivos.models import ExhExhortoArchivo
+from carina.blueprints.exh_exhortos_partes.models import ExhExhortoParte
+from carina.blueprints.exh_externos.models import ExhExterno
+from carina.blueprints.municipios.models import Municipio
+from carina.extensions import database
+from lib.exceptions import MyAnyError
+from lib.google_cloud_storage import delete_file_from_gcs, upload_file_to_gcs
+from lib.mock_pj import make_mock_pj_server
+from lib.stage_timer import StageTimer
+
+app = get_or_create_app()
+app.app_context().push()
+database.app = app
+
+BENCHMARK_CLAVE = "BENCHMARK"
+BENCHMARK_ESTADO_CLAVE = "99"
+BENCHMARK_API_KEY = "benchmark"
+BENCHMARK_DIRECTORIO = "benchmark"  # Directorio en el depósito del PDF de prueba
+ALMACENES_PERMITIDOS = ("local", "memoria")  # Para no subir el PDF de prueba al depósito real
+
+
+@click.group()
+def cli():
+    """Simulador PJ"""
+
+
+@click.command()
+@click.option("--host", type=str, default="127.0.0.1", help="Host")
+@click.option("--port", type=int, default=5099, help="Puerto")
+@click.option("--latencia", type=float, default=0.0, help="Segundos de espera en cada respuesta")
+@click.option("--variacion", type=float, default=0.0, help="Segundos aleatorios que se suman a la latencia")
+@click.option("--tasa_errores", type=float, default=0.0, help="Probabilidad de 0 a 1 de responder con error 500")
+@click.option("--tasa_rechazos", type=float, default=0.0, help="Probabilidad de 0 a 1 de rechazar un exhorto")
+@click.option("--api_key", type=str, default="", help="Si se da, se exige en el encabezado X-Api-Key")
+def servir(host, port, latencia, variacion, tasa_errores, tasa_rechazos, api_key):
+    """Levantar el PJ externo simulado"""
+    servidor = make_mock_pj_server(
+        host,
+        port,
+        latency=latencia,
+        latency_jitter=variacion,
+        error_rate=tasa_errores,
+        reject_rate=tasa_rechazos,
+        api_key=api_key,
+    )
+    click.echo(f"Simulador PJ en http://{host}:{servidor.server_port}")
+    click.echo("  endpoint_consultar_materias:      /materias")
+    click.echo("  endpoint_recibir_exhorto:         /exh_exhortos")
+    click.echo("  endpoint_recibir_exhorto_archivo: /exh_exhortos/archivos")
+    click.echo("  endpoint_consultar_exhorto:       /exh_exhortos")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        servidor.shutdown()
+
+
+def sembrar_externo(url_base: str) -> Municipio:
+    """Crear o actualizar el estado, municipio y externo BENCHMARK que apuntan al simulador, entrega el municipio"""
+    estado = Estado.query.filter_by(clave=BENCHMARK_ESTADO_CLAVE).first()
+    if estado is None:
+        estado = Estado(clave=BENCHMARK_ESTADO_CLAVE, nombre=BENCHMARK_CLAVE).save()
+    municipio = Municipio.query.filter_by(estado_id=estado.id).filter_by(clave="001").first()
+    if municipio is None:
+        municipio = Municipio(estado_id=estado.id, clave="001", nombre=BENCHMARK_CLAVE).save()
+    exh_externo = ExhExterno.query.filter_by(clave=BENCHMARK_CLAVE).first()
+    if exh_externo is None:
+        exh_externo = ExhExterno(estado_id=estado.id, clave=BENCHMARK_CLAVE, descripcion="PJ SIMULADO PARA MEDICIONES")
+    exh_externo.estatus = "A"
+    exh_externo.api_key = BENCHMARK_API_KEY
+    exh_externo.endpoint_consultar_materias = f"{url_base}/materias"
+    exh_externo.endpoint_recibir_exhorto = f"{url_base}/exh_exhortos"
+    exh_externo.endpoint_recibir_exhorto_archivo = f"{url_base}/exh_exhortos/archivos"
+    exh_externo.endpoint_consultar_exhorto = f"{url_base}/exh_exhortos"
+    exh_externo.save()
+    return municipio
+
+
+def sembrar_exhortos(municipio_destino: Municipio, cantidad: int, archivos: int, tamano: int) -> list[int]:
+    """Crear los exhortos POR ENVIAR con sus partes y archivos, todos los archivos apuntan al mismo PDF de prueba"""
+
+    # Tomar los datos de origen que ya existen
+    autoridad = Autoridad.query.filter_by(estatus="A").first()
+    exh_area = ExhArea.query.filter_by(estatus="A").first()
+    estado_origen = Estado.query.filter_by(clave=app.config["ESTADO_CLAVE"]).first()
+    if autoridad is None or exh_area is None or estado_origen is None:
+        raise MyAnyError("Faltan autoridades, exh_areas o el estado de ESTADO_CLAVE para sembrar los exhortos")
+    municipio_origen = Municipio.query.filter_by(estado_id=estado_origen.id).order_by(Municipio.id).first()
+
+    # Subir un PDF de prueba del tamaño pedido
+    contenido = b"%PDF-1.4\n" + os.urandom(max(tamano * 1024 - 9, 0))
+    url = upload_file_to_gcs(
+        bucket_name=app.config["CLOUD_STORAGE_DEPOSITO"],
+        blob_name=f"{BENCHMARK_DIRECTORIO}/archivo-{tamano}kb.pdf",
+        content_type="application/pdf",
+        data=contenido,
+    )
+    hash_sha1 = hashlib.sha1(contenido).hexdigest()
+    hash_sha256 = hashlib.sha256(contenido).hexdigest()
+
+    # Crear los exhortos
+    exh_exhortos_ids = []
+    for _ in range(cantidad):
+        exh_exhorto = ExhExhorto(
+            autoridad_id=autoridad.id,
+            exh_area_id=exh_area.id,
+            materia_clave="CIV",
+            materia_nombre="CIVIL",
+            municipio_origen_id=municipio_origen.id,
+            exhorto_origen_id=f"{BENCHMARK_CLAVE}-{uuid.uuid4()}",
+            municipio_destino_id=municipio_destino.id,
+            numero_expediente_origen="1/2024",
+            tipo_juicio_asunto_delitos=BENCHMARK_CLAVE,
+            estado="POR ENVIAR",
+            remitente="INTERNO",
+        )
+        database.session.add(exh_exhorto)
+        database.session.flush()
+        database.session.add(
+            ExhExhortoParte(
+                exh_exhorto_id=exh_exhorto.id,
+                nombre=BENCHMARK_CLAVE,
+                genero="M",
+                es_persona_moral=False,
+                tipo_parte=1,
+            )
+        )
+        for numero in range(archivos):
+            database.session.add(
+                ExhExhortoArchivo(
+                    exh_exhorto_id=exh_exhorto.id,
+                    nombre_archivo=f"archivo-{numero + 1}.pdf",
+                    hash_sha1=hash_sha1,
+                    hash_sha256=hash_sha256,
+                    tipo_documento=1,
+                    estado="PENDIENTE",
+                    url=url,
+                    tamano=len(contenido),
+                )
+            )
+        database.session.flush()
+        exh_exhorto.guardar_payload(municipio_destino)
+        exh_exhortos_ids.append(exh_exhorto.id)
+    database.session.commit()
+    return exh_exhortos_ids
+
+
+def borrar_exhortos(exh_exhortos_ids: list[int], tamano: int):
+    """Borrar físicamente los exhortos sembrados con sus partes y archivos, el PDF de prueba y el externo BENCHMARK"""
+
+    # Borrar los exhortos con sus partes y archivos
+    ExhExhortoArchivo.query.filter(ExhExhortoArchivo.exh_exhorto_id.in_(exh_exhortos_ids)).delete(synchronize_session=False)
+    ExhExhortoParte.query.filter(ExhExhortoParte.exh_exhorto_id.in_(exh_exhortos_ids)).delete(synchronize_session=False)
+    ExhExhorto.query.filter(ExhExhorto.id.in_(exh_exhortos_ids)).delete(synchronize_session=False)
+
+    # Borrar el externo, y el municipio y el estado si ya no los usan los exhortos conservados de otras mediciones
+    ExhExterno.query.filter_by(clave=BENCHMARK_CLAVE).delete(synchronize_session=False)
+    estado = Estado.query.filter_by(clave=BENCHMARK_ESTADO_CLAVE).first()
+    if estado is not None:
+        municipios_ids = [municipio.id for municipio in Municipio.query.filter_by(estado_id=estado.id).all()]
+        if ExhExhorto.query.filter(ExhExhorto.municipio_destino_id.in_(municipios_ids)).count() == 0:
+            Municipio.query.filter(Municipio.id.in_(municipios_ids)).delete(synchronize_session=False)
+            Estado.query.filter_by(id=estado.id).delete(synchronize_session=False)
+        else:
+            Municipio.query.filter(Municipio.id.in_(municipios_ids)).update({"estatus": "B"}, synchronize_session=False)
+            estado.estatus = "B"
+    database.session.commit()
+
+    # Borrar el PDF de prueba
+    delete_file_from_gcs(app.config["CLOUD_STORAGE_DEPOSITO"], f"{BENCHMARK_DIRECTORIO}/archivo-{tamano}kb.pdf")
+
+
+def desactivar_externo():
+    """Desactivar el externo BENCHMARK para que no se le envíen exhortos ni se pruebe su puerto que ya no existe"""
+    exh_externo = ExhExterno.query.filter_by(clave=BENCHMARK_CLAVE).first()
+    if exh_externo is not None:
+        exh_externo.estatus = "B"
+        exh_externo.save()
+
+
+@click.command()
+@click.option("--cantidad", type=int, default=20, help="Cantidad de exhortos")
+@click.option("--archivos", type=int, default=2, help="Cantidad de archivos por exhorto")
+@click.option("--tamano", type=int, default=512, help="Tamaño de cada archivo en KB")
+@click.option("--paralelo", is_flag=True, help="Enviar en paralelo agrupando por externo")
+@click.option("--latencia", type=float, default=0.0, help="Segundos de espera en cada respuesta del simulador")
+@click.option("--tasa_errores", type=float, default=0.0, help="Probabilidad de 0 a 1 de responder con error 500")
+@click.option("--tasa_rechazos", type=float, default=0.0, help="Probabilidad de 0 a 1 de rechazar un exhorto")
+@click.option("--conservar", is_flag=True, help="No borrar los exhortos sembrados al terminar, el externo se desactiva")
+def medir_enviar(cantidad, archivos, tamano, paralelo, latencia, tasa_errores, tasa_rechazos, conservar):
+    """Sembrar exhortos, enviarlos al simulador y reportar el rendimiento"""
+
+    # Validar que el almacén sea local o en memoria
+    if app.config["ALMACEN_BACKEND"] not in ALMACENES_PERMITIDOS:
+        mensaje = f"Use ALMACEN_BACKEND {' o '.join(ALMACENES_PERMITIDOS)} para no subir el PDF de prueba al depósito real"
+        click.echo(click.style(mensaje, fg="red"))
+        sys.exit(1)
+
+    # Levantar el simulador en otro proceso con un puerto libre, para que su memoria no se cuente en el pico de RSS
+    servidor = make_mock_pj_server(
+        "127.0.0.1",
+        0,
+        quiet=True,
+        latency=latencia,
+        error_rate=tasa_errores,
+        reject_rate=tasa_rechazos,
+        api_key=BENCHMARK_API_KEY,
+    )
+    url_base = f"http://127.0.0.1:{servidor.server_port}"
+    simulador = multiprocessing.get_context("fork").Process(target=servidor.serve_forever, daemon=True)
+    simulador.start()
+    servidor.server_close()
+
+    # Sembrar
+    try:
+        municipio_destino = sembrar_externo(url_base)
+        exh_exhortos_ids = sembrar_exhortos(municipio_destino, cantidad, archivos, tamano)
+    except MyAnyError as error:
+        simulador.terminate()
+        borrar_exhortos([], tamano)
+        click.echo(click.style(str(error), fg="red"))
+        sys.exit(1)
+    click.echo(f"Se sembraron {len(exh_exhortos_ids)} exhortos con {archivos} archivos de {tamano} KB cada uno")
+
+    try:
+        # Enviar solo los exhortos sembrados, nunca los POR ENVIAR reales, sin programar reintentos en la cola
+        # ru_maxrss está en KB en Linux, se toma antes de enviar para reportar cuánto creció durante el envío
+        cronometro = StageTimer()
+        rss_inicial_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        tiempo_inicial = time.perf_counter()
+        reservador, reservados_ids = reservar_por_enviar(ExhExhorto.query.filter(ExhExhorto.id.in_(exh_exhortos_ids)))
+        try:
+            with sin_programar_reintentos():
+                enviar_reservados(reservados_ids, paralelo, reservador, cronometro)
+        finally:
+            liberar_reserva(reservador, reservados_ids)
+        segundos = time.perf_counter() - tiempo_inicial
+        pico_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        # Contar lo recibido con éxito y los bytes enviados
+        database.session.expire_all()
+        exitosos = ExhExhorto.query.filter(ExhExhorto.id.in_(exh_exhortos_ids)).filter_by(estado="RECIBIDO CON EXITO").count()
+        bytes_enviados = (
+            ExhExhortoArchivo.query.filter(ExhExhortoArchivo.exh_exhorto_id.in_(exh_exhortos_ids))
+            .filter(ExhExhortoArchivo.envio_tiempo.isnot(None))
+            .with_entities(func.coalesce(func.sum(ExhExhortoArchivo.tamano), 0))
+            .scalar()
+        )
+        estadisticas = requests.get(f"{url_base}/estadisticas", timeout=5).json()
+    finally:
+        # Limpiar, al conservar los exhortos el externo queda desactivado porque su puerto ya no existe
+        simulador.terminate()
+        simulador.join()
+        if conservar:
+            desactivar_externo()
+        else:
+            borrar_exhortos(exh_exhortos_ids, tamano)
+
+    # Reportar
+    click.echo(click.style(f"Exhortos recibidos con éxito: {exitosos} de {len(exh_exhortos_ids)}", fg="green"))
+    click.echo(click.style(f"Tiempo:          {segundos:.2f} s", fg="green"))
+    click.echo(click.style(f"Exhortos/minuto: {exitosos * 60 / segundos:.1f}", fg="green"))
+    click.echo(click.style(f"Bytes/segundo:   {bytes_enviados / segundos:,.0f}", fg="green"))
+    click.echo(
+        click.style(
+            f"Pico de RSS:     {pico_rss_mb:.1f} MB, {pico_rss_mb - rss_inicial_mb:.1f} MB durante el envío", fg="green"
+        )
+    )
+    click.echo(f"Simulador: {estadisticas}")
+    for linea in cronometro.summary():
+        click.echo(linea)
+
+
+cli.add_command(servir)
+cli.add_command(medir_enviar)
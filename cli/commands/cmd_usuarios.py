@@ -7,12 +7,12 @@ from datetime import datetime, timedelta
 
 import click
 
-from carina.app import create_app
+from carina.app import get_or_create_app
 from carina.blueprints.usuarios.models import Usuario
 from carina.extensions import database, pwd_context
 from lib.pwgen import generar_api_key
 
-app = create_app()
+app = get_or_create_app()
 app.app_context().push()
 database.app = app
 
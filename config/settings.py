@@ -22,6 +22,19 @@ Para desarrollo, debe crear un archivo .env con las variables de entorno:
 - SECRET_KEY
 - SQLALCHEMY_DATABASE_URI
 - TASK_QUEUE
+
+Opcionalmente, como variables de entorno, puede ajustar:
+
+- INTEROP_TASA: peticiones por segundo hacia cada PJ externo, por defecto 2.0
+- INTEROP_RAFAGA: peticiones seguidas permitidas hacia cada PJ externo, por defecto 5
+- INTEROP_CIRCUITO_FALLAS: fallas seguidas para dejar de llamar a un PJ externo, por defecto 3
+- INTEROP_CIRCUITO_SEGUNDOS: segundos sin llamar a un PJ externo antes de volver a probarlo, por defecto 300
+- ALMACEN_BACKEND: dónde se guardan los archivos, "gcs", "local" o "memoria", por defecto gcs
+- ALMACEN_DIRECTORIO: directorio de los archivos cuando ALMACEN_BACKEND es local
+- CACHE_DISCO_DIRECTORIO: directorio del cache en disco de los archivos del storage, por defecto vacío que lo desactiva
+- CACHE_DISCO_MEGABYTES: tamaño máximo del cache en disco, por defecto 1024
+- DESCARGAS_MODO: "firmado" redirige a un URL firmado de Cloud Storage, "flujo" envía el archivo por partes, por defecto firmado
+- DESCARGAS_SEGUNDOS: segundos de validez del URL firmado, por defecto 300
 """
 
 import os
@@ -61,9 +74,19 @@ def get_secret(secret_id: str, default: str = "") -> str:
 class Settings(BaseSettings):
     """Settings"""
 
+    ALMACEN_BACKEND: str = "gcs"
+    ALMACEN_DIRECTORIO: str = ""
+    CACHE_DISCO_DIRECTORIO: str = ""
+    CACHE_DISCO_MEGABYTES: int = 1024
     CLOUD_STORAGE_DEPOSITO: str = get_secret("cloud_storage_deposito")
+    DESCARGAS_MODO: str = "firmado"
+    DESCARGAS_SEGUNDOS: int = 300
     ESTADO_CLAVE: str = get_secret("estado_clave", "05")  # Por defecto es 05 que es Coahuila de Zaragoza
     HOST: str = get_secret("host")
+    INTEROP_CIRCUITO_FALLAS: int = 3
+    INTEROP_CIRCUITO_SEGUNDOS: int = 300
+    INTEROP_RAFAGA: int = 5
+    INTEROP_TASA: float = 2.0
     REDIS_URL: str = get_secret("redis_url")
     SALT: str = get_secret("salt")
     SECRET_KEY: str = get_secret("secret_key")
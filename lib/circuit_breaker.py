@@ -0,0 +1,119 @@
+"""
+Circuit Breaker
+
+Health state per key kept in Redis, so every rq worker knows when a remote is down
+
+- closed: requests go through, consecutive failures are counted
+- open: after failure_threshold consecutive failures, requests fail fast for open_seconds
+- half_open: after open_seconds a single request is let through as a probe,
+  if it succeeds the circuit closes, if it fails the circuit opens again
+
+    circuit_breaker = CircuitBreaker(current_app.redis, failure_threshold=3, open_seconds=300)
+    if circuit_breaker.allow("JALISCO"):
+        ...
+        circuit_breaker.record_success("JALISCO")  # or record_failure("JALISCO")
+
+"""
+
+import logging
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+bitacora = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Returns 1 if the request is allowed, when the open time is over only one caller becomes the probe
+ALLOW_SCRIPT = """
+local state = redis.call('HGET', KEYS[1], 'state')
+if not state or state == 'closed' then
+    return 1
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1])
+local opened_at = tonumber(redis.call('HGET', KEYS[1], 'opened_at')) or 0
+if now - opened_at < tonumber(ARGV[1]) then
+    return 0
+end
+if redis.call('SET', KEYS[2], '1', 'NX', 'EX', ARGV[1]) then
+    redis.call('HSET', KEYS[1], 'state', 'half_open')
+    return 1
+end
+return 0
+"""
+
+# Counts a failure, opens the circuit at the threshold or when the probe fails
+FAILURE_SCRIPT = """
+local state = redis.call('HGET', KEYS[1], 'state')
+local time = redis.call('TIME')
+local now = tonumber(time[1])
+if state == 'half_open' then
+    redis.call('HSET', KEYS[1], 'state', 'open', 'opened_at', now)
+    redis.call('DEL', KEYS[2])
+    return 'open'
+end
+local failures = redis.call('HINCRBY', KEYS[1], 'failures', 1)
+if failures >= tonumber(ARGV[1]) and state ~= 'open' then
+    redis.call('HSET', KEYS[1], 'state', 'open', 'opened_at', now)
+    return 'open'
+end
+return state or 'closed'
+"""
+
+
+class CircuitBreaker:
+    """Circuit breaker backed by Redis"""
+
+    def __init__(self, redis: Redis, failure_threshold: int, open_seconds: int, prefix: str = "circuit_breaker") -> None:
+        """Circuit breaker constructor"""
+        self.redis = redis
+        self.failure_threshold = max(failure_threshold, 1)
+        self.open_seconds = max(open_seconds, 1)
+        self.prefix = prefix
+        self.allow_script = redis.register_script(ALLOW_SCRIPT)
+        self.failure_script = redis.register_script(FAILURE_SCRIPT)
+
+    def _keys(self, key: str) -> list[str]:
+        """Redis keys for the state and the probe lock"""
+        return [f"{self.prefix}:{key}", f"{self.prefix}:{key}:probe"]
+
+    def allow(self, key: str) -> bool:
+        """If a request to the key can be made now"""
+        try:
+            return bool(self.allow_script(keys=self._keys(key), args=[self.open_seconds]))
+        except RedisError as error:
+            # Without Redis do not block the requests
+            bitacora.warning("Circuit breaker without Redis for %s: %s", key, str(error))
+            return True
+
+    def record_success(self, key: str) -> None:
+        """A request succeeded, close the circuit"""
+        try:
+            self.redis.delete(*self._keys(key))
+        except RedisError as error:
+            bitacora.warning("Circuit breaker without Redis for %s: %s", key, str(error))
+
+    def record_failure(self, key: str) -> str:
+        """A request failed, returns the new state"""
+        try:
+            state = self.failure_script(keys=self._keys(key), args=[self.failure_threshold])
+        except RedisError as error:
+            bitacora.warning("Circuit breaker without Redis for %s: %s", key, str(error))
+            return CLOSED
+        state = state.decode("utf-8") if isinstance(state, bytes) else str(state)
+        if state == OPEN:
+            bitacora.warning("Circuit breaker open for %s", key)
+        return state
+
+    def get_state(self, key: str) -> str:
+        """Current state of the key"""
+        try:
+            state = self.redis.hget(self._keys(key)[0], "state")
+        except RedisError:
+            return CLOSED
+        if state is None:
+            return CLOSED
+        return state.decode("utf-8")
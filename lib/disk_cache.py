@@ -0,0 +1,249 @@
+"""
+Disk Cache
+
+Local cache of files addressed by their SHA-256, to read again the same files of the storage from the disk
+
+    disk_cache = DiskCache("/var/cache/carina", max_bytes=1024 * 1024 * 1024)
+    disk_cache.put(sha256, blob.download_to_file)
+    fileobj, size = disk_cache.open(sha256)
+    reader = disk_cache.tee(sha256, blob.open("rb"), blob.size)  # Saved while it is read
+
+
+- Every file is saved as {directory}/{sha256[:2]}/{sha256}
+- A file is written in a temporary file of the same directory and moved with an atomic rename,
+  only if its SHA-256 matches, then another process never reads a half written file
+- With tee a file is saved while it is read from the storage, the first bytes go out before
+  the whole file is downloaded; it is saved only if it was read from the beginning to the end
+- When read, the SHA-256 is checked again, a damaged file is removed and reads as a miss
+- Reading a file touches its modification time, when the total size goes over max_bytes
+  the least recently read files are removed until it is under MARGIN of max_bytes
+- The removal takes a fcntl lock on {directory}/.lock, it can be shared between the
+  processes of gunicorn and rq on the same node
+
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+from typing import BinaryIO, Callable, Optional
+
+CHUNK_SIZE = 1024 * 1024  # 1 MB read at a time to check the SHA-256
+MARGIN = 0.9  # The removal leaves the cache at 90% of max_bytes
+TEMPORARY_PREFIX = ".tmp-"
+TEMPORARY_SECONDS = 3600  # Temporary files older than this were left by a dead process
+
+SHA256_REGEXP = re.compile(r"^[0-9a-f]{64}$")
+
+bitacora = logging.getLogger(__name__)
+
+
+class HashingWriter:
+    """File-like writer that computes the SHA-256 of what goes through it"""
+
+    def __init__(self, fileobj: BinaryIO) -> None:
+        """Hashing writer constructor"""
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        """Write and hash"""
+        self.sha256.update(data)
+        return self.fileobj.write(data)
+
+
+class CachingReader:
+    """File-like reader that writes what is read in a temporary file of the cache, and saves it when the end is reached"""
+
+    def __init__(self, disk_cache: "DiskCache", sha256: str, fileobj: BinaryIO, size: int) -> None:
+        """Caching reader constructor, the reader must be at its beginning"""
+        self.disk_cache = disk_cache
+        self.sha256 = sha256
+        self.fileobj = fileobj
+        self.size = size
+        self.position = 0
+        self.path = disk_cache._path(sha256)
+        self.path.parent.mkdir(exist_ok=True)
+        descriptor, self.temporary = tempfile.mkstemp(prefix=TEMPORARY_PREFIX, dir=self.path.parent)
+        self.writer = HashingWriter(os.fdopen(descriptor, "wb"))
+
+    def _discard(self) -> None:
+        """Stop writing and remove the temporary file"""
+        if self.writer is not None:
+            self.writer.fileobj.close()
+            self.writer = None
+            if os.path.exists(self.temporary):
+                os.unlink(self.temporary)
+
+    def _save(self) -> None:
+        """Move the temporary file to its place if its SHA-256 matches"""
+        writer = self.writer
+        writer.fileobj.close()
+        self.writer = None
+        try:
+            if writer.sha256.hexdigest() != self.sha256:
+                bitacora.warning("Disk cache did not save %s because its SHA-256 is %s", self.sha256, writer.sha256.hexdigest())
+                return
+            os.replace(self.temporary, self.path)
+        finally:
+            if os.path.exists(self.temporary):
+                os.unlink(self.temporary)
+        self.disk_cache.prune()
+
+    def read(self, size: int = -1) -> bytes:
+        """Read from the reader and write in the temporary file, at the end save it"""
+        data = self.fileobj.read(size)
+        if self.writer is not None:
+            try:
+                self.writer.write(data)
+                self.position += len(data)
+                if self.position >= self.size or not data:
+                    self._save()
+            except OSError as error:
+                bitacora.warning("Disk cache could not save %s: %s", self.sha256, str(error))
+                self._discard()
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        """Seek the reader, a jump stops the writing because the file would not be whole"""
+        position = self.fileobj.seek(offset, whence)
+        if self.writer is not None and position != self.position:
+            self._discard()
+        return position
+
+    def tell(self) -> int:
+        """Position of the reader"""
+        return self.fileobj.tell()
+
+    def close(self) -> None:
+        """Close the reader, a file not read to the end is not saved"""
+        self._discard()
+        self.fileobj.close()
+
+    def __enter__(self):
+        """Enter the context"""
+        return self
+
+    def __exit__(self, *args) -> None:
+        """Close on exit"""
+        self.close()
+
+
+class DiskCache:
+    """Content addressed disk cache with a size cap"""
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        """Disk cache constructor, creates the directory if it does not exist"""
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, sha256: str) -> Path:
+        """Path of a file"""
+        return self.directory / sha256[:2] / sha256
+
+    def open(self, sha256: str) -> Optional[tuple[BinaryIO, int]]:
+        """
+        Open a file of the cache after checking its SHA-256
+
+        :param sha256: SHA-256 of the file in hexadecimal
+        :return: File opened for reading and its size in bytes, or None if it is not in the cache
+        """
+        sha256 = sha256.lower()
+        if SHA256_REGEXP.match(sha256) is None:
+            return None
+        path = self._path(sha256)
+        try:
+            fileobj = open(path, "rb")
+        except OSError:
+            return None
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+        if digest.hexdigest() != sha256:
+            fileobj.close()
+            bitacora.warning("Disk cache removed the damaged file %s", sha256)
+            path.unlink(missing_ok=True)
+            return None
+        size = fileobj.tell()
+        fileobj.seek(0)
+        try:
+            os.utime(path)
+        except OSError:
+            pass  # Removed by another process, the opened file can still be read
+        return fileobj, size
+
+    def put(self, sha256: str, write: Callable[[BinaryIO], None]) -> bool:
+        """
+        Save a file in the cache
+
+        :param sha256: Expected SHA-256 of the file in hexadecimal
+        :param write: Function that writes the content in the file-like object it receives, like blob.download_to_file
+        :return: True if the file was saved, False if its SHA-256 did not match
+        """
+        sha256 = sha256.lower()
+        if SHA256_REGEXP.match(sha256) is None:
+            return False
+        path = self._path(sha256)
+        path.parent.mkdir(exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(prefix=TEMPORARY_PREFIX, dir=path.parent)
+        try:
+            with os.fdopen(descriptor, "wb") as fileobj:
+                writer = HashingWriter(fileobj)
+                write(writer)
+            if writer.sha256.hexdigest() != sha256:
+                bitacora.warning("Disk cache did not save %s because its SHA-256 is %s", sha256, writer.sha256.hexdigest())
+                return False
+            os.replace(temporary, path)
+        finally:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+        self.prune()
+        return True
+
+    def tee(self, sha256: str, fileobj: BinaryIO, size: int) -> BinaryIO:
+        """
+        Save a file in the cache while it is read
+
+        :param sha256: Expected SHA-256 of the file in hexadecimal
+        :param fileobj: File-like reader at its beginning, like the one of blob.open
+        :param size: Size of the file in bytes
+        :return: Reader that saves the file when it is read to the end, or the same reader if the SHA-256 is not valid
+        """
+        sha256 = sha256.lower()
+        if SHA256_REGEXP.match(sha256) is None:
+            return fileobj
+        return CachingReader(self, sha256, fileobj, size)
+
+    def prune(self) -> None:
+        """Remove the least recently read files while the cache is over max_bytes, skip if another process is doing it"""
+        with open(self.directory / ".lock", "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            entries = []
+            total = 0
+            now = time.time()
+            for path in self.directory.glob("*/*"):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                if path.name.startswith(TEMPORARY_PREFIX):
+                    if now - stat.st_mtime > TEMPORARY_SECONDS:
+                        path.unlink(missing_ok=True)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            for _, size, path in sorted(entries):
+                path.unlink(missing_ok=True)
+                total -= size
+                if total <= self.max_bytes * MARGIN:
+                    break
@@ -0,0 +1,126 @@
+"""
+Download
+
+Answer the download of a file in Google Cloud Storage without holding it whole in the web worker
+
+- With DESCARGAS_MODO "firmado" redirects to a signed URL valid for DESCARGAS_SEGUNDOS,
+  the browser downloads the file from the storage and the worker is free at once
+- With DESCARGAS_MODO "flujo", or if the URL could not be signed, streams the file in chunks
+  with Content-Length and support for a single HTTP Range, a file with its SHA-256 is read
+  from the disk cache of the app when there is one, or saved there while it is streamed
+
+    try:
+        return send_file_from_gcs(bucket_name, blob_name, "archivo.pdf", "application/pdf")
+    except (MyBucketNotFoundError, MyFileNotFoundError, MyNotValidParamError) as error:
+        flash(str(error), "danger")
+
+"""
+
+import logging
+
+from flask import Response, current_app, redirect, request
+
+from lib.exceptions import MyDownloadError
+from lib.google_cloud_storage import CHUNK_SIZE, get_signed_url_from_gcs, open_file_from_gcs
+
+MODO_FIRMADO = "firmado"
+MODO_FLUJO = "flujo"
+
+bitacora = logging.getLogger(__name__)
+
+
+def stream_file_from_gcs(
+    bucket_name: str,
+    blob_name: str,
+    filename: str,
+    content_type: str,
+    chunk_size: int = CHUNK_SIZE,
+    sha256: str = "",
+) -> Response:
+    """
+    Stream a file from Google Cloud Storage in chunks, answering the Range of the request
+
+    :param bucket_name: Name of the bucket
+    :param blob_name: Path to the file
+    :param filename: Name of the downloaded file
+    :param content_type: Content type of the response
+    :param chunk_size: Bytes fetched from the storage and sent on each chunk
+    :param sha256: SHA-256 of the file, to read it from the disk cache
+    :return: Response with status 200, 206 for a Range or 416 for a Range out of the file
+    """
+
+    # Open the file, raises the errors before the response starts
+    reader, size = open_file_from_gcs(
+        bucket_name,
+        blob_name,
+        chunk_size=chunk_size,
+        disk_cache=current_app.disk_cache,
+        sha256=sha256,
+    )
+
+    # Only a single range is answered, with several ranges the whole file is sent
+    start, stop = 0, size
+    status = 200
+    if request.range is not None and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            reader.close()
+            response = Response(status=416)
+            response.headers["Content-Range"] = f"bytes */{size}"
+            return response
+        start, stop = byte_range
+        status = 206
+
+    def generate():
+        """Read and send the chunks, the reader is closed even if the client goes away"""
+        try:
+            reader.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = reader.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            reader.close()
+
+    response = Response(generate(), status=status, mimetype=content_type, direct_passthrough=True)
+    response.headers["Content-Length"] = str(stop - start)
+    response.headers["Accept-Ranges"] = "bytes"
+    if status == 206:
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
+
+def send_file_from_gcs(
+    bucket_name: str,
+    blob_name: str,
+    filename: str,
+    content_type: str,
+    sha256: str = "",
+) -> Response:
+    """
+    Send a file from Google Cloud Storage with the mode of DESCARGAS_MODO
+
+    :param bucket_name: Name of the bucket
+    :param blob_name: Path to the file
+    :param filename: Name of the downloaded file
+    :param content_type: Content type of the response
+    :param sha256: SHA-256 of the file, to stream it from the disk cache
+    :return: Redirect to a signed URL or streamed response
+    """
+    if current_app.config["DESCARGAS_MODO"] == MODO_FIRMADO:
+        try:
+            url = get_signed_url_from_gcs(
+                bucket_name=bucket_name,
+                blob_name=blob_name,
+                seconds=current_app.config["DESCARGAS_SEGUNDOS"],
+                filename=filename,
+                content_type=content_type,
+            )
+            return redirect(url)
+        except MyDownloadError as error:
+            bitacora.warning("Could not sign the URL of %s, streaming it: %s", blob_name, str(error.__cause__ or error))
+    return stream_file_from_gcs(bucket_name, blob_name, filename, content_type, sha256=sha256)
@@ -0,0 +1,220 @@
+"""
+Endpoint Health
+
+Time series of the calls to the endpoints of every ExhExterno, kept in Redis, to read the
+latency percentiles (p50, p95, p99) and the availability of each remote PJ on any window
+
+    endpoint_health = EndpointHealth(current_app.redis)
+    endpoint_health.record("JALISCO", "endpoint_recibir_exhorto", latency=0.35, outcome=OK)
+    endpoint_health.summary("JALISCO", "endpoint_recibir_exhorto", seconds=86400)
+    by_kind, total = endpoint_health.summaries("JALISCO", ["endpoint_recibir_exhorto", "endpoint_consultar_exhorto"])
+
+Every sample increments, in the hash of its time bucket {prefix}:{clave}:{kind}:{resolution}:{bucket_start},
+the field count, the field of its outcome and the field of its latency bin (b0, b1...).
+The same sample is added to the buckets of every RESOLUTIONS, the short buckets are kept
+for a short time and the long ones are the rollups for the long windows.
+
+The set {prefix}:series keeps the clave:kind pairs that have samples.
+
+"""
+
+import logging
+import time
+from typing import Optional
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+bitacora = logging.getLogger(__name__)
+
+# Outcomes of a sample
+OK = "ok"  # A response below 500
+ERROR = "error"  # A response of 500 or more
+TIMEOUT = "timeout"  # No response in time
+CONNECTION = "connection"  # Could not connect
+OUTCOMES = (OK, ERROR, TIMEOUT, CONNECTION)
+
+# Upper bounds in milliseconds of the latency bins, the last one takes everything
+LATENCY_BINS = (10, 25, 50, 100, 250, 500, 750, 1000, 1500, 2000, 3000, 5000, 10000, 30000, 60000, float("inf"))
+
+# Seconds of each bucket and seconds the buckets are kept, the summaries use the shortest resolution that covers the window
+RESOLUTIONS = ((300, 2 * 86400), (3600, 31 * 86400))
+
+# Kind of the samples of the calls that do not say their endpoint
+DEFAULT_KIND = "otro"
+
+
+def latency_bin(milliseconds: float) -> int:
+    """Index of the latency bin of milliseconds"""
+    for index, upper in enumerate(LATENCY_BINS):
+        if milliseconds <= upper:
+            return index
+    return len(LATENCY_BINS) - 1
+
+
+def percentile(bins: list[int], fraction: float) -> Optional[float]:
+    """Estimate a percentile in milliseconds from the counts of the latency bins, interpolating inside the bin"""
+    total = sum(bins)
+    if total == 0:
+        return None
+    rank = fraction * total
+    accumulated = 0
+    for index, count in enumerate(bins):
+        if count > 0 and accumulated + count >= rank:
+            lower = LATENCY_BINS[index - 1] if index > 0 else 0.0
+            upper = LATENCY_BINS[index]
+            if upper == float("inf"):
+                return lower
+            return lower + (upper - lower) * (rank - accumulated) / count
+        accumulated += count
+    return LATENCY_BINS[-2]
+
+
+class EndpointHealth:
+    """Endpoint health time series backed by Redis"""
+
+    def __init__(self, redis: Redis, prefix: str = "endpoint_health") -> None:
+        """Endpoint health constructor"""
+        self.redis = redis
+        self.prefix = prefix
+
+    def _key(self, clave: str, kind: str, resolution: int, bucket_start: int) -> str:
+        """Redis key of a bucket"""
+        return f"{self.prefix}:{clave}:{kind}:{resolution}:{bucket_start}"
+
+    def record(
+        self,
+        clave: str,
+        kind: str,
+        latency: Optional[float],
+        outcome: str,
+        timestamp: float = None,
+    ) -> None:
+        """
+        Record a sample, a failure to reach Redis is logged and ignored
+
+        :param clave: Clave of the ExhExterno
+        :param kind: Endpoint kind, the column of ExhExterno like endpoint_recibir_exhorto
+        :param latency: Seconds to the response, None if there was no response
+        :param outcome: One of OUTCOMES
+        :param timestamp: Epoch seconds of the sample, now by default
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for resolution, retention in RESOLUTIONS:
+                bucket_start = int(timestamp // resolution * resolution)
+                key = self._key(clave, kind, resolution, bucket_start)
+                pipeline.hincrby(key, "count", 1)
+                pipeline.hincrby(key, outcome, 1)
+                if latency is not None:
+                    milliseconds = latency * 1000
+                    pipeline.hincrby(key, f"b{latency_bin(milliseconds)}", 1)
+                    pipeline.hincrbyfloat(key, "sum", milliseconds)
+                pipeline.expireat(key, bucket_start + resolution + retention)
+            pipeline.sadd(f"{self.prefix}:series", f"{clave}:{kind}")
+            pipeline.execute()
+        except RedisError as error:
+            bitacora.warning("Endpoint health could not record %s %s: %s", clave, kind, str(error))
+
+    def series(self) -> list[tuple[str, str]]:
+        """The clave and kind pairs that have samples"""
+        try:
+            members = self.redis.smembers(f"{self.prefix}:series")
+        except RedisError as error:
+            bitacora.warning("Endpoint health without Redis: %s", str(error))
+            return []
+        pairs = []
+        for member in members:
+            clave, _, kind = member.decode("utf-8").partition(":")
+            pairs.append((clave, kind))
+        return sorted(pairs)
+
+    def summary(self, clave: str, kind: str = None, seconds: int = 86400, now: float = None) -> dict:
+        """
+        Roll up the buckets of the last seconds
+
+        :param clave: Clave of the ExhExterno
+        :param kind: Endpoint kind, None for all the kinds of the clave
+        :param seconds: Window in seconds
+        :param now: Epoch seconds of the end of the window, now by default
+        :return: Dict with count, the count of each outcome, availability from 0 to 1 (None without samples),
+            mean, p50, p95 and p99 in milliseconds (None without latencies)
+        """
+        if kind is None:
+            kinds = [series_kind for series_clave, series_kind in self.series() if series_clave == clave]
+        else:
+            kinds = [kind]
+        _, total = self.summaries(clave, kinds, seconds, now)
+        return total
+
+    def summaries(self, clave: str, kinds: list[str], seconds: int = 86400, now: float = None) -> tuple[dict, dict]:
+        """
+        Roll up the buckets of the last seconds of several kinds and their total, reading Redis once
+
+        :param clave: Clave of the ExhExterno
+        :param kinds: Endpoint kinds
+        :param seconds: Window in seconds
+        :param now: Epoch seconds of the end of the window, now by default
+        :return: Dict of the summary of every kind, like the one of summary, and the summary of all of them together
+        """
+        if now is None:
+            now = time.time()
+        resolution = RESOLUTIONS[-1][0]
+        for candidate, retention in RESOLUTIONS:
+            if seconds <= retention:
+                resolution = candidate
+                break
+        first = int((now - seconds) // resolution * resolution)
+        starts = range(first, int(now) + 1, resolution)
+        rollups = {kind: _Rollup() for kind in kinds}
+        total = _Rollup()
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for kind in kinds:
+                for start in starts:
+                    pipeline.hgetall(self._key(clave, kind, resolution, start))
+            buckets = pipeline.execute()
+        except RedisError as error:
+            bitacora.warning("Endpoint health without Redis: %s", str(error))
+            return {kind: rollup.result() for kind, rollup in rollups.items()}, total.result()
+        for index, bucket in enumerate(buckets):
+            rollups[kinds[index // len(starts)]].add(bucket)
+            total.add(bucket)
+        return {kind: rollup.result() for kind, rollup in rollups.items()}, total.result()
+
+
+class _Rollup:
+    """Counts, latency bins and latency sum of the buckets added"""
+
+    def __init__(self) -> None:
+        """Rollup constructor"""
+        self.counts = {"count": 0, **{outcome: 0 for outcome in OUTCOMES}}
+        self.bins = [0] * len(LATENCY_BINS)
+        self.total = 0.0
+
+    def add(self, bucket: dict) -> None:
+        """Add the fields of a bucket read from Redis"""
+        for field, value in bucket.items():
+            field = field.decode("utf-8")
+            if field == "sum":
+                self.total += float(value)
+            elif field.startswith("b"):
+                self.bins[int(field[1:])] += int(value)
+            elif field in self.counts:
+                self.counts[field] += int(value)
+
+    def result(self) -> dict:
+        """Summary with count, the count of each outcome, availability, mean, p50, p95 and p99"""
+        result = {"count": self.counts["count"], "availability": None, "mean": None, "p50": None, "p95": None, "p99": None}
+        result.update({outcome: self.counts[outcome] for outcome in OUTCOMES})
+        if result["count"] > 0:
+            result["availability"] = result[OK] / result["count"]
+        latencies = sum(self.bins)
+        if latencies > 0:
+            result["mean"] = self.total / latencies
+            result["p50"] = percentile(self.bins, 0.50)
+            result["p95"] = percentile(self.bins, 0.95)
+            result["p99"] = percentile(self.bins, 0.99)
+        return result
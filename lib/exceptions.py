@@ -19,10 +19,18 @@ class MyBucketNotFoundError(MyAnyError):
     """Excepción porque no se encontró el bucket"""
 
 
+class MyCircuitOpenError(MyAnyError):
+    """Excepción porque el circuito hacia el externo está abierto"""
+
+
 class MyConnectionError(MyAnyError):
     """Excepción porque no se pudo conectar"""
 
 
+class MyDownloadError(MyAnyError):
+    """Excepción porque falló la descarga"""
+
+
 class MyEmptyError(MyAnyError):
     """Excepción porque no hay resultados"""
 
@@ -5,21 +5,26 @@ Functions to get and upload files from Google Cloud Storage
 
 For develpment you need the environment variable GOOGLE_APPLICATION_CREDENTIALS
 
+The functions use the storage backend of lib/storage_backends, by default
+Google Cloud Storage, set ALMACEN_BACKEND to use the local filesystem or the memory.
+
+The reads take an optional DiskCache and the SHA-256 of the file, a file already
+in the disk cache is read from the disk, otherwise it is downloaded to the disk cache.
+
 """
 
+import hashlib
+import logging
+import os
 from pathlib import Path
+from typing import BinaryIO
 from urllib.parse import unquote, urlparse
 
-from google.cloud import storage
-from google.cloud.exceptions import NotFound
+from lib.disk_cache import DiskCache
+from lib.exceptions import MyFileNotAllowedError, MyFileNotFoundError, MyNotValidParamError
+from lib.storage_backends import CHUNK_SIZE, get_storage_backend
 
-from lib.exceptions import (
-    MyBucketNotFoundError,
-    MyFileNotAllowedError,
-    MyFileNotFoundError,
-    MyNotValidParamError,
-    MyUploadError,
-)
+bitacora = logging.getLogger(__name__)
 
 EXTENSIONS_MEDIA_TYPES = {
     "doc": "application/msword",
@@ -34,6 +39,45 @@ EXTENSIONS_MEDIA_TYPES = {
 }
 
 
+class HashingReader:
+    """
+    File-like reader that computes the SHA-1, SHA-256 and size of the stream while it is read
+
+    The resumable upload may seek back to send a chunk again, the bytes already hashed are not hashed twice
+
+        reader = HashingReader(archivo.stream)
+        upload_stream_to_gcs(bucket_name, blob_name, "application/pdf", reader)
+        reader.sha1.hexdigest(), reader.sha256.hexdigest(), reader.size
+
+    """
+
+    def __init__(self, stream: BinaryIO) -> None:
+        """Hashing reader constructor, the stream must be at its beginning"""
+        self.stream = stream
+        self.sha1 = hashlib.sha1()
+        self.sha256 = hashlib.sha256()
+        self.size = 0  # Bytes hashed, also the farthest position read
+
+    def read(self, size: int = -1) -> bytes:
+        """Read from the stream and hash the bytes not seen before"""
+        position = self.stream.tell()
+        data = self.stream.read(size)
+        if position + len(data) > self.size:
+            new_data = data[self.size - position :]
+            self.sha1.update(new_data)
+            self.sha256.update(new_data)
+            self.size += len(new_data)
+        return data
+
+    def tell(self) -> int:
+        """Position in the stream"""
+        return self.stream.tell()
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        """Move in the stream"""
+        return self.stream.seek(offset, whence)
+
+
 def get_media_type_from_filename(filename: str) -> str:
     """
     Get media type from filename
@@ -91,20 +135,21 @@ def check_file_exists_from_gcs(
     :return: True if file exists
     """
 
-    # Get bucket
-    storage_client = storage.Client()
-    try:
-        bucket = storage_client.get_bucket(bucket_name)
-    except NotFound as error:
-        raise MyBucketNotFoundError("Bucket not found") from error
+    # Return True if file exists, a missing bucket has no files
+    return get_storage_backend().exists(bucket_name, blob_name)
 
-    # Get file
-    blob = bucket.get_blob(blob_name)
-    if blob is None:
-        return False
 
-    # Return True if file exists
-    return True
+def delete_file_from_gcs(
+    bucket_name: str,
+    blob_name: str,
+) -> None:
+    """
+    Delete file from Google Cloud Storage, a missing file is ignored
+
+    :param bucket_name: Name of the bucket
+    :param blob_name: Path to the file
+    """
+    get_storage_backend().delete(bucket_name, blob_name)
 
 
 def get_public_url_from_gcs(
@@ -119,48 +164,102 @@ def get_public_url_from_gcs(
     :return: Public URL
     """
 
-    # Get bucket
-    storage_client = storage.Client()
-    try:
-        bucket = storage_client.get_bucket(bucket_name)
-    except NotFound as error:
-        raise MyBucketNotFoundError("Bucket not found") from error
-
-    # Get file
-    blob = bucket.get_blob(blob_name)
-    if blob is None:
+    # Check that the file exists
+    storage_backend = get_storage_backend()
+    if not storage_backend.exists(bucket_name, blob_name):
         raise MyFileNotFoundError("File not found")
 
     # Return public URL
-    return blob.public_url
+    return storage_backend.url(bucket_name, blob_name)
 
 
 def get_file_from_gcs(
     bucket_name: str,
     blob_name: str,
+    disk_cache: DiskCache = None,
+    sha256: str = "",
 ) -> bytes:
     """
     Get file from Google Cloud Storage
 
     :param bucket_name: Name of the bucket
     :param blob_name: Path to the file
+    :param disk_cache: Optional disk cache
+    :param sha256: SHA-256 of the file, required to use the disk cache
     :return: File content
     """
 
-    # Get bucket
-    storage_client = storage.Client()
-    try:
-        bucket = storage_client.get_bucket(bucket_name)
-    except NotFound as error:
-        raise MyBucketNotFoundError("Bucket not found") from error
+    # Read from the disk cache
+    if disk_cache is not None and sha256 != "":
+        reader, _ = open_file_from_gcs(bucket_name, blob_name, disk_cache=disk_cache, sha256=sha256)
+        with reader:
+            return reader.read()
 
-    # Get file
-    blob = bucket.get_blob(blob_name)
-    if blob is None:
-        raise MyFileNotFoundError("File not found")
+    # Download the file
+    return get_storage_backend().get(bucket_name, blob_name)
 
-    # Return file content
-    return blob.download_as_string()
+
+def get_signed_url_from_gcs(
+    bucket_name: str,
+    blob_name: str,
+    seconds: int,
+    filename: str,
+    content_type: str,
+) -> str:
+    """
+    Get a signed URL to download the file directly from Google Cloud Storage
+
+    The backends that can not sign raise MyDownloadError
+
+    :param bucket_name: Name of the bucket
+    :param blob_name: Path to the file
+    :param seconds: Seconds the URL is valid
+    :param filename: Name of the downloaded file
+    :param content_type: Content type of the response
+    :return: Signed URL
+    """
+
+    # Sign the URL, the backend checks that the file exists
+    return get_storage_backend().signed_url(bucket_name, blob_name, seconds, filename, content_type)
+
+
+def open_file_from_gcs(
+    bucket_name: str,
+    blob_name: str,
+    chunk_size: int = CHUNK_SIZE,
+    disk_cache: DiskCache = None,
+    sha256: str = "",
+) -> tuple[BinaryIO, int]:
+    """
+    Open file from Google Cloud Storage to read it in chunks, without downloading it whole
+
+    :param bucket_name: Name of the bucket
+    :param blob_name: Path to the file
+    :param chunk_size: Bytes fetched from the storage on each read
+    :param disk_cache: Optional disk cache, the file is read from the disk or saved there while it is read
+    :param sha256: SHA-256 of the file, required to use the disk cache
+    :return: File-like reader and the size of the file in bytes
+    """
+
+    # Read from the disk cache
+    use_disk_cache = disk_cache is not None and sha256 != ""
+    if use_disk_cache:
+        cached = disk_cache.open(sha256)
+        if cached is not None:
+            return cached
+
+    # Read from the storage in chunks
+    reader, size = get_storage_backend().stream(bucket_name, blob_name, chunk_size=chunk_size)
+
+    # Save in the disk cache while it is read, the first chunks do not wait for the whole download
+    if use_disk_cache:
+        try:
+            return disk_cache.tee(sha256, reader, size), size
+        except OSError as error:
+            bitacora.warning("Disk cache could not save %s: %s", blob_name, str(error))
+
+    # Return the reader and the size
+    return reader, size
 
 
 def upload_file_to_gcs(
@@ -183,21 +282,27 @@ def upload_file_to_gcs(
     # if content_type not in EXTENSIONS_MEDIA_TYPES.values():
     #     raise MyFileNotAllowedError("File not allowed")
 
-    # Get bucket
-    storage_client = storage.Client()
-    try:
-        bucket = storage_client.get_bucket(bucket_name)
-    except NotFound as error:
-        raise MyBucketNotFoundError("Bucket not found") from error
+    # Upload file and return public URL
+    return get_storage_backend().put(bucket_name, blob_name, content_type, data)
 
-    # Create blob
-    blob = bucket.blob(blob_name)
 
-    # Upload file
-    try:
-        blob.upload_from_string(data, content_type=content_type)
-    except Exception as error:
-        raise MyUploadError("Error uploading file") from error
+def upload_stream_to_gcs(
+    bucket_name: str,
+    blob_name: str,
+    content_type: str,
+    stream: BinaryIO,
+    chunk_size: int = CHUNK_SIZE,
+) -> str:
+    """
+    Upload file to Google Cloud Storage from a stream, with a resumable upload of chunk_size bytes at a time
 
-    # Return public URL
-    return blob.public_url
+    :param bucket_name: Name of the bucket
+    :param blob_name: Path to the file
+    :param content_type: Content type of the file
+    :param stream: File-like object at its beginning, like a HashingReader
+    :param chunk_size: Bytes read and sent on each request, must be a multiple of 256 KB
+    :return: Public URL
+    """
+
+    # Upload file, in Google Cloud Storage with chunk_size the upload is resumable and only one chunk is in memory
+    return get_storage_backend().put(bucket_name, blob_name, content_type, stream, chunk_size=chunk_size)
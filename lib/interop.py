@@ -0,0 +1,318 @@
+"""
+Interop
+
+Shared HTTP client for the calls between Poderes Judiciales (PJ to PJ)
+
+Each ExhExterno gets one requests.Session with its own pool of keep-alive connections,
+so one batch of exhortos and archivos reuses a handful of TCP+TLS connections.
+
+Every request takes a token from the Redis rate limiter of the ExhExterno clave,
+configured with INTEROP_TASA (requests per second) and INTEROP_RAFAGA (burst).
+
+Connection errors, timeouts and 5xx responses are counted by the Redis circuit breaker of the clave,
+after INTEROP_CIRCUITO_FALLAS in a row the requests fail fast with MyCircuitOpenError
+for INTEROP_CIRCUITO_SEGUNDOS, then a single request probes the remote before closing it again.
+
+The latency and outcome of every request are recorded in the endpoint health time series,
+under the clave and the kind given, use the name of the ExhExterno column of the endpoint.
+
+    client = get_interop_client(exh_externo)
+    response = client.post(exh_externo.endpoint_recibir_exhorto, kind="endpoint_recibir_exhorto", json=datos_exhorto)
+    response.raise_for_status()
+
+To time the wait of the rate limiter apart from the request, call acquire first and pass acquired=True.
+
+    client.acquire()
+    response = client.post(exh_externo.endpoint_recibir_exhorto, kind="endpoint_recibir_exhorto", acquired=True, data=payload)
+
+To send a file without having it whole in memory use post_multipart with a file-like reader,
+the body is streamed in chunks of CHUNK_SIZE bytes.
+
+To check the health of an endpoint use probe_endpoint, it measures the TCP connect,
+the TLS handshake and the time to the response headers, with short timeouts.
+
+"""
+
+import os
+import socket
+import ssl
+import threading
+import time
+import uuid
+from typing import BinaryIO
+from urllib.parse import urlparse
+
+import requests
+from flask import current_app, has_app_context
+from requests.adapters import HTTPAdapter
+from urllib3.fields import format_multipart_header_param
+
+from lib.circuit_breaker import CircuitBreaker
+from lib.endpoint_health import CONNECTION, DEFAULT_KIND, ERROR, OK, TIMEOUT, EndpointHealth
+from lib.exceptions import MyCircuitOpenError, MyDownloadError
+from lib.rate_limiter import RateLimiter
+
+CONNECT_TIMEOUT = 5  # 5 segundos para establecer la conexión
+READ_TIMEOUT = 30  # 30 segundos para recibir la respuesta
+POOL_MAXSIZE = 4  # Conexiones persistentes por externo
+CHUNK_SIZE = 256 * 1024  # 256 KB por cada pedazo enviado
+PROBE_CONNECT_TIMEOUT = 3  # 3 segundos para conectar al probar un endpoint
+PROBE_READ_TIMEOUT = 10  # 10 segundos para recibir la respuesta al probar un endpoint
+HEALTH_PREFIX = "interop:salud"  # Prefijo en Redis de la serie de tiempo de salud de los endpoints
+
+_clients = {}
+_clients_lock = threading.Lock()
+_clients_pid = os.getpid()
+
+
+class MultipartStream:
+    """Multipart/form-data body that reads the file in chunks while it is being sent"""
+
+    def __init__(
+        self,
+        fields: dict,
+        file_field: str,
+        filename: str,
+        fileobj: BinaryIO,
+        size: int,
+        content_type: str,
+        chunk_size: int = CHUNK_SIZE,
+    ) -> None:
+        """Multipart stream constructor"""
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self.fileobj = fileobj
+        self.size = size
+        self.chunk_size = chunk_size
+        head = ""
+        for name, value in fields.items():
+            head += f"--{boundary}\r\nContent-Disposition: form-data; {format_multipart_header_param('name', name)}"
+            head += f"\r\n\r\n{value}\r\n"
+        head += f"--{boundary}\r\nContent-Disposition: form-data; {format_multipart_header_param('name', file_field)}; "
+        head += f"{format_multipart_header_param('filename', filename)}\r\nContent-Type: {content_type}\r\n\r\n"
+        self.head = head.encode("utf-8")
+        self.tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    def __len__(self) -> int:
+        """Total length of the body, so it is sent with Content-Length"""
+        return len(self.head) + self.size + len(self.tail)
+
+    def __iter__(self):
+        """Yield the head, the file in chunks and the tail"""
+        yield self.head
+        while True:
+            try:
+                chunk = self.fileobj.read(self.chunk_size)
+            except Exception as error:
+                raise MyDownloadError(f"Error reading the file: {str(error)}") from error
+            if not chunk:
+                break
+            yield chunk
+        yield self.tail
+
+
+class InteropClient:
+    """Interop HTTP client for one ExhExterno"""
+
+    def __init__(
+        self,
+        clave: str,
+        api_key: str,
+        connect_timeout: float = CONNECT_TIMEOUT,
+        read_timeout: float = READ_TIMEOUT,
+        pool_maxsize: int = POOL_MAXSIZE,
+        rate_limiter: RateLimiter = None,
+        circuit_breaker: CircuitBreaker = None,
+        endpoint_health: EndpointHealth = None,
+    ) -> None:
+        """Interop client constructor"""
+        self.clave = clave
+        self.api_key = api_key
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.endpoint_health = endpoint_health
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers.update({"X-Api-Key": api_key, "Connection": "keep-alive"})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _record_health(self, kind: str, latency: float, outcome: str) -> None:
+        """Record the sample of a request in the endpoint health time series"""
+        if self.endpoint_health is not None:
+            self.endpoint_health.record(self.clave, kind, latency, outcome)
+
+    def acquire(self) -> None:
+        """Check the circuit breaker and take a token of the rate limiter, sleeps until there is one"""
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow(self.clave):
+            raise MyCircuitOpenError(f"The circuit of {self.clave} is open, not calling it for now")
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(self.clave)
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        kind: str = DEFAULT_KIND,
+        acquired: bool = False,
+        **kwargs,
+    ) -> requests.Response:
+        """Make a request with the separated connect and read timeouts, kind is the endpoint for the health samples,
+        acquired is True when the caller already called acquire, to time the wait apart from the request"""
+        if not acquired:
+            self.acquire()
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+            # ConnectTimeout is both, it is counted as a timeout
+            outcome = TIMEOUT if isinstance(error, requests.exceptions.Timeout) else CONNECTION
+            self._record_health(kind, None, outcome)
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record_failure(self.clave)
+            raise
+        self._record_health(kind, time.perf_counter() - start, ERROR if response.status_code >= 500 else OK)
+        if self.circuit_breaker is not None:
+            if response.status_code >= 500:
+                self.circuit_breaker.record_failure(self.clave)
+            else:
+                self.circuit_breaker.record_success(self.clave)
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """GET request"""
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """POST request"""
+        return self.request("POST", url, **kwargs)
+
+    def post_multipart(
+        self,
+        url: str,
+        fields: dict,
+        file_field: str,
+        filename: str,
+        fileobj: BinaryIO,
+        size: int,
+        content_type: str,
+        **kwargs,
+    ) -> requests.Response:
+        """POST multipart/form-data request streaming the file from a file-like reader"""
+        body = MultipartStream(fields, file_field, filename, fileobj, size, content_type)
+        headers = kwargs.pop("headers", {})
+        headers["Content-Type"] = body.content_type
+        return self.post(url, data=body, headers=headers, **kwargs)
+
+    def close(self) -> None:
+        """Close the pooled connections"""
+        self.session.close()
+
+
+def get_interop_client(exh_externo) -> InteropClient:
+    """
+    Get the shared interop client of an ExhExterno, it is created on the first use
+
+    :param exh_externo: ExhExterno with clave and api_key
+    :return: InteropClient
+    """
+    global _clients_pid  # pylint: disable=global-statement
+    api_key = exh_externo.api_key or ""
+    with _clients_lock:
+        # After a fork the inherited sockets can not be shared, start with new clients
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get(exh_externo.clave)
+        if client is None or client.api_key != api_key:
+            if client is not None:
+                client.close()
+            rate_limiter = None
+            circuit_breaker = None
+            endpoint_health = None
+            if has_app_context():
+                rate_limiter = RateLimiter(
+                    redis=current_app.redis,
+                    rate=current_app.config["INTEROP_TASA"],
+                    burst=current_app.config["INTEROP_RAFAGA"],
+                    prefix="interop:tasa",
+                )
+                circuit_breaker = CircuitBreaker(
+                    redis=current_app.redis,
+                    failure_threshold=current_app.config["INTEROP_CIRCUITO_FALLAS"],
+                    open_seconds=current_app.config["INTEROP_CIRCUITO_SEGUNDOS"],
+                    prefix="interop:circuito",
+                )
+                endpoint_health = EndpointHealth(redis=current_app.redis, prefix=HEALTH_PREFIX)
+            client = InteropClient(
+                exh_externo.clave,
+                api_key,
+                rate_limiter=rate_limiter,
+                circuit_breaker=circuit_breaker,
+                endpoint_health=endpoint_health,
+            )
+            _clients[exh_externo.clave] = client
+    return client
+
+
+def close_interop_clients() -> None:
+    """Close all the interop clients"""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+def probe_endpoint(
+    url: str,
+    api_key: str = "",
+    connect_timeout: float = PROBE_CONNECT_TIMEOUT,
+    read_timeout: float = PROBE_READ_TIMEOUT,
+) -> dict:
+    """
+    Probe an endpoint, the connect and the TLS handshake are timed on their own socket before the request
+
+    :param url: URL of the endpoint
+    :param api_key: Sent in the X-Api-Key header
+    :param connect_timeout: Seconds to connect and to make the TLS handshake
+    :param read_timeout: Seconds to receive the response headers
+    :return: Dict with url, status_code, latency, connect and tls in seconds (None when not reached) and error
+    """
+    result = {"url": url, "status_code": None, "latency": None, "connect": None, "tls": None, "error": ""}
+
+    # Validate the URL
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        result["error"] = "Invalid URL"
+        return result
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+
+    # Time the TCP connect and the TLS handshake
+    try:
+        start = time.perf_counter()
+        sock = socket.create_connection((parsed.hostname, port), timeout=connect_timeout)
+        result["connect"] = time.perf_counter() - start
+        try:
+            if parsed.scheme == "https":
+                start = time.perf_counter()
+                with ssl.create_default_context().wrap_socket(sock, server_hostname=parsed.hostname):
+                    result["tls"] = time.perf_counter() - start
+        finally:
+            sock.close()
+    except OSError as error:
+        result["error"] = f"{type(error).__name__}: {str(error)}"
+        return result
+
+    # Time the request until the response headers, the body is not read
+    start = time.perf_counter()
+    try:
+        with requests.get(
+            url, headers={"X-Api-Key": api_key}, timeout=(connect_timeout, read_timeout), stream=True
+        ) as response:
+            result["latency"] = time.perf_counter() - start
+            result["status_code"] = response.status_code
+    except requests.exceptions.RequestException as error:
+        result["error"] = f"{type(error).__name__}: {str(error)}"
+    return result
@@ -0,0 +1,186 @@
+"""
+Mock PJ
+
+Local stand-in of a remote Poder Judicial that implements the interop contract used by enviar,
+consultar and probar_endpoints, so the send pipeline can be load-tested without touching real courts
+
+- GET  /materias                        consultar materias
+- POST /exh_exhortos                    recibir exhorto
+- POST /exh_exhortos/archivos           recibir exhorto archivo, the last archivo gets the acuse
+- GET  /exh_exhortos/<folio_seguimiento> consultar exhorto
+- GET  /estadisticas                    counters of what has been received
+
+Latency, error rate (HTTP 500) and reject rate (success false) are configurable.
+
+    server = make_mock_pj_server("127.0.0.1", 5099, latency=0.2, error_rate=0.05, reject_rate=0.01)
+    server.serve_forever()
+
+"""
+
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from flask import Flask, jsonify, request
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, make_server
+
+CHUNK_SIZE = 256 * 1024  # 256 KB per read of the received files
+
+MATERIAS = [
+    {"clave": "CIV", "nombre": "CIVIL"},
+    {"clave": "FAM", "nombre": "FAMILIAR"},
+    {"clave": "MER", "nombre": "MERCANTIL"},
+    {"clave": "PEN", "nombre": "PENAL"},
+]
+
+
+def create_mock_pj_app(
+    latency: float = 0.0,
+    latency_jitter: float = 0.0,
+    error_rate: float = 0.0,
+    reject_rate: float = 0.0,
+    api_key: str = "",
+) -> Flask:
+    """
+    Create the mock PJ Flask app
+
+    :param latency: Seconds to wait before every response
+    :param latency_jitter: Random extra seconds, between zero and this value, added to the latency
+    :param error_rate: Probability from 0 to 1 of answering with HTTP 500
+    :param reject_rate: Probability from 0 to 1 of rejecting an exhorto with success false
+    :param api_key: If not empty, the X-Api-Key header must match it
+    :return: Flask app
+    """
+    app = Flask(__name__)
+    lock = threading.Lock()
+    pending = {}  # exhortoOrigenId -> names of the archivos not received yet
+    received = {}  # folioSeguimiento -> consulta data
+    stats = {"exhortos": 0, "rechazados": 0, "archivos": 0, "bytes": 0, "errores": 0}
+
+    def simulate():
+        """Check the api key, wait the latency and maybe fail, returns a response to send instead or None"""
+        if api_key != "" and request.headers.get("X-Api-Key", "") != api_key:
+            return jsonify({"success": False, "message": "Unauthorized", "errors": ["Wrong X-Api-Key"], "data": None}), 401
+        time.sleep(latency + random.uniform(0, latency_jitter))
+        if random.random() < error_rate:
+            with lock:
+                stats["errores"] += 1
+            return jsonify({"success": False, "message": "Simulated error", "errors": [], "data": None}), 500
+        return None
+
+    @app.get("/materias")
+    def consultar_materias():
+        """Consultar materias"""
+        failure = simulate()
+        if failure is not None:
+            return failure
+        return jsonify({"success": True, "message": "", "errors": [], "data": MATERIAS})
+
+    @app.post("/exh_exhortos")
+    def recibir_exhorto():
+        """Recibir exhorto"""
+        failure = simulate()
+        if failure is not None:
+            return failure
+        payload = request.get_json(silent=True) or {}
+        exhorto_origen_id = str(payload.get("exhortoOrigenId", ""))
+        if exhorto_origen_id == "" or random.random() < reject_rate:
+            with lock:
+                stats["rechazados"] += 1
+            return jsonify({"success": False, "message": "Rejected by the mock", "errors": ["Simulated reject"], "data": None})
+        with lock:
+            stats["exhortos"] += 1
+            pending[exhorto_origen_id] = {
+                "archivos": {str(archivo.get("nombreArchivo", "")) for archivo in payload.get("archivos", [])},
+                "municipioDestinoId": payload.get("municipioDestinoId"),
+            }
+        return jsonify(
+            {
+                "success": True,
+                "message": "",
+                "errors": [],
+                "data": {"exhortoOrigenId": exhorto_origen_id, "fechaHora": datetime.now().strftime("%Y-%m-%dT%H:%M:%S")},
+            }
+        )
+
+    @app.post("/exh_exhortos/archivos")
+    def recibir_exhorto_archivo():
+        """Recibir exhorto archivo, the acuse is given with the last one"""
+        failure = simulate()
+        if failure is not None:
+            return failure
+        exhorto_origen_id = request.form.get("exhortoOrigenId", "")
+        archivo = request.files.get("archivo")
+        if archivo is None:
+            return jsonify({"success": False, "message": "Missing archivo", "errors": [], "data": None})
+        size = 0
+        while True:
+            chunk = archivo.stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+        with lock:
+            exhorto = pending.get(exhorto_origen_id)
+            if exhorto is None:
+                return jsonify({"success": False, "message": "Unknown exhortoOrigenId", "errors": [], "data": None})
+            stats["archivos"] += 1
+            stats["bytes"] += size
+            exhorto["archivos"].discard(archivo.filename)
+            data = {"archivo": {"nombreArchivo": archivo.filename, "tamano": size}}
+            if len(exhorto["archivos"]) == 0:
+                acuse = {
+                    "exhortoOrigenId": exhorto_origen_id,
+                    "folioSeguimiento": str(uuid.uuid4()),
+                    "fechaHoraRecepcion": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+                    "municipioAreaRecibeId": exhorto["municipioDestinoId"],
+                    "areaRecibeId": "OFICIALIA",
+                    "areaRecibeNombre": "OFICIALIA VIRTUAL",
+                    "urlInfo": "",
+                }
+                received[acuse["folioSeguimiento"]] = acuse
+                del pending[exhorto_origen_id]
+                data["acuse"] = acuse
+        return jsonify({"success": True, "message": "", "errors": [], "data": data})
+
+    @app.get("/exh_exhortos/<folio_seguimiento>")
+    def consultar_exhorto(folio_seguimiento: str):
+        """Consultar exhorto"""
+        failure = simulate()
+        if failure is not None:
+            return failure
+        with lock:
+            acuse = received.get(folio_seguimiento)
+        if acuse is None:
+            return jsonify({"success": False, "message": "Unknown folioSeguimiento", "errors": [], "data": None}), 404
+        return jsonify({"success": True, "message": "", "errors": [], "data": acuse})
+
+    @app.get("/estadisticas")
+    def estadisticas():
+        """Counters of what has been received"""
+        with lock:
+            return jsonify(dict(stats))
+
+    return app
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Request handler that does not log every request"""
+
+    def log_request(self, code="-", size="-") -> None:
+        """Do not log the request"""
+
+
+def make_mock_pj_server(host: str, port: int, quiet: bool = False, **kwargs) -> BaseWSGIServer:
+    """
+    Make a threaded WSGI server with the mock PJ, call serve_forever to start it and shutdown to stop it
+
+    :param host: Host to listen on
+    :param port: Port to listen on, 0 takes a free one
+    :param quiet: Do not log every request
+    :param kwargs: Arguments for create_mock_pj_app
+    :return: Werkzeug server
+    """
+    request_handler = QuietRequestHandler if quiet else None
+    return make_server(host, port, create_mock_pj_app(**kwargs), threaded=True, request_handler=request_handler)
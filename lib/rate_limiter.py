@@ -0,0 +1,66 @@
+"""
+Rate Limiter
+
+Token bucket kept in Redis, so every rq worker shares the same budget for each key
+
+    rate_limiter = RateLimiter(current_app.redis, rate=2.0, burst=5)
+    rate_limiter.acquire("JALISCO")  # Returns at once if there is a token, or sleeps until there is one
+
+"""
+
+import logging
+import time
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+bitacora = logging.getLogger(__name__)
+
+# Takes one token if there is one, otherwise returns the seconds to wait for the next one
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+if tokens < 1 then
+    return tostring((1 - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return '0'
+"""
+
+
+class RateLimiter:
+    """Token bucket rate limiter backed by Redis"""
+
+    def __init__(self, redis: Redis, rate: float, burst: int, prefix: str = "rate_limiter") -> None:
+        """Rate limiter constructor, rate is in requests per second"""
+        self.redis = redis
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.prefix = prefix
+        self.script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def acquire(self, key: str) -> float:
+        """Take one token for the key, sleeping as needed, returns the seconds waited"""
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            try:
+                wait = float(self.script(keys=[f"{self.prefix}:{key}"], args=[self.rate, self.burst]))
+            except RedisError as error:
+                # Without Redis keep the remote protected by spacing the requests by the configured rate
+                bitacora.warning("Rate limiter without Redis for %s: %s", key, str(error))
+                wait = 1 / self.rate
+                time.sleep(wait)
+                return waited + wait
+            if wait <= 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
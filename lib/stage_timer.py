@@ -0,0 +1,133 @@
+"""
+Stage Timer
+
+Timing spans for the stages of a batch, tagged with the exhorto and the destination,
+aggregated after the run into latency histograms per destination and stage kept in Redis
+
+    stage_timer = StageTimer()
+    with stage_timer.span("post_exhorto", clave="JALISCO", exhorto_origen_id="..."):
+        ...
+    stage_timer.save(current_app.redis, "stage_timer:enviar")
+    for line in stage_timer.summary():
+        print(line)
+
+Each histogram is a Redis hash {prefix}:{clave}:{stage} with the cumulative counts of the
+HISTOGRAM_BUCKETS (le_0.1, le_0.25...), plus count and sum in seconds.
+
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import BinaryIO
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+bitacora = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the histogram buckets, the last one takes everything
+HISTOGRAM_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+# Destination for the spans that are not of a single externo, like loading the batch from the database
+BATCH_CLAVE = "_lote"
+
+
+class StageTimer:
+    """Collects timing spans, safe to use from several threads"""
+
+    def __init__(self, logger: logging.Logger = None) -> None:
+        """Stage timer constructor, if a logger is given every span is logged in DEBUG"""
+        self.logger = logger
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float, clave: str = BATCH_CLAVE, exhorto_origen_id: str = "") -> None:
+        """Add a span that was measured elsewhere"""
+        with self.lock:
+            self.spans.append((stage, clave, exhorto_origen_id, seconds))
+        if self.logger is not None:
+            self.logger.debug(
+                "span stage=%s clave=%s exhorto_origen_id=%s ms=%.1f", stage, clave, exhorto_origen_id, seconds * 1000
+            )
+
+    @contextmanager
+    def span(self, stage: str, clave: str = BATCH_CLAVE, exhorto_origen_id: str = ""):
+        """Measure the time of the block, it is added even if the block raises an exception"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, clave, exhorto_origen_id)
+
+    def histograms(self) -> dict[tuple[str, str], dict[str, float]]:
+        """Aggregate the spans by destination and stage into histograms"""
+        histograms = {}
+        with self.lock:
+            spans = list(self.spans)
+        for stage, clave, _, seconds in spans:
+            histogram = histograms.setdefault((clave, stage), {"count": 0, "sum": 0.0, "max": 0.0})
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+            for bucket in HISTOGRAM_BUCKETS:
+                if seconds <= bucket:
+                    key = f"le_{bucket}"
+                    histogram[key] = histogram.get(key, 0) + 1
+        return histograms
+
+    def save(self, redis: Redis, prefix: str) -> None:
+        """Add the histograms of this run to the ones kept in Redis"""
+        histograms = self.histograms()
+        if len(histograms) == 0:
+            return
+        try:
+            pipeline = redis.pipeline(transaction=False)
+            for (clave, stage), histogram in histograms.items():
+                key = f"{prefix}:{clave}:{stage}"
+                for field, value in histogram.items():
+                    if field == "sum":
+                        pipeline.hincrbyfloat(key, field, value)
+                    elif field != "max":
+                        pipeline.hincrby(key, field, value)
+            pipeline.execute()
+        except RedisError as error:
+            bitacora.warning("Stage timer could not save the histograms in Redis: %s", str(error))
+
+    def summary(self) -> list[str]:
+        """Lines with the count, mean and max of each destination and stage"""
+        lines = []
+        for (clave, stage), histogram in sorted(self.histograms().items()):
+            mean = histogram["sum"] / histogram["count"]
+            lines.append(
+                f"{clave} {stage}: {histogram['count']} veces, promedio {mean * 1000:.0f} ms, máximo {histogram['max'] * 1000:.0f} ms"
+            )
+        return lines
+
+
+class TimedReader:
+    """File-like reader that accumulates the seconds spent reading, to tell storage time from network time"""
+
+    def __init__(self, fileobj: BinaryIO) -> None:
+        """Timed reader constructor"""
+        self.fileobj = fileobj
+        self.seconds = 0.0
+
+    def read(self, size: int = -1) -> bytes:
+        """Read and accumulate the time"""
+        start = time.perf_counter()
+        try:
+            return self.fileobj.read(size)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def close(self) -> None:
+        """Close the reader"""
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
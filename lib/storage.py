@@ -117,11 +117,11 @@ from pathlib import Path
 from typing import Any
 
 from flask import current_app
-from google.cloud import storage
 from unidecode import unidecode
 from werkzeug.utils import secure_filename
 
 from lib.exceptions import MyFilenameError, MyNotAllowedExtensionError, MyUnknownExtensionError
+from lib.storage_backends import get_storage_backend
 
 locale.setlocale(locale.LC_TIME, "es_MX.utf8")
 
@@ -240,9 +240,5 @@ class GoogleCloudStorage:
         else:
             month_str = self.upload_date.strftime("%m")
         path_str = str(Path(self.base_directory, year_str, month_str, self.filename))
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(self.bucket_name)
-        blob = bucket.blob(path_str)
-        blob.upload_from_string(data, self.content_type)
-        self.url = blob.public_url
+        self.url = get_storage_backend().put(self.bucket_name, path_str, self.content_type, data)
         return self.url
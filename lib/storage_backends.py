@@ -0,0 +1,407 @@
+"""
+Storage Backends
+
+The files of the app are kept in a storage backend, selected with ALMACEN_BACKEND
+
+- gcs: Google Cloud Storage, the URL is https://storage.googleapis.com/{bucket}/{blob}
+- local: a directory of the filesystem ALMACEN_DIRECTORIO, the URL is file:///{bucket}/{blob}
+- memoria: a dict in the memory of the process, for tests, the URL is memory:///{bucket}/{blob}
+
+Every URL has the path /{bucket}/{blob}, then get_blob_name_from_url works with all of them.
+The functions of lib/google_cloud_storage use the backend set with set_storage_backend,
+by default the one of Google Cloud Storage.
+
+    set_storage_backend(create_storage_backend("local", "/var/lib/carina"))
+    url = get_storage_backend().put("deposito", "exh_exhortos_archivos/archivo.pdf", "application/pdf", data)
+
+Every process of Google Cloud Storage shares one client, created on first use, with a pooled
+HTTP session, and one handle per bucket, made with client.bucket() that does not call the API.
+A missing bucket is not checked before, the call that uses it raises NotFound.
+
+"""
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from datetime import timedelta
+from pathlib import Path
+from typing import BinaryIO, Union
+from urllib.parse import quote
+
+import google.auth
+from google.auth.credentials import Signing
+from google.auth.transport.requests import AuthorizedSession, Request
+from google.cloud import storage
+from google.cloud.exceptions import NotFound
+from requests.adapters import HTTPAdapter
+
+from lib.exceptions import (
+    MyBucketNotFoundError,
+    MyDownloadError,
+    MyFileNotFoundError,
+    MyNotValidParamError,
+    MyUploadError,
+)
+
+CHUNK_SIZE = 1024 * 1024  # 1 MB, must be a multiple of 256 KB
+
+POOL_MAXSIZE = 32  # Connections kept open to the storage API, one per thread is enough
+
+_clients = {}  # Client by process ID, a forked process must not reuse the connections of its parent
+_buckets = {}  # Bucket handle by process ID and bucket name
+_lock = threading.Lock()
+
+
+def get_gcs_client() -> storage.Client:
+    """
+    Get the shared client of this process, created on first use
+
+    :return: Storage client with a pooled HTTP session
+    """
+    pid = os.getpid()
+    storage_client = _clients.get(pid)
+    if storage_client is None:
+        with _lock:
+            storage_client = _clients.get(pid)
+            if storage_client is None:
+                credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+                session = AuthorizedSession(credentials)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+                session.mount("https://", adapter)
+                storage_client = storage.Client(project=project, credentials=credentials, _http=session)
+                _clients[pid] = storage_client
+    return storage_client
+
+
+def get_gcs_bucket(bucket_name: str) -> storage.Bucket:
+    """
+    Get the cached handle of a bucket, without calling the API
+
+    :param bucket_name: Name of the bucket
+    :return: Bucket handle
+    """
+    key = (os.getpid(), bucket_name)
+    bucket = _buckets.get(key)
+    if bucket is None:
+        bucket = get_gcs_client().bucket(bucket_name)
+        _buckets[key] = bucket
+    return bucket
+
+
+class StorageBackend(ABC):
+    """Storage backend, a subclass must implement put, get, stream, exists, delete and url"""
+
+    @abstractmethod
+    def put(
+        self,
+        bucket_name: str,
+        blob_name: str,
+        content_type: str,
+        data: Union[bytes, str, BinaryIO],
+        chunk_size: int = CHUNK_SIZE,
+    ) -> str:
+        """
+        Save a file
+
+        :param bucket_name: Name of the bucket
+        :param blob_name: Path to the file
+        :param content_type: Content type of the file
+        :param data: File content, a text is encoded in UTF-8, or a file-like object at its beginning
+            that is read chunk_size bytes at a time
+        :param chunk_size: Bytes read and sent at a time
+        :return: URL of the file
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, bucket_name: str, blob_name: str) -> bytes:
+        """Get the content of a file, raises MyFileNotFoundError"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def stream(self, bucket_name: str, blob_name: str, chunk_size: int = CHUNK_SIZE) -> tuple[BinaryIO, int]:
+        """Open a file to read it in chunks, returns the reader and the size, raises MyFileNotFoundError"""
+        raise NotImplementedError
+
+    def download(self, bucket_name: str, blob_name: str, fileobj: BinaryIO) -> None:
+        """Write the content of a file in a file-like object, raises MyFileNotFoundError"""
+        reader, _ = self.stream(bucket_name, blob_name)
+        with reader:
+            shutil.copyfileobj(reader, fileobj, CHUNK_SIZE)
+
+    @abstractmethod
+    def exists(self, bucket_name: str, blob_name: str) -> bool:
+        """Check if a file exists"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, bucket_name: str, blob_name: str) -> None:
+        """Delete a file, a missing file is ignored"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def url(self, bucket_name: str, blob_name: str) -> str:
+        """URL of a file, without checking that it exists"""
+        raise NotImplementedError
+
+    def signed_url(self, bucket_name: str, blob_name: str, seconds: int, filename: str, content_type: str) -> str:
+        """Temporary URL to download a file directly, raises MyDownloadError if the backend can not sign"""
+        raise MyDownloadError("Signed URLs not supported")
+
+
+class GCSBackend(StorageBackend):
+    """Google Cloud Storage backend"""
+
+    def put(
+        self,
+        bucket_name: str,
+        blob_name: str,
+        content_type: str,
+        data: Union[bytes, str, BinaryIO],
+        chunk_size: int = CHUNK_SIZE,
+    ) -> str:
+        """Upload in one request, or from a file-like object with a resumable upload of chunk_size bytes at a time"""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        bucket = get_gcs_bucket(bucket_name)
+        try:
+            if isinstance(data, bytes):
+                blob = bucket.blob(blob_name)
+                blob.upload_from_string(data, content_type=content_type)
+            else:
+                blob = bucket.blob(blob_name, chunk_size=chunk_size)
+                blob.upload_from_file(data, content_type=content_type)
+        except NotFound as error:
+            raise MyBucketNotFoundError("Bucket not found") from error
+        except Exception as error:
+            raise MyUploadError("Error uploading file") from error
+        return blob.public_url
+
+    def get(self, bucket_name: str, blob_name: str) -> bytes:
+        """Download in one request, a missing bucket or file gives the same NotFound"""
+        try:
+            return get_gcs_bucket(bucket_name).blob(blob_name).download_as_bytes()
+        except NotFound as error:
+            raise MyFileNotFoundError("File not found") from error
+
+    def stream(self, bucket_name: str, blob_name: str, chunk_size: int = CHUNK_SIZE) -> tuple[BinaryIO, int]:
+        """Open a reader that fetches chunk_size bytes on each request"""
+        blob = get_gcs_bucket(bucket_name).get_blob(blob_name)
+        if blob is None:
+            raise MyFileNotFoundError("File not found")
+        return blob.open("rb", chunk_size=chunk_size), blob.size
+
+    def download(self, bucket_name: str, blob_name: str, fileobj: BinaryIO) -> None:
+        """Download in one streamed request"""
+        try:
+            get_gcs_bucket(bucket_name).blob(blob_name).download_to_file(fileobj)
+        except NotFound as error:
+            raise MyFileNotFoundError("File not found") from error
+
+    def exists(self, bucket_name: str, blob_name: str) -> bool:
+        """Check if a file exists, a missing bucket has no files"""
+        return get_gcs_bucket(bucket_name).blob(blob_name).exists()
+
+    def delete(self, bucket_name: str, blob_name: str) -> None:
+        """Delete the blob"""
+        try:
+            get_gcs_bucket(bucket_name).blob(blob_name).delete()
+        except NotFound:
+            pass
+
+    def url(self, bucket_name: str, blob_name: str) -> str:
+        """Public URL"""
+        return get_gcs_bucket(bucket_name).blob(blob_name).public_url
+
+    def signed_url(self, bucket_name: str, blob_name: str, seconds: int, filename: str, content_type: str) -> str:
+        """
+        Signed URL, checks that the file exists because the URL does not
+
+        The credentials of App Engine have no private key, then the URL is signed with
+        the IAM signBlob API using the access token of the service account
+        """
+        blob = get_gcs_bucket(bucket_name).blob(blob_name)
+        if not blob.exists():
+            raise MyFileNotFoundError("File not found")
+        credentials = get_gcs_client()._credentials
+        signing = {}
+        try:
+            if not isinstance(credentials, Signing):
+                if not credentials.valid:
+                    credentials.refresh(Request())
+                signing = {"service_account_email": credentials.service_account_email, "access_token": credentials.token}
+            return blob.generate_signed_url(
+                version="v4",
+                expiration=timedelta(seconds=seconds),
+                method="GET",
+                response_disposition=f"attachment; filename={filename}",
+                response_type=content_type,
+                **signing,
+            )
+        except Exception as error:
+            raise MyDownloadError("Error signing URL") from error
+
+
+class LocalBackend(StorageBackend):
+    """Local filesystem backend, every bucket is a directory inside the root directory"""
+
+    def __init__(self, directory: str) -> None:
+        """Local backend constructor"""
+        if directory == "":
+            raise MyNotValidParamError("The directory of the local storage is not set")
+        self.directory = Path(directory).resolve()
+
+    def _path(self, bucket_name: str, blob_name: str) -> Path:
+        """Path of a file, it must stay inside the root directory"""
+        path = (self.directory / bucket_name / blob_name).resolve()
+        if not path.is_relative_to(self.directory / bucket_name):
+            raise MyNotValidParamError("Not valid blob name")
+        return path
+
+    def put(
+        self,
+        bucket_name: str,
+        blob_name: str,
+        content_type: str,
+        data: Union[bytes, str, BinaryIO],
+        chunk_size: int = CHUNK_SIZE,
+    ) -> str:
+        """Write in a temporary file and move it with an atomic rename"""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        path = self._path(bucket_name, blob_name)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            descriptor, temporary = tempfile.mkstemp(prefix=".tmp-", dir=path.parent)
+            try:
+                with os.fdopen(descriptor, "wb") as fileobj:
+                    if isinstance(data, bytes):
+                        fileobj.write(data)
+                    else:
+                        shutil.copyfileobj(data, fileobj, chunk_size)
+                os.replace(temporary, path)
+            finally:
+                if os.path.exists(temporary):
+                    os.unlink(temporary)
+        except OSError as error:
+            raise MyUploadError("Error uploading file") from error
+        return self.url(bucket_name, blob_name)
+
+    def get(self, bucket_name: str, blob_name: str) -> bytes:
+        """Read the file"""
+        try:
+            return self._path(bucket_name, blob_name).read_bytes()
+        except FileNotFoundError as error:
+            raise MyFileNotFoundError("File not found") from error
+
+    def stream(self, bucket_name: str, blob_name: str, chunk_size: int = CHUNK_SIZE) -> tuple[BinaryIO, int]:
+        """Open the file"""
+        path = self._path(bucket_name, blob_name)
+        try:
+            fileobj = open(path, "rb")
+        except FileNotFoundError as error:
+            raise MyFileNotFoundError("File not found") from error
+        return fileobj, os.fstat(fileobj.fileno()).st_size
+
+    def exists(self, bucket_name: str, blob_name: str) -> bool:
+        """Check if the file exists"""
+        return self._path(bucket_name, blob_name).is_file()
+
+    def delete(self, bucket_name: str, blob_name: str) -> None:
+        """Remove the file"""
+        self._path(bucket_name, blob_name).unlink(missing_ok=True)
+
+    def url(self, bucket_name: str, blob_name: str) -> str:
+        """URL file:///{bucket}/{blob}, relative to the root directory"""
+        return f"file:///{bucket_name}/{quote(blob_name)}"
+
+
+class MemoryBackend(StorageBackend):
+    """In memory backend for tests, the files are lost when the process ends"""
+
+    def __init__(self) -> None:
+        """Memory backend constructor"""
+        self.files = {}  # Content by bucket and blob name
+        self.lock = threading.Lock()
+
+    def put(
+        self,
+        bucket_name: str,
+        blob_name: str,
+        content_type: str,
+        data: Union[bytes, str, BinaryIO],
+        chunk_size: int = CHUNK_SIZE,
+    ) -> str:
+        """Keep the content"""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if not isinstance(data, bytes):
+            buffer = io.BytesIO()
+            shutil.copyfileobj(data, buffer, chunk_size)
+            data = buffer.getvalue()
+        with self.lock:
+            self.files[(bucket_name, blob_name)] = data
+        return self.url(bucket_name, blob_name)
+
+    def get(self, bucket_name: str, blob_name: str) -> bytes:
+        """Get the content"""
+        try:
+            return self.files[(bucket_name, blob_name)]
+        except KeyError as error:
+            raise MyFileNotFoundError("File not found") from error
+
+    def stream(self, bucket_name: str, blob_name: str, chunk_size: int = CHUNK_SIZE) -> tuple[BinaryIO, int]:
+        """Reader of the content"""
+        data = self.get(bucket_name, blob_name)
+        return io.BytesIO(data), len(data)
+
+    def exists(self, bucket_name: str, blob_name: str) -> bool:
+        """Check if the content exists"""
+        return (bucket_name, blob_name) in self.files
+
+    def delete(self, bucket_name: str, blob_name: str) -> None:
+        """Remove the content"""
+        with self.lock:
+            self.files.pop((bucket_name, blob_name), None)
+
+    def url(self, bucket_name: str, blob_name: str) -> str:
+        """URL memory:///{bucket}/{blob}"""
+        return f"memory:///{bucket_name}/{quote(blob_name)}"
+
+
+# Backends by the value of ALMACEN_BACKEND
+BACKENDS = {
+    "gcs": GCSBackend,
+    "local": LocalBackend,
+    "memoria": MemoryBackend,
+}
+
+_backend = {"actual": GCSBackend()}
+
+
+def create_storage_backend(name: str, directory: str = "") -> StorageBackend:
+    """
+    Create a storage backend
+
+    :param name: One of BACKENDS
+    :param directory: Root directory of the local backend
+    :return: Storage backend
+    """
+    if name not in BACKENDS:
+        raise MyNotValidParamError(f"Storage backend {name} does not exist")
+    if name == "local":
+        return LocalBackend(directory)
+    return BACKENDS[name]()
+
+
+def get_storage_backend() -> StorageBackend:
+    """Get the storage backend of the process"""
+    return _backend["actual"]
+
+
+def set_storage_backend(backend: StorageBackend) -> None:
+    """Set the storage backend of the process"""
+    _backend["actual"] = backend
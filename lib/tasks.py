@@ -1,38 +1,179 @@
 """
 Tareas en el fondo
+
+El avance se guarda en los meta del job en Redis en cada llamada, y en la tabla tareas
+solo al terminar o cuando han pasado SEGUNDOS_ENTRE_GUARDADOS desde que se guardó
+
+Cada cambio se publica como un evento en el canal de Redis de la tarea, y el último evento
+se guarda en la llave del mismo nombre, para que la página de la tarea lo reciba sin consultar
+
+Una tarea lanzada con llave única toma en Redis la llave de su comando y su llave única,
+mientras la tenga, lanzar una tarea equivalente entrega la misma; se libera al terminar
 """
 
+import json
+import time
+from typing import Optional
+
+from redis import Redis
+from redis.exceptions import RedisError
 from rq import get_current_job
+from rq.job import Job, JobStatus
 
 from carina.blueprints.tareas.models import Tarea
 
+SEGUNDOS_ENTRE_GUARDADOS = 5  # Como máximo se guarda el avance en la base de datos cada 5 segundos
+SEGUNDOS_EVENTOS = 86400  # El último evento de una tarea se conserva un día
+TASK_EVENTS_PREFIX = "tareas:eventos"
+TASK_LOCKS_PREFIX = "tareas:unicas"
+SEGUNDOS_LLAVE_UNICA = 3600  # Si el worker muere sin liberar la llave, vence en una hora
+INTENTOS_ESPERAR_TAREA = 20  # Veces que se busca la tarea de la llave, la guarda quien la tomó justo después de encolar
+SEGUNDOS_ESPERAR_TAREA = 0.1
+
+# Estados del job en los que una tarea equivalente no se debe lanzar
+JOB_ESTADOS_VIVOS = (JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED, JobStatus.SCHEDULED)
+
+# Cambia el job de la llave solo si todavía tiene el anterior, sin job nuevo la borra
+SWAP_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    if ARGV[2] == '' then
+        redis.call('DEL', KEYS[1])
+    else
+        redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    end
+    return 1
+end
+return 0
+"""
+
+
+def get_task_channel(tarea_id: str) -> str:
+    """Canal de Redis donde se publican los eventos de la tarea, también es la llave del último evento"""
+    return f"{TASK_EVENTS_PREFIX}:{tarea_id}"
+
+
+def publish_task_event(job: Job, ha_terminado: bool) -> None:
+    """Publicar el avance de la tarea y guardarlo como el último evento"""
+    evento = json.dumps(
+        {
+            "secuencia": job.meta["secuencia"],
+            "progress": job.meta.get("progress", 0),
+            "message": job.meta.get("message", ""),
+            "ha_terminado": ha_terminado,
+            "archivo": job.meta.get("archivo", ""),
+            "url": job.meta.get("url", ""),
+        }
+    )
+    canal = get_task_channel(job.get_id())
+    try:
+        pipeline = job.connection.pipeline(transaction=False)
+        pipeline.set(canal, evento, ex=SEGUNDOS_EVENTOS)
+        pipeline.publish(canal, evento)
+        pipeline.execute()
+    except RedisError:
+        pass  # Sin eventos la página de la tarea muestra lo que está en la base de datos
+
+
+def get_task_lock(comando: str, llave_unica: str) -> str:
+    """Llave de Redis de una tarea única"""
+    return f"{TASK_LOCKS_PREFIX}:{comando}:{llave_unica}"
+
+
+def swap_task_lock(redis: Redis, llave: str, anterior_id: str, nuevo_id: str = "") -> bool:
+    """Cambiar el job de la llave solo si todavía es el anterior, sin nuevo_id se libera, entrega si se cambió"""
+    return bool(redis.eval(SWAP_LOCK_SCRIPT, 1, llave, anterior_id, nuevo_id, SEGUNDOS_LLAVE_UNICA))
+
+
+def lock_task(redis: Redis, llave: str, job_id: str) -> Optional[Tarea]:
+    """
+    Tomar la llave única para el job, si otra tarea equivalente está en la cola o en ejecución se entrega esa
+
+    :param redis: Conexión a Redis
+    :param llave: Llave de get_task_lock
+    :param job_id: ID del job que se va a encolar
+    :return: La tarea equivalente o None si se tomó la llave
+    """
+    for _ in range(3):
+        if redis.set(llave, job_id, nx=True, ex=SEGUNDOS_LLAVE_UNICA):
+            return None
+        anterior_id = redis.get(llave)
+        if anterior_id is None:
+            continue  # Venció o se liberó en medio, volver a intentar
+        anterior_id = anterior_id.decode("utf-8")
+        # Quien tomó la llave guarda la tarea justo después de encolar, esperar un poco si todavía no está
+        tarea = None
+        for _ in range(INTENTOS_ESPERAR_TAREA):
+            tarea = Tarea.query.get(anterior_id)
+            if tarea is not None:
+                break
+            time.sleep(SEGUNDOS_ESPERAR_TAREA)
+        if tarea is not None and not tarea.ha_terminado:
+            rq_job = tarea.get_rq_job()
+            if rq_job is not None and rq_job.get_status() in JOB_ESTADOS_VIVOS:
+                return tarea
+        # La tarea anterior terminó o murió sin liberar la llave, tomarla si nadie más lo hizo
+        if swap_task_lock(redis, llave, anterior_id, job_id):
+            return None
+    return None
+
+
+def release_task_lock(job: Job) -> None:
+    """Liberar la llave única del job, si tiene"""
+    llave = job.meta.get("llave_unica", "")
+    if llave != "":
+        try:
+            swap_task_lock(job.connection, llave, job.get_id())
+        except RedisError:
+            pass  # La llave vence sola
+
+
+def save_task(job: Job, ha_terminado: bool) -> None:
+    """Guardar en la base de datos el mensaje, archivo y url que están en los meta del job"""
+    tarea = Tarea.query.get(job.get_id())
+    if tarea:
+        hay_cambios = False
+        archivo = job.meta.get("archivo", "")
+        if archivo != "" and archivo != tarea.archivo:
+            tarea.archivo = archivo
+            hay_cambios = True
+        url = job.meta.get("url", "")
+        if url != "" and url != tarea.url:
+            tarea.url = url
+            hay_cambios = True
+        if ha_terminado != tarea.ha_terminado:
+            tarea.ha_terminado = ha_terminado
+            hay_cambios = True
+        mensaje = job.meta.get("message", "")
+        if mensaje != tarea.mensaje:
+            tarea.mensaje = mensaje
+            hay_cambios = True
+        if hay_cambios:
+            tarea.save()
+
 
 def set_task_progress(progress: int, message: str, archivo: str = "", url: str = "") -> None:
     """Cambiar el progreso de la tarea"""
     job = get_current_job()
     if job:
         job.meta["progress"] = progress
+        job.meta["message"] = message
+        if archivo != "":
+            job.meta["archivo"] = archivo
+        if url != "":
+            job.meta["url"] = url
+        # Guardar en la base de datos solo al terminar o si ya pasaron los segundos entre guardados
+        ahora = time.time()
+        hay_que_guardar = progress >= 100 or ahora - job.meta.get("guardado", 0) >= SEGUNDOS_ENTRE_GUARDADOS
+        if hay_que_guardar:
+            job.meta["guardado"] = ahora
+        job.meta["secuencia"] = job.meta.get("secuencia", 0) + 1
         job.save_meta()
-        tarea = Tarea.query.get(job.get_id())
-        if tarea:
-            hay_cambios = False
-            if archivo != "" and archivo != tarea.archivo:
-                tarea.archivo = archivo
-                hay_cambios = True
-            if url != "" and url != tarea.url:
-                tarea.url = url
-                hay_cambios = True
-            if progress < 100 and tarea.ha_terminado is True:
-                tarea.ha_terminado = False
-                hay_cambios = True
-            if progress >= 100 and tarea.ha_terminado is False:
-                tarea.ha_terminado = True
-                hay_cambios = True
-            if message != tarea.mensaje:
-                tarea.mensaje = message
-                hay_cambios = True
-            if hay_cambios:
-                tarea.save()
+        # Se guarda antes de publicar para que la página que se recarga al terminar ya lo encuentre en la base de datos
+        if hay_que_guardar:
+            save_task(job, progress >= 100)
+        publish_task_event(job, progress >= 100)
+        if progress >= 100:
+            release_task_lock(job)
 
 
 def set_task_error(message: str) -> str:
@@ -40,10 +181,11 @@ def set_task_error(message: str) -> str:
     job = get_current_job()
     if job:
         job.meta["progress"] = 100
+        job.meta["message"] = message
+        job.meta["guardado"] = time.time()
+        job.meta["secuencia"] = job.meta.get("secuencia", 0) + 1
         job.save_meta()
-        tarea = Tarea.query.get(job.get_id())
-        if tarea:
-            tarea.ha_terminado = True
-            tarea.mensaje = message
-            tarea.save()
+        save_task(job, True)
+        publish_task_event(job, True)
+        release_task_lock(job)
     return message
@@ -0,0 +1,113 @@
+"""
+Tests Storage Backends
+"""
+
+import io
+
+import pytest
+
+from lib.exceptions import MyFileNotFoundError, MyNotValidParamError
+from lib.google_cloud_storage import check_file_exists_from_gcs, get_file_from_gcs
+from lib.storage_backends import (
+    LocalBackend,
+    MemoryBackend,
+    StorageBackend,
+    get_storage_backend,
+    set_storage_backend,
+)
+
+BUCKET = "deposito"
+BLOB = "exh_exhortos_archivos/archivo de prueba.pdf"
+DATA = b"%PDF-1.4 " + bytes(range(256)) * 1024
+
+
+@pytest.fixture(name="backend", params=["local", "memoria"])
+def fixture_backend(request, tmp_path):
+    """Local and memory backends"""
+    if request.param == "local":
+        return LocalBackend(str(tmp_path))
+    return MemoryBackend()
+
+
+def test_put_get(backend):
+    """Put bytes and get them back"""
+    url = backend.put(BUCKET, BLOB, "application/pdf", DATA)
+    assert url == backend.url(BUCKET, BLOB)
+    assert backend.get(BUCKET, BLOB) == DATA
+
+
+def test_put_stream(backend):
+    """Put a file-like object in chunks and stream it back"""
+    backend.put(BUCKET, BLOB, "application/pdf", io.BytesIO(DATA), chunk_size=256 * 1024)
+    reader, size = backend.stream(BUCKET, BLOB)
+    with reader:
+        assert size == len(DATA)
+        assert reader.read() == DATA
+
+
+def test_put_text(backend):
+    """A text is saved in UTF-8"""
+    backend.put(BUCKET, "texto.txt", "text/plain", "Señor juez")
+    assert backend.get(BUCKET, "texto.txt") == "Señor juez".encode("utf-8")
+
+
+def test_exists(backend):
+    """Exists only after the put"""
+    assert backend.exists(BUCKET, BLOB) is False
+    backend.put(BUCKET, BLOB, "application/pdf", DATA)
+    assert backend.exists(BUCKET, BLOB) is True
+
+
+def test_delete(backend):
+    """Delete removes the file, deleting a missing file does nothing"""
+    backend.put(BUCKET, BLOB, "application/pdf", DATA)
+    backend.delete(BUCKET, BLOB)
+    assert backend.exists(BUCKET, BLOB) is False
+    backend.delete(BUCKET, BLOB)
+
+
+def test_missing_file(backend):
+    """A missing file raises MyFileNotFoundError"""
+    with pytest.raises(MyFileNotFoundError):
+        backend.get(BUCKET, "no_existe.pdf")
+    with pytest.raises(MyFileNotFoundError):
+        backend.stream(BUCKET, "no_existe.pdf")
+
+
+def test_local_path_traversal(tmp_path):
+    """The local backend does not write outside its directory"""
+    backend = LocalBackend(str(tmp_path / "almacen"))
+    with pytest.raises(MyNotValidParamError):
+        backend.put(BUCKET, "../../fuera.pdf", "application/pdf", DATA)
+
+
+def test_abstract_backend():
+    """A backend without the required methods can not be created"""
+
+    class Incomplete(StorageBackend):
+        """Backend without stream, exists and url"""
+
+        def put(self, bucket_name, blob_name, content_type, data, chunk_size=0):
+            return ""
+
+        def get(self, bucket_name, blob_name):
+            return b""
+
+    with pytest.raises(TypeError):
+        Incomplete()  # pylint: disable=abstract-class-instantiated
+
+
+def test_set_storage_backend():
+    """The functions of google_cloud_storage use the backend that is set"""
+    previous = get_storage_backend()
+    backend = MemoryBackend()
+    try:
+        set_storage_backend(backend)
+        assert get_storage_backend() is backend
+        assert check_file_exists_from_gcs(BUCKET, BLOB) is False
+        backend.put(BUCKET, BLOB, "application/pdf", DATA)
+        assert check_file_exists_from_gcs(BUCKET, BLOB) is True
+        assert get_file_from_gcs(BUCKET, BLOB) == DATA
+    finally:
+        set_storage_backend(previous)
+    assert get_storage_backend() is previous
@@ -0,0 +1,41 @@
+"""
+Arrancar el worker de las tareas en el fondo con la app ya cargada
+
+El worker de rq por defecto hace un fork por cada tarea, y el proceso hijo vuelve a importar el módulo
+de tareas que crea la app con sus blueprints, Redis y el pool de SQLAlchemy, lo que tarda segundos.
+Este worker crea la app, el pool y los módulos de tareas una sola vez y ejecuta las tareas sin fork,
+cada tarea en su propio contexto de la app para que tenga su propia sesión de la base de datos.
+
+    python3 worker.py
+
+"""
+
+import importlib
+
+import rq
+
+from carina.app import get_or_create_app
+
+# Módulos con las tareas que lanza launch_task, se importan al arrancar y no en la primera tarea
+MODULOS_TAREAS = (
+    "carina.blueprints.exh_exhortos.tasks",
+    "carina.blueprints.exh_externos.tasks",
+)
+
+app = get_or_create_app()
+
+
+class WarmWorker(rq.SimpleWorker):
+    """Worker sin fork que ejecuta cada tarea en un contexto nuevo de la app"""
+
+    def perform_job(self, job, queue):
+        """Ejecutar la tarea, al salir del contexto se cierra su sesión y la conexión regresa al pool"""
+        with app.app_context():
+            return super().perform_job(job, queue)
+
+
+if __name__ == "__main__":
+    for modulo in MODULOS_TAREAS:
+        importlib.import_module(modulo)
+    worker = WarmWorker([app.task_queue], connection=app.redis)
+    worker.work(with_scheduler=True)